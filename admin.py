@@ -0,0 +1,173 @@
+import database
+import get_api_token
+import outbox
+import plans
+from cache import TTLCache, MISSING
+from singleflight import SingleFlight
+
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# Команды для администраторов (id в Admin_ids_env): /stats - сводка по подпискам и платежам,
+# /export accounts|payments - выгрузка таблицы в CSV, сжатом gzip.
+
+# Сколько секунд отдавать сводку из кэша: повторные /stats не пересчитывают агрегаты
+STATS_TTL = 60
+# "Истекают скоро" - в ближайшие EXPIRING_DAYS дней; выручка "за период" - за REVENUE_DAYS дней
+EXPIRING_DAYS = 7
+REVENUE_DAYS = 30
+# Строк на страницу выгрузки: в памяти одновременно лежит только одна страница
+EXPORT_PAGE_SIZE = 1000
+
+_stats_cache = TTLCache("admin_stats", 1, STATS_TTL)
+# Одновременные /stats ждут один подсчет
+_stats_flight = SingleFlight()
+# Фоновые задачи выгрузки по (id администратора, таблица): повторная команда не запускает вторую,
+# и ссылка на задачу не дает ее собрать сборщику мусора
+_exports = {}
+
+
+# Таблица -> (заголовок CSV, функция чтения страницы, отбросить ли первое поле). Первое поле строки -
+# ключ страницы (keyset); у payments это rowid, в файл он не пишется.
+EXPORTS = {
+    'accounts': (
+        ('user_id', 'end_ts', 'node_id', 'status', 'used_traffic', 'lifetime_used_traffic', 'data_limit'),
+        database.export_accounts_page,
+        False,
+    ),
+    'payments': (
+        ('payment_id', 'user_id', 'plan', 'amount', 'status', 'created_at'),
+        database.export_payments_page,
+        True,
+    ),
+}
+
+
+# Фильтр обработчиков: команды видят только администраторы, остальным бот не отвечает
+def is_admin(message):
+    return message.from_user.id in get_api_token.Admin_ids
+
+
+async def _compute_stats():
+    now = int(time.time())
+    users, active, expiring, revenue, usage = await database.get_stats(
+        now, now + EXPIRING_DAYS * 86400, now - REVENUE_DAYS * 86400
+    )
+    lines = [
+        f"Пользователей: {users}",
+        f"Активных подписок: {active}",
+        f"Истекает за {EXPIRING_DAYS} дн.: {expiring}",
+        "",
+        f"Выручка по тарифам (всего / за {REVENUE_DAYS} дн.):",
+    ]
+    total = total_recent = 0
+    for plan, count, amount, recent_count, recent_amount in revenue:
+        lines.append(f"{plans.title(plan)}: {count} шт. на {amount} руб / {recent_count} шт. на {recent_amount} руб")
+        total += amount
+        total_recent += recent_amount
+    if not revenue:
+        lines.append("платежей нет")
+    lines.append(f"Итого: {total} руб / {total_recent} руб")
+    users_with_traffic, traffic = usage
+    lines.append("")
+    lines.append(f"Трафик за сегодня: {traffic / 1024 ** 3:.1f} ГБ у {users_with_traffic} пользователей")
+    lines.append(f"Данные на {datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%d %H:%M')} UTC")
+    return "\n".join(lines)
+
+
+# Текст сводки; пересчитывается не чаще раза в STATS_TTL секунд
+async def stats_text():
+    text = _stats_cache.get('stats')
+    if text is MISSING:
+        text, _ = await _stats_flight.do('stats', _compute_stats)
+        _stats_cache.set('stats', text)
+    return text
+
+
+# Ответы администратору уходят в его личный чат (from_user.id, проверенный is_admin), а не в чат
+# из обновления: команда, отправленная в группе, не должна выкладывать сводку и выгрузки туда
+async def stats_command(message):
+    outbox.send(message.from_user.id, await stats_text())
+
+
+# Пишет таблицу во временный .csv.gz страницами по EXPORT_PAGE_SIZE строк. Чтение страниц идет
+# через пул соединений, сжатие и запись на диск - в потоке, поэтому event loop не блокируется
+# и обработчики пользователей работают как обычно. Возвращает (путь, число строк).
+async def write_export(table):
+    header, fetch_page, skip_key = EXPORTS[table]
+    fd, path = tempfile.mkstemp(prefix=f'export_{table}_', suffix='.csv.gz')
+    rows_written = 0
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as output:
+            after = 0
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            while True:
+                rows = await fetch_page(after, EXPORT_PAGE_SIZE)
+                if not rows:
+                    break
+                writer.writerows((row[1:] for row in rows) if skip_key else rows)
+                rows_written += len(rows)
+                after = rows[-1][0]
+                data = buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+                await asyncio.to_thread(output.write, data)
+                if len(rows) < EXPORT_PAGE_SIZE:
+                    break
+            if buffer.tell():
+                await asyncio.to_thread(output.write, buffer.getvalue().encode())
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, rows_written
+
+
+async def _export(chat_id, table):
+    started = time.monotonic()
+    try:
+        path, rows = await write_export(table)
+    except Exception:
+        logging.exception("Не удалось выгрузить %s", table)
+        outbox.send(chat_id, f"Не удалось выгрузить {table}, подробности в логах")
+        return
+    try:
+        # Файл уходит через outbox, с общими лимитами Telegram, как и остальные ответы
+        filename = f"{table}_{datetime.now(timezone.utc).strftime('%Y%m%d_%H%M')}.csv.gz"
+        sent = await outbox.send_document(chat_id, path, filename, caption=f"{table}: {rows} строк")
+    finally:
+        os.unlink(path)
+    if sent:
+        logging.info("Выгрузка %s: %s строк за %.1f с", table, rows, time.monotonic() - started)
+    else:
+        outbox.send(chat_id, f"Не удалось отправить выгрузку {table}, подробности в логах")
+
+
+async def export_command(message):
+    admin_id = message.from_user.id
+    table = message.get_args().strip() or 'accounts'
+    if table not in EXPORTS:
+        outbox.send(admin_id, f"Использование: /export {'|'.join(EXPORTS)}")
+        return
+    key = (admin_id, table)
+    if key in _exports:
+        outbox.send(admin_id, f"Выгрузка {table} уже идет")
+        return
+    outbox.send(admin_id, f"Готовлю выгрузку {table}, пришлю файлом")
+    # Выгрузка идет в фоне: обработчик сразу возвращается, а долгий проход по таблице
+    # не держит обработку обновлений
+    task = _exports[key] = asyncio.create_task(_export(admin_id, table))
+    task.add_done_callback(lambda _: _exports.pop(key, None))
+
+
+def register_handlers(dp):
+    dp.register_message_handler(stats_command, is_admin, commands=['stats'])
+    dp.register_message_handler(export_command, is_admin, commands=['export'])
@@ -0,0 +1,200 @@
+# Замер задержки и пропускной способности обработчиков main.py.
+# Настоящий диспетчер dp получает синтетические Update, а Telegram, YooKassa и Marzban
+# заменены локальными фейками с настраиваемой задержкой. Каждый виртуальный пользователь
+# проходит сценарий /start -> «Купить VPN» -> выбор тарифа -> «Проверить оплату» -> «Мои подписки».
+#
+# Запуск:  python -m bench.bench_handlers --users 100 1000 --concurrency 1 10 50 --output bench_results.json
+# Результаты нескольких запусков можно сравнивать по JSON-файлам.
+
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+
+os.environ.setdefault("TOKEN_bot", "123456:BENCHbenchBENCHbench")
+
+import get_api_token
+import callbacks
+import database
+import yookassa_link
+import outbox
+from bench import fake_marzban, fake_telegram, yookassa_stub
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+
+def _message_update(user_id, text):
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def _callback_update(user_id, data):
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "Выберите срок подписки и перейдите по ссылке для оплаты:",
+            },
+        },
+    }
+
+
+# Сценарий одного пользователя: (название обработчика, Update)
+def _scenario(user_id):
+    return [
+        ("menu_vpn", _message_update(user_id, "/start")),
+        ("process_buy_vpn", _message_update(user_id, "Купить VPN")),
+        ("handle_subscription_choice", _callback_update(user_id, callbacks.pack(callbacks.ACTION_BUY, "1month"))),
+        ("check_payment_status_handler", _callback_update(user_id, callbacks.pack(callbacks.ACTION_CHECK, "1month"))),
+        ("show_subscription_info", _message_update(user_id, "Мои подписки")),
+    ]
+
+
+def _percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(len(samples) * q))] * 1000
+
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.fmean(samples) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+    }
+
+
+async def _run_level(main, types, users, concurrency, first_user_id):
+    latencies = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def session(user_id):
+        async with semaphore:
+            for handler, data in _scenario(user_id):
+                update = types.Update.to_object(data)
+                start = time.perf_counter()
+                await main.dp.process_updates([update])
+                latencies.setdefault(handler, []).append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(session(first_user_id + i) for i in range(users)))
+    elapsed = time.perf_counter() - start
+
+    all_samples = [sample for samples in latencies.values() for sample in samples]
+    return {
+        "users": users,
+        "concurrency": concurrency,
+        "updates": len(all_samples),
+        "elapsed_s": elapsed,
+        "updates_per_s": len(all_samples) / elapsed,
+        "overall": _percentiles(all_samples),
+        "handlers": {handler: _percentiles(samples) for handler, samples in latencies.items()},
+    }
+
+
+async def run(args):
+    telegram_app, telegram_runner = await fake_telegram.start_fake(args.port, args.telegram_latency)
+    yookassa_runner = await yookassa_stub.start_stub(args.port + 1, args.yookassa_latency)
+    marzban_app, marzban_runner = await fake_marzban.start_fake(args.port + 2, args.marzban_latency)
+
+    get_api_token.Yoo_Api_url = f"http://127.0.0.1:{args.port + 1}/v3"
+    get_api_token.Yoo_Api_id = get_api_token.Yoo_Api_key = "bench"
+    get_api_token.Marzban_url = f"http://127.0.0.1:{args.port + 2}"
+    get_api_token.Auth_name = get_api_token.Auth_password = "bench"
+    database.DB_PATH = os.path.join(tempfile.mkdtemp(), "bench.db")
+    # Фейковый Telegram лимитов не вводит; общий лимит outbox можно поднять, чтобы очередь не копилась
+    get_api_token.Telegram_rate = args.telegram_rate
+
+    # Бот создается внутри работающего event loop, чтобы его HTTP-сессия была привязана к нему
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.bot.api import TelegramAPIServer
+    main = importlib.import_module("main")
+    main.create_dispatcher()
+    main.bot.server = TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+
+    await database.db_start()
+    await yookassa_link.start()
+    outbox.start(main.bot)
+
+    results = []
+    first_user_id = 1
+    try:
+        for users in args.users:
+            for concurrency in args.concurrency:
+                result = await _run_level(main, types, users, concurrency, first_user_id)
+                first_user_id += users
+                results.append(result)
+                overall = result["overall"]
+                print(
+                    f"users={users:6d} concurrency={concurrency:4d}  "
+                    f"{result['updates_per_s']:8.1f} upd/s  "
+                    f"p50={overall['p50_ms']:7.1f} мс  p95={overall['p95_ms']:7.1f} мс  p99={overall['p99_ms']:7.1f} мс"
+                )
+    finally:
+        # Дожидаемся отправки ответов из очереди, чтобы telegram_calls были полными
+        await outbox.stop(timeout=60)
+        await main.on_shutdown(main.dp)
+        await (await main.bot.get_session()).close()
+        for runner in (telegram_runner, yookassa_runner, marzban_runner):
+            await runner.cleanup()
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "latency_ms": {
+            "telegram": args.telegram_latency * 1000,
+            "yookassa": args.yookassa_latency * 1000,
+            "marzban": args.marzban_latency * 1000,
+        },
+        "results": results,
+        "telegram_calls": telegram_app["calls"],
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный замер обработчиков бота")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--yookassa-latency", type=float, default=0.1)
+    parser.add_argument("--marzban-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-rate", type=float, default=1000, help="общий лимит сообщений в секунду")
+    parser.add_argument("--port", type=int, default=8083)
+    parser.add_argument("--output", help="файл для JSON-результатов")
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -0,0 +1,55 @@
+# Замер пакетного отключения пользователей в Marzban (пользователей в секунду)
+# при разных уровнях параллельности против локального фейкового Marzban.
+#
+# Запуск:  python -m bench.bench_marzban --users 2000 --concurrency 1 8 32 64 --latency 0.02 --capacity 32
+
+import argparse
+import asyncio
+import time
+
+import get_api_token
+from marzban_backend import MarzbanBackend
+from bench import fake_marzban
+
+
+async def run(users, concurrency_levels, latency, capacity, error_rate, verify, port):
+    app, runner = await fake_marzban.start_fake(port, latency, capacity, error_rate)
+    fake_marzban.add_users(app, users)
+    get_api_token.Marzban_url = f"http://127.0.0.1:{port}"
+    marzban = MarzbanBackend(token="fake-token")
+    names = [f"user_{i}" for i in range(users)]
+
+    try:
+        print(f"users={users} latency={latency * 1000:.0f} мс capacity={capacity or '-'} error_rate={error_rate}")
+        for concurrency in concurrency_levels:
+            for user in app["users"].values():
+                user["status"] = "active"
+            before = dict(app["stats"])
+
+            start = time.perf_counter()
+            results = await marzban.disable_users(names, verify=verify, concurrency=concurrency)
+            elapsed = time.perf_counter() - start
+
+            ok = sum(result.ok for result in results)
+            throttled = app["stats"]["throttled"] - before["throttled"]
+            requests = app["stats"]["requests"] - before["requests"]
+            print(
+                f"concurrency={concurrency:4d}  {ok / elapsed:9.1f} польз/с  "
+                f"ok={ok}/{users}  запросов={requests}  429={throttled}  время={elapsed:.2f} с"
+            )
+    finally:
+        await marzban.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Замер пакетного отключения пользователей Marzban")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--capacity", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--verify", action="store_true")
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.concurrency, args.latency, args.capacity, args.error_rate, args.verify, args.port))
@@ -0,0 +1,79 @@
+# Замер пропускной способности платежного клиента на N одновременных плательщиках.
+# Поднимает заглушку YooKassa в том же процессе и временную БД,
+# каждый плательщик создает платеж и проверяет его статус.
+#
+# Запуск:  python -m bench.bench_payments --payers 50 100 200 --latency 0.2
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import get_api_token
+import database
+import plans
+import yookassa_link
+from bench import yookassa_stub
+
+
+async def _loop_lag_probe(interval, samples):
+    # Если что-то блокирует event loop, sleep просыпается заметно позже положенного
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+async def _payer(user_id, latencies):
+    start = time.perf_counter()
+    url = await yookassa_link.create_payment(user_id, plans.get('1month'))
+    paid = await yookassa_link.check_payment_status(user_id)
+    latencies.append(time.perf_counter() - start)
+    return url is not None and paid is not None
+
+
+async def run(payers_list, latency, port):
+    runner = await yookassa_stub.start_stub(port, latency)
+    get_api_token.Yoo_Api_url = f"http://127.0.0.1:{port}/v3"
+    get_api_token.Yoo_Api_id = get_api_token.Yoo_Api_id or "bench"
+    get_api_token.Yoo_Api_key = get_api_token.Yoo_Api_key or "bench"
+
+    tmp_dir = tempfile.mkdtemp()
+    database.DB_PATH = os.path.join(tmp_dir, "bench.db")
+    await database.db_start()
+    await yookassa_link.start()
+
+    try:
+        print(f"latency заглушки: {latency * 1000:.0f} мс")
+        for payers in payers_list:
+            latencies, lags = [], []
+            probe = asyncio.create_task(_loop_lag_probe(0.01, lags))
+            start = time.perf_counter()
+            results = await asyncio.gather(*(_payer(user_id, latencies) for user_id in range(payers)))
+            elapsed = time.perf_counter() - start
+            probe.cancel()
+
+            latencies.sort()
+            p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0
+            print(
+                f"payers={payers:5d}  ok={sum(results):5d}  "
+                f"{payers / elapsed:8.1f} плат/с  "
+                f"p50={statistics.median(latencies) * 1000:7.1f} мс  p95={p95 * 1000:7.1f} мс  "
+                f"max loop lag={max(lags, default=0) * 1000:6.1f} мс"
+            )
+    finally:
+        await yookassa_link.close()
+        await database.db_close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный замер платежного клиента")
+    parser.add_argument("--payers", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    asyncio.run(run(args.payers, args.latency, args.port))
@@ -0,0 +1,154 @@
+# Локальный фейковый Marzban с основными эндпоинтами API пользователей
+# для замеров без настоящей панели.
+#
+# Отдельный запуск:  python -m bench.fake_marzban --port 8082 --latency 0.05 --capacity 32
+# и Marzban_url_env=http://127.0.0.1:8082 в .env бота.
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import time
+
+from aiohttp import web
+
+
+def _user(username, status="active"):
+    return {
+        "username": username,
+        "status": status,
+        "used_traffic": 0,
+        "lifetime_used_traffic": 0,
+        "data_limit": 15 * 1024 * 1024 * 1024,
+        "links": [
+            f"ss://Y2hhY2hhMjAtaWV0Zi1wb2x5MTMwNTp7dXNlcm5hbWV9@127.0.0.1:1080#{username}",
+            f"ss://Y2hhY2hhMjAtaWV0Zi1wb2x5MTMwNTp7dXNlcm5hbWV9@127.0.0.2:1080#{username}",
+        ],
+    }
+
+
+def _jwt(exp):
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    return f"{part({'alg': 'HS256', 'typ': 'JWT'})}.{part({'sub': 'admin', 'exp': exp})}.signature"
+
+
+def create_app(latency=0.0, capacity=0, error_rate=0.0, token_ttl=0):
+    # latency - задержка каждого ответа,
+    # capacity - сколько запросов панель обрабатывает одновременно, сверх этого отвечает 429 (0 - без лимита),
+    # error_rate - доля запросов, на которые панель отвечает 502,
+    # token_ttl - срок жизни выдаваемых токенов; если задан, запросы с истекшим токеном получают 401
+    users = {}
+    tokens = {}
+    stats = {"requests": 0, "throttled": 0, "errors": 0, "logins": 0}
+    in_flight = 0
+
+    @web.middleware
+    async def simulate_load(request, handler):
+        nonlocal in_flight
+        stats["requests"] += 1
+        if token_ttl and request.path != "/api/admin/token":
+            token = request.headers.get("Authorization", "").replace("Bearer ", "")
+            if tokens.get(token, 0) < time.time():
+                return web.json_response({"detail": "Could not validate credentials"}, status=401)
+        if capacity and in_flight >= capacity:
+            stats["throttled"] += 1
+            return web.json_response({"detail": "Too Many Requests"}, status=429)
+        if error_rate and random.random() < error_rate:
+            stats["errors"] += 1
+            return web.json_response({"detail": "Bad Gateway"}, status=502)
+        in_flight += 1
+        try:
+            await asyncio.sleep(latency)
+            return await handler(request)
+        finally:
+            in_flight -= 1
+
+    async def admin_token(request):
+        stats["logins"] += 1
+        exp = int(time.time()) + (token_ttl or 86400)
+        token = _jwt(exp)
+        tokens[token] = exp
+        return web.json_response({"access_token": token, "token_type": "bearer"})
+
+    async def create_user(request):
+        data = await request.json()
+        username = data["username"]
+        if username in users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        users[username] = _user(username)
+        return web.json_response(users[username])
+
+    async def get_user(request):
+        user = users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def modify_user(request):
+        user = users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        data = await request.json()
+        user.update({key: value for key, value in data.items() if key in user})
+        return web.json_response(user)
+
+    async def list_users(request):
+        names = request.query.getall("username", [])
+        if names:
+            selected = [users[name] for name in names if name in users]
+        else:
+            selected = list(users.values())
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 0)) or len(selected)
+        return web.json_response({"users": selected[offset:offset + limit], "total": len(selected)})
+
+    async def system(request):
+        active = sum(user["status"] == "active" for user in users.values())
+        return web.json_response({
+            "total_user": len(users),
+            "users_active": active,
+            "incoming_bandwidth_speed": 0,
+            "outgoing_bandwidth_speed": 0,
+        })
+
+    app = web.Application(middlewares=[simulate_load])
+    app["users"] = users
+    app["stats"] = stats
+    app["tokens"] = tokens
+    app.router.add_post("/api/admin/token", admin_token)
+    app.router.add_post("/api/user", create_user)
+    app.router.add_get("/api/user/{username}", get_user)
+    app.router.add_put("/api/user/{username}", modify_user)
+    app.router.add_get("/api/users", list_users)
+    app.router.add_get("/api/system", system)
+    return app
+
+
+# Добавляет в фейковую панель count активных пользователей user_0 ... user_{count-1}
+def add_users(app, count):
+    for i in range(count):
+        app["users"][f"user_{i}"] = _user(f"user_{i}")
+
+
+async def start_fake(port, latency=0.0, capacity=0, error_rate=0.0, token_ttl=0):
+    app = create_app(latency, capacity, error_rate, token_ttl)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return app, runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Marzban")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--capacity", type=int, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--token-ttl", type=int, default=0)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(args.latency, args.capacity, args.error_rate, args.token_ttl),
+        host="127.0.0.1", port=args.port,
+    )
@@ -0,0 +1,50 @@
+# Локальный фейковый Telegram Bot API: принимает вызовы методов, которые делает бот,
+# и отвечает правдоподобными объектами с заданной задержкой.
+# Бот направляется сюда через Bot.server = TelegramAPIServer.from_base(...).
+
+import asyncio
+import itertools
+import time
+
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+
+def create_app(latency=0.0):
+    message_ids = itertools.count(1)
+    calls = {}
+
+    async def call_method(request):
+        method = request.match_info["method"]
+        calls[method] = calls.get(method, 0) + 1
+        data = dict(await request.post()) if request.can_read_body else {}
+        await asyncio.sleep(latency)
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            chat_id = int(data.get("chat_id", 0))
+            result = {
+                "message_id": int(data.get("message_id") or next(message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": data.get("text", ""),
+            }
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application()
+    app["calls"] = calls
+    app.router.add_post("/bot{token}/{method}", call_method)
+    return app
+
+
+async def start_fake(port, latency=0.0):
+    app = create_app(latency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return app, runner
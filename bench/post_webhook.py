@@ -0,0 +1,64 @@
+# Отправляет в вебхук бота уведомления YooKassa payment.succeeded для локальной проверки.
+# Обработчик перечитывает платеж из API, поэтому бот должен смотреть на заглушку YooKassa
+# (Yoo_Api_url_env=http://127.0.0.1:8081/v3), а платеж должен в ней существовать:
+# с --stub-url скрипт сам создаст оплаченный платеж для --user-id и --plan.
+#
+# Запуск:
+#   python -m bench.yookassa_stub --port 8081 --latency 0
+#   python -m bench.post_webhook --stub-url http://127.0.0.1:8081/v3 --user-id 123 --plan 1month --repeat 5
+#
+# --repeat отправляет одно и то же уведомление несколько раз одновременно:
+# подписка должна продлиться один раз, а ключ прийти одним сообщением.
+
+import argparse
+import asyncio
+import uuid
+
+import aiohttp
+
+
+async def create_stub_payment(session, stub_url, user_id, plan):
+    async with session.post(
+        f"{stub_url}/payments",
+        json={
+            "amount": {"value": "100.00", "currency": "RUB"},
+            "metadata": {"user_id": str(user_id), "plan": plan},
+        },
+        headers={"Idempotence-Key": str(uuid.uuid4())},
+        auth=aiohttp.BasicAuth("local", "local"),
+    ) as response:
+        return (await response.json())["id"]
+
+
+async def post_notification(session, url, payment_id):
+    notification = {
+        "type": "notification",
+        "event": "payment.succeeded",
+        "object": {"id": payment_id, "status": "succeeded", "paid": True},
+    }
+    async with session.post(url, json=notification) as response:
+        return response.status
+
+
+async def main(args):
+    async with aiohttp.ClientSession() as session:
+        payment_id = args.payment_id
+        if payment_id is None:
+            payment_id = await create_stub_payment(session, args.stub_url, args.user_id, args.plan)
+            print(f"Создан платеж {payment_id}")
+        statuses = await asyncio.gather(
+            *(post_notification(session, args.url, payment_id) for _ in range(args.repeat))
+        )
+        print(f"Ответы вебхука: {statuses}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка уведомлений YooKassa в вебхук бота")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/yookassa/webhook")
+    parser.add_argument("--payment-id")
+    parser.add_argument("--stub-url", default="http://127.0.0.1:8081/v3")
+    parser.add_argument("--user-id", type=int, default=1)
+    parser.add_argument("--plan", default="1month")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    asyncio.run(main(args))
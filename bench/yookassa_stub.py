@@ -0,0 +1,79 @@
+# Локальная заглушка API YooKassa (эндпоинты создания и получения платежа)
+# для нагрузочных замеров без обращения к настоящему API.
+#
+# Отдельный запуск:  python -m bench.yookassa_stub --port 8081 --latency 0.2
+# и Yoo_Api_url_env=http://127.0.0.1:8081/v3 в .env бота.
+
+import argparse
+import asyncio
+import time
+import uuid
+
+from aiohttp import web
+
+
+def create_app(latency=0.0, succeed_after=0.0):
+    # latency - искусственная задержка ответа (имитация HTTPS до API),
+    # succeed_after - через сколько секунд после создания платеж считается оплаченным
+    payments = {}
+    by_idempotence_key = {}
+
+    async def create_payment(request):
+        if request.headers.get("Authorization") is None:
+            return web.json_response({"type": "error", "code": "invalid_credentials"}, status=401)
+        await asyncio.sleep(latency)
+
+        key = request.headers.get("Idempotence-Key")
+        if key in by_idempotence_key:
+            return web.json_response(payments[by_idempotence_key[key]])
+
+        data = await request.json()
+        payment_id = str(uuid.uuid4())
+        payments[payment_id] = {
+            "id": payment_id,
+            "status": "pending",
+            "paid": False,
+            "amount": data["amount"],
+            "description": data.get("description"),
+            "metadata": data.get("metadata", {}),
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}",
+            },
+            "created_at": time.time(),
+        }
+        if key:
+            by_idempotence_key[key] = payment_id
+        return web.json_response(payments[payment_id])
+
+    async def find_payment(request):
+        await asyncio.sleep(latency)
+        payment = payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response({"type": "error", "code": "not_found"}, status=404)
+        if payment["status"] == "pending" and time.time() - payment["created_at"] >= succeed_after:
+            payment["status"] = "succeeded"
+            payment["paid"] = True
+        return web.json_response(payment)
+
+    app = web.Application()
+    app["payments"] = payments
+    app.router.add_post("/v3/payments", create_payment)
+    app.router.add_get("/v3/payments/{payment_id}", find_payment)
+    return app
+
+
+async def start_stub(port, latency=0.0, succeed_after=0.0):
+    runner = web.AppRunner(create_app(latency, succeed_after))
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API YooKassa")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--succeed-after", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency, args.succeed_after), host="127.0.0.1", port=args.port)
@@ -0,0 +1,54 @@
+import metrics
+
+import time
+from collections import OrderedDict
+
+# Признак промаха: None тоже может быть закэшированным значением
+MISSING = object()
+
+
+# LRU-кэш в памяти процесса с ограничением размера и временем жизни записей.
+# Не потокобезопасен - рассчитан на один event loop.
+class TTLCache:
+
+    def __init__(self, name, max_size, ttl):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Растет при каждой инвалидации. Read-through кладет прочитанное из БД значение,
+        # только если за время чтения ничего не инвалидировали, иначе оно может быть устаревшим.
+        self.generation = 0
+        # key -> (время истечения, значение); порядок - от давно использованных к недавним
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                metrics.CACHE_REQUESTS.inc(self.name, "hit")
+                return entry[1]
+            del self._data[key]
+        self.misses += 1
+        metrics.CACHE_REQUESTS.inc(self.name, "miss")
+        return MISSING
+
+    def set(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
@@ -0,0 +1,101 @@
+import plans
+
+from functools import lru_cache
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# callback_data кнопок: "<версия>:<действие>[:<код тарифа>]", например "v1:b:1month".
+# Версия нужна, чтобы формат можно было поменять, не ломая кнопки в уже отправленных сообщениях:
+# старые форматы разбираются в _parse_legacy.
+CALLBACK_VERSION = 'v1'
+
+ACTION_BUY = 'b'     # выбор тарифа - создать платеж
+ACTION_CHECK = 'c'   # проверить оплату
+ACTION_BACK = 'bk'   # назад к выбору тарифа
+
+# Сколько разных callback_data помнить разобранными
+PARSE_CACHE_SIZE = 1024
+
+
+def pack(action, plan_code=None) -> str:
+    if plan_code is None:
+        return f"{CALLBACK_VERSION}:{action}"
+    return f"{CALLBACK_VERSION}:{action}:{plan_code}"
+
+
+# Кнопки, отправленные до появления версии: "1month", "check_payment_1 месяц", "back_to_duration_selection"
+def _parse_legacy(data):
+    if data == 'back_to_duration_selection':
+        return ACTION_BACK, None
+    if data in plans.PLANS:
+        plan = plans.PLANS[data]
+        return (ACTION_BUY, plan) if plan.active else None
+    if data.startswith('check_payment_'):
+        duration = data[len('check_payment_'):]
+        for plan in plans.PLANS.values():
+            if duration in (plan.code, plan.title):
+                return ACTION_CHECK, plan
+        return ACTION_CHECK, None
+    return None
+
+
+# (действие, Plan или None) или None для чужих данных. Одинаковые callback_data приходят
+# постоянно (у всех пользователей одни и те же кнопки), поэтому результат кэшируется.
+@lru_cache(maxsize=PARSE_CACHE_SIZE)
+def parse(data):
+    if not data:
+        return None
+    version, _, rest = data.partition(':')
+    if version != CALLBACK_VERSION:
+        return _parse_legacy(data)
+    action, _, plan_code = rest.partition(':')
+    if not plan_code:
+        return action, None
+    plan = plans.get(plan_code)
+    if action == ACTION_BUY and (plan is None or not plan.active):
+        # Тариф снят с продажи или удален из конфигурации - покупать нечего
+        return None
+    # Для проверки оплаты тариф не обязателен: он записан в самом платеже
+    return action, plan
+
+
+# Фильтр обработчика callback_query по действию. Разбор callback_data берется из кэша,
+# поэтому проверка каждого обработчика - это поиск в словаре, а не цепочка сравнений строк.
+# Обработчик получает тариф из кнопки аргументом plan.
+def action_filter(action):
+    def check(callback_query):
+        parsed = parse(callback_query.data)
+        if parsed is None or parsed[0] != action:
+            return False
+        return {'plan': parsed[1]}
+    return check
+
+
+# Клавиатуры собираются один раз и хранятся готовым JSON: при каждом показе меню
+# не создаются объекты кнопок и не сериализуется разметка
+
+@lru_cache(maxsize=None)
+def plans_keyboard() -> str:
+    inline_kb = InlineKeyboardMarkup(row_width=1)
+    for plan in plans.active():
+        inline_kb.add(InlineKeyboardButton(f"VPN на {plan.title} - {plan.price} руб", callback_data=pack(ACTION_BUY, plan.code)))
+    return inline_kb.as_json()
+
+
+# Продление в одно нажатие из напоминания: те же кнопки, что и при покупке из меню
+@lru_cache(maxsize=None)
+def renew_keyboard() -> str:
+    inline_kb = InlineKeyboardMarkup(row_width=1)
+    for plan in plans.active():
+        inline_kb.add(InlineKeyboardButton(f"Продлить на {plan.title}", callback_data=pack(ACTION_BUY, plan.code)))
+    return inline_kb.as_json()
+
+
+# Ссылка на оплату своя у каждого платежа, поэтому эта клавиатура собирается при каждом вызове
+def payment_keyboard(plan, payment_url) -> InlineKeyboardMarkup:
+    inline_kb = InlineKeyboardMarkup(row_width=1)
+    inline_kb.add(
+        InlineKeyboardButton(f"Оплатить {plan.title} - {plan.price} руб", url=payment_url),
+        InlineKeyboardButton(f"Проверить оплату за {plan.title}", callback_data=pack(ACTION_CHECK, plan.code)),
+        InlineKeyboardButton("Назад", callback_data=pack(ACTION_BACK)),
+    )
+    return inline_kb
@@ -1,14 +1,527 @@
-import sqlite3 as sq
-
-db = sq.connect('tg.db')
-cur = db.cursor()
-
-async def db_start():
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS accounts (
-            user_id INTEGER PRIMARY KEY,
-            payment_id TEXT,
-            end_date TEXT,
-            access_key TEXT
-        )
-    ''')
\ No newline at end of file
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import metrics
+import migrations
+
+DB_PATH = 'tg.db'
+
+# apply_payment: ключ в БД изменился после того, как его прочитал вызывающий
+KEY_CHANGED = object()
+
+# Количество читающих соединений в пуле (запись идет через одно отдельное соединение)
+POOL_SIZE = 4
+
+# Настройки, которые применяются к каждому соединению при открытии
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA busy_timeout = 5000',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -8000',
+)
+
+# Запросы бота. Текст запроса неизменен, поэтому sqlite3 берет уже
+# подготовленный statement из кэша соединения, а не разбирает SQL заново.
+SQL_ADD_USER = 'INSERT OR IGNORE INTO accounts (user_id) VALUES (?)'
+SQL_GET_SUBSCRIPTION = '''
+    SELECT a.end_ts, a.access_key, u.used_traffic, u.data_limit FROM accounts a
+    LEFT JOIN usage u ON u.user_id = a.user_id
+    WHERE a.user_id = ?
+'''
+SQL_GET_PAYMENT_ID = 'SELECT payment_id FROM accounts WHERE user_id = ?'
+SQL_SET_PAYMENT_ID = '''
+    INSERT INTO accounts (user_id, payment_id) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET payment_id = excluded.payment_id
+'''
+# Сохраняет срок окончания и ключ, не затирая payment_id
+SQL_SAVE_SUBSCRIPTION = '''
+    INSERT INTO accounts (user_id, end_ts, access_key) VALUES (?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET end_ts = excluded.end_ts, access_key = excluded.access_key
+'''
+# Условие на end_ts: платеж, примененный после выборки истекших, не должен потеряться
+SQL_EXPIRE_USER = 'UPDATE accounts SET access_key = NULL, end_ts = NULL WHERE user_id = ? AND end_ts <= ?'
+SQL_GET_EXPIRED_KEY = 'SELECT access_key FROM accounts WHERE user_id = ? AND end_ts <= ?'
+# Истекшие подписки по индексу idx_accounts_end_ts, страницами по (end_ts, user_id)
+SQL_DUE_SUBSCRIPTIONS = '''
+    SELECT user_id, end_ts, node_id FROM accounts
+    WHERE end_ts <= ? AND (end_ts, user_id) > (?, ?)
+    ORDER BY end_ts, user_id
+    LIMIT ?
+'''
+SQL_GET_NODE_ID = 'SELECT node_id FROM accounts WHERE user_id = ?'
+SQL_SET_NODE_ID = '''
+    INSERT INTO accounts (user_id, node_id) VALUES (?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET node_id = excluded.node_id
+'''
+# Обновляет строку, только если что-то изменилось: у неизменившихся пользователей записи нет
+SQL_SAVE_USAGE = '''
+    INSERT INTO usage (user_id, node_id, status, used_traffic, lifetime_used_traffic, data_limit, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        node_id = excluded.node_id, status = excluded.status, used_traffic = excluded.used_traffic,
+        lifetime_used_traffic = excluded.lifetime_used_traffic, data_limit = excluded.data_limit,
+        updated_at = excluded.updated_at
+    WHERE usage.status IS NOT excluded.status
+        OR usage.used_traffic IS NOT excluded.used_traffic
+        OR usage.lifetime_used_traffic IS NOT excluded.lifetime_used_traffic
+        OR usage.data_limit IS NOT excluded.data_limit
+        OR usage.node_id IS NOT excluded.node_id
+'''
+# Подписки, истекающие в (after, until], которым напоминание kind для этого срока еще не отправлено.
+# Диапазон по индексу idx_accounts_end_ts, страницами по (end_ts, user_id).
+SQL_DUE_REMINDERS = '''
+    SELECT a.user_id, a.end_ts FROM accounts a
+    WHERE a.end_ts > ? AND a.end_ts <= ? AND (a.end_ts, a.user_id) > (?, ?)
+        AND NOT EXISTS (
+            SELECT 1 FROM sent_reminders r
+            WHERE r.user_id = a.user_id AND r.end_ts = a.end_ts AND r.kind = ?
+        )
+    ORDER BY a.end_ts, a.user_id
+    LIMIT ?
+'''
+SQL_MARK_REMINDER_SENT = 'INSERT OR IGNORE INTO sent_reminders (user_id, end_ts, kind, sent_at) VALUES (?, ?, ?, ?)'
+SQL_DELETE_OLD_REMINDERS = 'DELETE FROM sent_reminders WHERE end_ts < ?'
+SQL_GET_QR_FILE_ID = 'SELECT file_id FROM qr_file_ids WHERE key_hash = ?'
+SQL_SET_QR_FILE_ID = 'INSERT OR REPLACE INTO qr_file_ids (key_hash, file_id, created_at) VALUES (?, ?, ?)'
+SQL_DELETE_QR_FILE_ID = 'DELETE FROM qr_file_ids WHERE key_hash = ?'
+SQL_NEXT_EXPIRY = 'SELECT MIN(end_ts) FROM accounts WHERE end_ts > ?'
+SQL_MARK_PAYMENT_APPLIED = 'INSERT OR IGNORE INTO applied_payments (payment_id, user_id, applied_at) VALUES (?, ?, ?)'
+SQL_IS_PAYMENT_APPLIED = 'SELECT 1 FROM applied_payments WHERE payment_id = ?'
+SQL_GET_END_TS_AND_KEY = 'SELECT end_ts, access_key FROM accounts WHERE user_id = ?'
+SQL_ADD_PAYMENT = '''
+    INSERT INTO payments (payment_id, user_id, plan, amount, status, created_at, next_check_at)
+    VALUES (?, ?, ?, ?, 'pending', ?, ?)
+'''
+SQL_GET_LAST_PAYMENT = '''
+    SELECT payment_id, plan, status FROM payments
+    WHERE user_id = ?
+    ORDER BY created_at DESC
+    LIMIT 1
+'''
+SQL_SET_PAYMENT_STATUS = 'UPDATE payments SET status = ? WHERE payment_id = ?'
+# Ожидающие платежи, которые пора проверить, по частичному индексу idx_payments_pending
+SQL_DUE_PAYMENTS = '''
+    SELECT payment_id, user_id, plan, attempts FROM payments
+    WHERE status = 'pending' AND next_check_at <= ?
+    ORDER BY next_check_at
+    LIMIT ?
+'''
+SQL_RESCHEDULE_PAYMENT = '''
+    UPDATE payments SET attempts = attempts + 1, next_check_at = ?
+    WHERE payment_id = ? AND status = 'pending'
+'''
+# Захват или продление блокировки: получится, если она свободна, истекла или уже наша
+SQL_ACQUIRE_LOCK = '''
+    INSERT INTO locks (name, owner, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+    WHERE locks.owner = excluded.owner OR locks.expires_at < ?
+'''
+SQL_RELEASE_LOCK = 'DELETE FROM locks WHERE name = ? AND owner = ?'
+SQL_EXPIRE_PAYMENTS = "UPDATE payments SET status = 'expired' WHERE status = 'pending' AND created_at < ?"
+SQL_ADD_OUTBOX_MESSAGE = '''
+    INSERT INTO outbox (chat_id, text, parse_mode, reply_markup, created_at) VALUES (?, ?, ?, ?, ?)
+'''
+SQL_GET_OUTBOX_MESSAGES = '''
+    SELECT id, chat_id, text, parse_mode, reply_markup FROM outbox
+    WHERE id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+SQL_DELETE_OUTBOX_MESSAGE = 'DELETE FROM outbox WHERE id = ?'
+SQL_ADD_BROADCAST = 'INSERT INTO broadcasts (text, parse_mode, reply_markup, created_at) VALUES (?, ?, ?, ?)'
+SQL_ACTIVE_BROADCASTS = '''
+    SELECT id, text, parse_mode, reply_markup, last_user_id FROM broadcasts
+    WHERE done = 0
+    ORDER BY id
+'''
+SQL_ADVANCE_BROADCAST = 'UPDATE broadcasts SET last_user_id = ?, done = ? WHERE id = ?'
+# Получатели рассылки страницами по первичному ключу, без загрузки всей таблицы в память
+SQL_RECIPIENTS = 'SELECT user_id FROM accounts WHERE user_id > ? ORDER BY user_id LIMIT ?'
+# Статистика для администраторов (admin.py). Активные и истекающие подписки считаются по диапазону
+# idx_accounts_end_ts, выручка - по idx_payments_status_plan без чтения таблицы. COUNT(*) по accounts
+# проходит самый узкий индекс целиком, трафик - всю таблицу usage: обе по строке на пользователя,
+# а результат кэшируется (admin.STATS_TTL).
+SQL_COUNT_USERS = 'SELECT COUNT(*) FROM accounts'
+SQL_SUBSCRIPTION_STATS = '''
+    SELECT COUNT(*), COALESCE(SUM(end_ts <= ?), 0) FROM accounts WHERE end_ts > ?
+'''
+SQL_REVENUE_BY_PLAN = '''
+    SELECT plan, COUNT(*), SUM(amount), SUM(created_at >= ?), SUM(CASE WHEN created_at >= ? THEN amount ELSE 0 END)
+    FROM payments WHERE status = 'succeeded' GROUP BY plan
+'''
+SQL_USAGE_STATS = 'SELECT COUNT(*), COALESCE(SUM(used_traffic), 0) FROM usage WHERE used_traffic > 0'
+# Страницы выгрузки по первичному ключу (keyset): каждая страница - поиск по индексу, а не OFFSET.
+# Ключи доступа в выгрузку не попадают.
+SQL_EXPORT_ACCOUNTS = '''
+    SELECT a.user_id, a.end_ts, a.node_id, u.status, u.used_traffic, u.lifetime_used_traffic, u.data_limit
+    FROM accounts a LEFT JOIN usage u ON u.user_id = a.user_id
+    WHERE a.user_id > ? ORDER BY a.user_id LIMIT ?
+'''
+SQL_EXPORT_PAYMENTS = '''
+    SELECT rowid, payment_id, user_id, plan, amount, status, created_at
+    FROM payments WHERE rowid > ? ORDER BY rowid LIMIT ?
+'''
+
+_readers = None
+_writer = None
+_write_lock = None
+
+
+async def _connect():
+    # isolation_level=None: одиночные запросы коммитятся сразу,
+    # а многошаговые транзакции открываются явно через transaction()
+    conn = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=64)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+async def db_start():
+    global _readers, _writer, _write_lock
+
+    _writer = await _connect()
+    _write_lock = asyncio.Lock()
+    # Схема создается и обновляется версионированными миграциями (migrations.py)
+    await migrations.migrate(_writer)
+
+    _readers = asyncio.Queue()
+    for _ in range(POOL_SIZE):
+        _readers.put_nowait(await _connect())
+
+
+async def db_close():
+    global _readers, _writer
+
+    if _readers is not None:
+        while not _readers.empty():
+            conn = _readers.get_nowait()
+            await conn.close()
+        _readers = None
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+
+@asynccontextmanager
+async def acquire():
+    # Берем свободное читающее соединение из пула и возвращаем его обратно
+    conn = await _readers.get()
+    try:
+        yield conn
+    finally:
+        _readers.put_nowait(conn)
+
+
+@asynccontextmanager
+async def transaction():
+    # Все записи идут через одно соединение, поэтому транзакции сериализуются блокировкой
+    async with _write_lock:
+        await _writer.execute('BEGIN IMMEDIATE')
+        try:
+            yield _writer
+        except BaseException:
+            await _writer.execute('ROLLBACK')
+            raise
+        else:
+            await _writer.execute('COMMIT')
+
+
+async def _fetchone(sql, params=()):
+    async with acquire() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchone()
+
+
+async def _fetchall(sql, params=()):
+    async with acquire() as conn:
+        async with conn.execute(sql, params) as cursor:
+            return await cursor.fetchall()
+
+
+async def _write(sql, params=()):
+    async with _write_lock:
+        await _writer.execute(sql, params)
+
+
+# Добавляет пользователя, если его еще нет (один запрос вместо SELECT + INSERT)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def add_user(user_id):
+    await _write(SQL_ADD_USER, (user_id,))
+
+
+# Возвращает (end_ts, access_key, used_traffic, data_limit) или None; трафик - None, если еще не синхронизирован
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_subscription(user_id):
+    return await _fetchone(SQL_GET_SUBSCRIPTION, (user_id,))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_payment_id(user_id):
+    row = await _fetchone(SQL_GET_PAYMENT_ID, (user_id,))
+    return row[0] if row else None
+
+
+# Записывает новый платеж в историю и делает его текущим платежом пользователя
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def add_payment(payment_id, user_id, plan, amount, now, first_check_at):
+    async with transaction() as conn:
+        await conn.execute(SQL_ADD_PAYMENT, (payment_id, user_id, plan, amount, now, first_check_at))
+        await conn.execute(SQL_SET_PAYMENT_ID, (user_id, payment_id))
+
+
+# Последний платеж пользователя: (payment_id, plan, status) или None
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_last_payment(user_id):
+    return await _fetchone(SQL_GET_LAST_PAYMENT, (user_id,))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def set_payment_status(payment_id, status):
+    await _write(SQL_SET_PAYMENT_STATUS, (status, payment_id))
+
+
+# До limit ожидающих платежей, срок проверки которых наступил: (payment_id, user_id, plan, attempts)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_due_payments(now, limit):
+    return await _fetchall(SQL_DUE_PAYMENTS, (now, limit))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def reschedule_payment(payment_id, next_check_at):
+    await _write(SQL_RESCHEDULE_PAYMENT, (next_check_at, payment_id))
+
+
+# Помечает брошенными ожидающие платежи, созданные раньше created_before. Возвращает их число.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def expire_payments(created_before):
+    async with _write_lock:
+        cursor = await _writer.execute(SQL_EXPIRE_PAYMENTS, (created_before,))
+        return cursor.rowcount
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def is_payment_applied(payment_id):
+    return await _fetchone(SQL_IS_PAYMENT_APPLIED, (payment_id,)) is not None
+
+
+# Продлевает подписку на days дней по платежу payment_id в одной транзакции.
+# Новый срок считается от текущего end_ts (если он еще не прошел) или от now.
+# read_key - ключ, который вызывающий прочитал до выдачи access_key (None, если ключа не было).
+# Возвращает новый end_ts, None, если этот платеж уже был применен, или KEY_CHANGED, если ключ
+# в БД с тех пор изменился (например, проверка истекших сняла подписку и отключила пользователя
+# в Marzban): тогда платеж не применяется, а ключ нужно выдать заново.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def apply_payment(payment_id, user_id, days, access_key, read_key, now):
+    async with transaction() as conn:
+        async with conn.execute(SQL_IS_PAYMENT_APPLIED, (payment_id,)) as cursor:
+            if await cursor.fetchone() is not None:
+                return None
+        async with conn.execute(SQL_GET_END_TS_AND_KEY, (user_id,)) as cursor:
+            row = await cursor.fetchone()
+        if (row[1] if row else None) != read_key:
+            return KEY_CHANGED
+        await conn.execute(SQL_MARK_PAYMENT_APPLIED, (payment_id, user_id, now))
+        end_ts = max(row[0] or 0, now) if row else now
+        end_ts += days * 86400
+        await conn.execute(SQL_SAVE_SUBSCRIPTION, (user_id, end_ts, access_key))
+        await conn.execute(SQL_SET_PAYMENT_STATUS, ('succeeded', payment_id))
+        return end_ts
+
+
+# Возвращает до limit строк (user_id, end_ts, node_id) с end_ts <= now, идущих после (after_ts, after_user_id)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_due_subscriptions(now, after_ts, after_user_id, limit):
+    return await _fetchall(SQL_DUE_SUBSCRIPTIONS, (now, after_ts, after_user_id, limit))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_node_id(user_id):
+    row = await _fetchone(SQL_GET_NODE_ID, (user_id,))
+    return row[0] if row else None
+
+
+# Запоминает узел Marzban, на котором создан пользователь
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def set_node_id(user_id, node_id):
+    await _write(SQL_SET_NODE_ID, (user_id, node_id))
+
+
+# Сохраняет страницу трафика из Marzban одной транзакцией.
+# rows - кортежи (user_id, node_id, status, used_traffic, lifetime_used_traffic, data_limit).
+# Возвращает число действительно измененных строк.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def save_usage(rows, now):
+    async with transaction() as conn:
+        cursor = await conn.executemany(SQL_SAVE_USAGE, [row + (now,) for row in rows])
+        return cursor.rowcount
+
+
+# Ближайший срок окончания после now или None, если активных подписок нет
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def next_expiry_ts(now):
+    row = await _fetchone(SQL_NEXT_EXPIRY, (now,))
+    return row[0] if row else None
+
+
+# Снимает подписку сразу у пачки пользователей одной транзакцией, если срок все еще не позже now.
+# Возвращает пары (user_id, снятый ключ доступа) для тех, у кого подписка снята;
+# остальные успели продлить ее после выборки.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def expire_users(user_ids, now):
+    expired = []
+    async with transaction() as conn:
+        for user_id in user_ids:
+            async with conn.execute(SQL_GET_EXPIRED_KEY, (user_id, now)) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                continue
+            await conn.execute(SQL_EXPIRE_USER, (user_id, now))
+            expired.append((user_id, row[0]))
+    return expired
+
+
+# Пытается захватить (или продлить свою) блокировку name до now + ttl. Возвращает True при успехе.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def acquire_lock(name, owner, ttl, now):
+    async with _write_lock:
+        cursor = await _writer.execute(SQL_ACQUIRE_LOCK, (name, owner, now + ttl, now))
+        return cursor.rowcount == 1
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def release_lock(name, owner):
+    await _write(SQL_RELEASE_LOCK, (name, owner))
+
+
+# Ставит сообщения в постоянную очередь outbox одной транзакцией.
+# messages - пары (chat_id, text) с общими parse_mode и reply_markup (JSON-строка или None).
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def add_outbox_messages(messages, parse_mode, reply_markup, now):
+    async with transaction() as conn:
+        await conn.executemany(
+            SQL_ADD_OUTBOX_MESSAGE,
+            [(chat_id, text, parse_mode, reply_markup, now) for chat_id, text in messages]
+        )
+
+
+# До limit сообщений outbox с id больше after_id: (id, chat_id, text, parse_mode, reply_markup)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_outbox_messages(after_id, limit):
+    return await _fetchall(SQL_GET_OUTBOX_MESSAGES, (after_id, limit))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def delete_outbox_message(message_id):
+    await _write(SQL_DELETE_OUTBOX_MESSAGE, (message_id,))
+
+
+# Создает рассылку и возвращает ее id
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def add_broadcast(text, parse_mode, reply_markup, now):
+    async with _write_lock:
+        cursor = await _writer.execute(SQL_ADD_BROADCAST, (text, parse_mode, reply_markup, now))
+        return cursor.lastrowid
+
+
+# Незавершенные рассылки: (id, text, parse_mode, reply_markup, last_user_id)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_active_broadcasts():
+    return await _fetchall(SQL_ACTIVE_BROADCASTS)
+
+
+# До limit id пользователей после after_user_id по возрастанию
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_recipients(after_user_id, limit):
+    rows = await _fetchall(SQL_RECIPIENTS, (after_user_id, limit))
+    return [row[0] for row in rows]
+
+
+# Ставит в outbox страницу рассылки и сдвигает ее курсор в одной транзакции,
+# чтобы после перезапуска страница не была поставлена повторно или пропущена
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def enqueue_broadcast_page(broadcast, user_ids, done, now):
+    broadcast_id, text, parse_mode, reply_markup, last_user_id = broadcast
+    async with transaction() as conn:
+        await conn.executemany(
+            SQL_ADD_OUTBOX_MESSAGE,
+            [(user_id, text, parse_mode, reply_markup, now) for user_id in user_ids]
+        )
+        last_user_id = user_ids[-1] if user_ids else last_user_id
+        await conn.execute(SQL_ADVANCE_BROADCAST, (last_user_id, int(done), broadcast_id))
+
+
+# До limit пар (user_id, end_ts) для напоминания kind: срок в (after, until], после курсора (after_ts, after_user_id)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_due_reminders(kind, after, until, after_ts, after_user_id, limit):
+    return await _fetchall(SQL_DUE_REMINDERS, (after, until, after_ts, after_user_id, kind, limit))
+
+
+# Записывает напоминания как отправленные и ставит их в outbox в одной транзакции,
+# поэтому каждое напоминание уходит ровно один раз, даже если два прохода пересеклись.
+# reminders - кортежи (user_id, end_ts, text). Возвращает число поставленных в очередь.
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def add_reminders(kind, reminders, parse_mode, reply_markup, now):
+    queued = 0
+    async with transaction() as conn:
+        for user_id, end_ts, text in reminders:
+            cursor = await conn.execute(SQL_MARK_REMINDER_SENT, (user_id, end_ts, kind, now))
+            if cursor.rowcount:
+                await conn.execute(SQL_ADD_OUTBOX_MESSAGE, (user_id, text, parse_mode, reply_markup, now))
+                queued += 1
+    return queued
+
+
+# Удаляет записи о напоминаниях для сроков, истекших раньше before
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def delete_old_reminders(before):
+    await _write(SQL_DELETE_OLD_REMINDERS, (before,))
+
+
+# file_id загруженной в Telegram картинки с QR-кодом ключа или None
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_qr_file_id(key_hash):
+    row = await _fetchone(SQL_GET_QR_FILE_ID, (key_hash,))
+    return row[0] if row else None
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def set_qr_file_id(key_hash, file_id, now):
+    await _write(SQL_SET_QR_FILE_ID, (key_hash, file_id, now))
+
+
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def delete_qr_file_ids(key_hashes):
+    async with transaction() as conn:
+        await conn.executemany(SQL_DELETE_QR_FILE_ID, [(key_hash,) for key_hash in key_hashes])
+
+
+# Сводка для администраторов: (всего пользователей, активных подписок, истекает до expiring_until,
+# строки (plan, платежей, сумма, платежей после since, сумма после since), (пользователей с трафиком, трафик))
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def get_stats(now, expiring_until, since):
+    async with acquire() as conn:
+        async with conn.execute(SQL_COUNT_USERS) as cursor:
+            users, = await cursor.fetchone()
+        async with conn.execute(SQL_SUBSCRIPTION_STATS, (expiring_until, now)) as cursor:
+            active, expiring = await cursor.fetchone()
+        async with conn.execute(SQL_REVENUE_BY_PLAN, (since, since)) as cursor:
+            revenue = await cursor.fetchall()
+        async with conn.execute(SQL_USAGE_STATS) as cursor:
+            usage = await cursor.fetchone()
+    return users, active, expiring, revenue, usage
+
+
+# Страница выгрузки accounts после after_user_id:
+# (user_id, end_ts, node_id, status, used_traffic, lifetime_used_traffic, data_limit)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def export_accounts_page(after_user_id, limit):
+    return await _fetchall(SQL_EXPORT_ACCOUNTS, (after_user_id, limit))
+
+
+# Страница выгрузки payments после after_rowid: (rowid, payment_id, user_id, plan, amount, status, created_at)
+@metrics.timed(metrics.SQLITE_QUERY_SECONDS)
+async def export_payments_page(after_rowid, limit):
+    return await _fetchall(SQL_EXPORT_PAYMENTS, (after_rowid, limit))
@@ -1,38 +1,82 @@
-from dotenv import load_dotenv
-import os
-
-load_dotenv()
-
-TOKEN = os.getenv('TOKEN_bot')
-
-Yoo_Api_id = os.getenv('Yoo_Api_id_env')
-Yoo_Api_key = os.getenv('Yoo_Api_key_env')
-
-PROVIDER_TOKEN = os.getenv('PROVIDER_TOKEN_env')
-
-Auth_name = os.getenv('Auth_name_env')
-Auth_password = os.getenv('Auth_password_env')
-Marzban_url = os.getenv('Marzban_url_env')
-
-
-from marzban_api_client import Client
-from marzban_api_client.api.admin import admin_token
-from marzban_api_client.models.body_admin_token_api_admin_token_post import (
-     BodyAdminTokenApiAdminTokenPost,
-)
-from marzban_api_client.models.token import Token
-from marzban_api_client.types import Response
-
-login_data = BodyAdminTokenApiAdminTokenPost(
-     username= Auth_name,
-     password= Auth_password,
- )
-
-client = Client(base_url=Marzban_url)
-
-with client as client:
-     token: Token = admin_token.sync(
-         client=client,
-         body=login_data,
-     )
-     Marzban_Api_Token = token.access_token
+from dotenv import load_dotenv
+import hashlib
+import json
+import os
+
+load_dotenv()
+
+TOKEN = os.getenv('TOKEN_bot')
+
+# Режим работы: polling (один процесс) или webhook (aiohttp-сервер, можно несколько воркеров)
+Bot_mode = os.getenv('Bot_mode_env', 'polling')
+# Публичный адрес, на который Telegram будет присылать обновления, например https://bot.example.com
+Bot_webhook_host = os.getenv('Bot_webhook_host_env')
+Bot_webhook_path = os.getenv('Bot_webhook_path_env', '/telegram/webhook')
+# Секрет, который Telegram присылает в заголовке каждого обновления (A-Z, a-z, 0-9, _ и -).
+# Если не задан, выводится из токена бота: так он одинаковый во всех воркерах и не меняется между запусками.
+Bot_webhook_secret = os.getenv('Bot_webhook_secret_env') or (
+    hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest() if TOKEN else None
+)
+Bot_webapp_host = os.getenv('Bot_webapp_host_env', '0.0.0.0')
+Bot_webapp_port = int(os.getenv('Bot_webapp_port_env', '8080'))
+# Сколько процессов запускать в режиме webhook (все слушают один порт через SO_REUSEPORT)
+Bot_workers = int(os.getenv('Bot_workers_env', '1'))
+
+Yoo_Api_id = os.getenv('Yoo_Api_id_env')
+Yoo_Api_key = os.getenv('Yoo_Api_key_env')
+Yoo_Api_url = os.getenv('Yoo_Api_url_env', 'https://api.yookassa.ru/v3')
+# Сколько одновременных HTTPS-соединений держим открытыми к YooKassa
+Yoo_Api_connections = int(os.getenv('Yoo_Api_connections_env', '20'))
+# Прием уведомлений YooKassa (payment.succeeded). Если порт не задан, сервер не запускается.
+Yoo_Webhook_host = os.getenv('Yoo_Webhook_host_env', '0.0.0.0')
+Yoo_Webhook_port = int(os.getenv('Yoo_Webhook_port_env', '0')) or None
+Yoo_Webhook_path = os.getenv('Yoo_Webhook_path_env', '/yookassa/webhook')
+
+PROVIDER_TOKEN = os.getenv('PROVIDER_TOKEN_env')
+
+# Telegram id администраторов через запятую: им доступны команды /stats и /export (admin.py)
+Admin_ids = {int(admin_id) for admin_id in os.getenv('Admin_ids_env', '').split(',') if admin_id.strip()}
+
+# Тарифы - JSON-список, например
+# [{"code": "1month", "title": "1 месяц", "days": 30, "price": 100}, {"code": "12month", "title": "12 месяцев", "days": 365, "price": 800}]
+# Если список не задан, используются тарифы по умолчанию из plans.py
+Plans = json.loads(os.getenv('Plans_env') or '[]')
+
+Auth_name = os.getenv('Auth_name_env')
+Auth_password = os.getenv('Auth_password_env')
+Marzban_url = os.getenv('Marzban_url_env')
+# Сколько запросов к Marzban выполнять одновременно при пакетных операциях
+Marzban_concurrency = int(os.getenv('Marzban_concurrency_env', '16'))
+# Размер пула соединений к каждой панели и общий таймаут одного запроса, в секундах
+Marzban_connections = int(os.getenv('Marzban_connections_env', '32'))
+Marzban_timeout = float(os.getenv('Marzban_timeout_env', '15'))
+
+# За сколько секунд до истечения JWT Marzban получать новый токен
+Marzban_token_margin = int(os.getenv('Marzban_token_margin_env', '300'))
+
+# Несколько панелей Marzban - JSON-список узлов, например
+# [{"id": "de1", "url": "https://de1.example.com", "username": "admin", "password": "...", "inbound": "Shadowsocks TCP", "weight": 2}]
+# username, password и inbound можно не указывать - берутся значения выше. Первый узел обслуживает
+# пользователей, у которых узел еще не записан. Если список не задан, используется одна панель Marzban_url.
+Marzban_nodes = json.loads(os.getenv('Marzban_nodes_env') or '[]')
+# Как часто опрашивать нагрузку и доступность панелей, в секундах
+Marzban_health_interval = int(os.getenv('Marzban_health_interval_env', '30'))
+
+# Логи (logs.py): уровень и формат вывода - json (по строке JSON на запись) или text
+Log_level = os.getenv('Log_level_env', 'INFO').upper()
+Log_format = os.getenv('Log_format_env', 'json')
+
+# Локальный HTTP-эндпоинт /metrics в формате Prometheus. Если порт не задан, сервер не запускается.
+# При нескольких воркерах каждый слушает свой порт: Metrics_port + номер воркера.
+Metrics_host = os.getenv('Metrics_host_env', '127.0.0.1')
+Metrics_port = int(os.getenv('Metrics_port_env', '0')) or None
+
+# Ограничения исходящих сообщений (outbox.py): Telegram допускает около 30 сообщений в секунду
+# на бота и около одного в секунду в один чат. При нескольких воркерах лимит действует в каждом процессе.
+Telegram_rate = float(os.getenv('Telegram_rate_env', '30'))
+Telegram_chat_rate = float(os.getenv('Telegram_chat_rate_env', '1'))
+
+# QR-коды ключей (qr.py, нужен пакет qrcode[png]): каталог кэша картинок на диске
+# и число процессов, в которых они рисуются
+Qr_cache_dir = os.getenv('Qr_cache_dir_env', 'qr_cache')
+Qr_workers = int(os.getenv('Qr_workers_env', '1'))
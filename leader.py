@@ -0,0 +1,72 @@
+import database
+
+import asyncio
+import logging
+import os
+import socket
+import time
+
+# Блокировка живет LOCK_TTL секунд и продлевается каждые RENEW_INTERVAL секунд.
+# Если ведущий процесс упал, другой воркер подхватит задачу не позже чем через LOCK_TTL.
+LOCK_TTL = 60
+RENEW_INTERVAL = 20
+
+_held = set()
+
+
+# Владелец блокировки - конкретный процесс на конкретной машине
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Запускает фоновую задачу job() только в одном из воркеров - в том, который держит блокировку name.
+# Если блокировку перехватил другой процесс (например, этот надолго завис), задача здесь останавливается.
+# Упавшая или завершившаяся задача перезапускается на следующем продлении, пока блокировка у этого процесса.
+async def run_as_leader(name, job):
+    owner = _owner()
+    task = None
+    try:
+        while True:
+            try:
+                is_leader = await database.acquire_lock(name, owner, LOCK_TTL, int(time.time()))
+            except Exception as e:
+                logging.error("Не удалось продлить блокировку %s: %s", name, e)
+                is_leader = False
+
+            # Задача завершилась сама (упала или вышла из цикла) - перезапускаем ее, пока блокировка наша.
+            # Перезапуск не чаще раза в RENEW_INTERVAL, поэтому постоянно падающая задача не крутится в цикле.
+            if task is not None and task.done():
+                if task.cancelled():
+                    logging.error("Задача %s была отменена, перезапускаем", name)
+                elif task.exception() is not None:
+                    logging.error("Задача %s упала, перезапускаем", name, exc_info=task.exception())
+                else:
+                    logging.error("Задача %s неожиданно завершилась, перезапускаем", name)
+                task = None
+                if is_leader:
+                    task = asyncio.create_task(job())
+                else:
+                    _held.discard(name)
+
+            if is_leader and task is None:
+                logging.info("Процесс %s стал ведущим для %s", owner, name)
+                _held.add(name)
+                task = asyncio.create_task(job())
+            elif not is_leader and task is not None:
+                logging.warning("Процесс %s больше не ведущий для %s, задача остановлена", owner, name)
+                _held.discard(name)
+                task.cancel()
+                task = None
+
+            await asyncio.sleep(RENEW_INTERVAL)
+    finally:
+        if task is not None:
+            task.cancel()
+
+
+# Освобождает блокировки при остановке, чтобы другой воркер не ждал их истечения
+async def release_all():
+    owner = _owner()
+    for name in list(_held):
+        await database.release_lock(name, owner)
+        _held.discard(name)
@@ -0,0 +1,151 @@
+import get_api_token
+from ratelimit import BucketMap
+
+import atexit
+import contextvars
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# Логи пишутся в очередь, а форматирует и выводит их отдельный поток (QueueListener): под нагрузкой
+# event loop не ждет записи в stderr. Строки - JSON с полями контекста (user_id, handler, latency_ms).
+#
+# Вызовы логирования пишутся с %-аргументами, а не f-строками: сообщение собирается в потоке вывода
+# и только для записей, прошедших уровень и ограничение частоты.
+
+# Сколько записей одного вида (одного шаблона сообщения) пропускать в секунду и сколько подряд.
+# Остальные отбрасываются, а их число попадает в поле suppressed следующей пропущенной записи.
+# Для предупреждений и ошибок лимит выше, но тоже есть: массовое истечение подписок при недоступной
+# панели дает по ошибке на пользователя.
+LOG_RATE = 10
+LOG_BURST = 50
+LOG_ERROR_RATE = 50
+LOG_ERROR_BURST = 200
+# Сколько разных шаблонов сообщений отслеживать
+MAX_TRACKED_TEMPLATES = 1000
+
+# Поля контекста текущей задачи asyncio: обработчик и пользователь (см. bind)
+_context = contextvars.ContextVar('log_context', default=None)
+
+_listener = None
+
+
+# Добавляет поля ко всем записям текущей задачи и задач, созданных из нее
+def bind(**fields):
+    context = _context.get()
+    _context.set({**context, **fields} if context else fields)
+
+
+class _ContextFilter(logging.Filter):
+
+    def filter(self, record):
+        context = _context.get()
+        if context:
+            for key, value in context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+# Ограничивает частоту записей по шаблону сообщения (record.msg), отдельно для info и для ошибок
+class _RateLimitFilter(logging.Filter):
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = BucketMap(LOG_RATE, LOG_BURST, MAX_TRACKED_TEMPLATES)
+        self.error_buckets = BucketMap(LOG_ERROR_RATE, LOG_ERROR_BURST, MAX_TRACKED_TEMPLATES)
+        self.suppressed = {}
+        # Логируют и из других потоков (aiosqlite, QueueListener при ошибках вывода)
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, str(record.msg))
+        buckets = self.error_buckets if record.levelno >= logging.WARNING else self.buckets
+        with self.lock:
+            if not buckets.get(key, time.monotonic()).consume(time.monotonic()):
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return False
+            suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+# Запись кладется в очередь как есть: сообщение и traceback форматирует поток вывода
+class _LazyQueueHandler(QueueHandler):
+
+    def prepare(self, record):
+        return record
+
+
+# Одна запись - одна строка JSON
+class JsonFormatter(logging.Formatter):
+
+    FIELDS = ('user_id', 'handler', 'latency_ms', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# Текстовый формат для запуска из консоли (Log_format_env=text)
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = super().format(record)
+        extra = " ".join(
+            f"{field}={getattr(record, field)}" for field in JsonFormatter.FIELDS if getattr(record, field, None) is not None
+        )
+        return f"{line} [{extra}]" if extra else line
+
+
+# Настраивает корневой логгер: очередь в памяти и поток вывода в stderr.
+# Вызывается один раз в каждом процессе бота до запуска event loop.
+def setup():
+    global _listener
+    if _listener is not None:
+        return
+    if get_api_token.Log_format == 'text':
+        formatter = TextFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    else:
+        formatter = JsonFormatter()
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _LazyQueueHandler(log_queue)
+    queue_handler.addFilter(_RateLimitFilter())
+    queue_handler.addFilter(_ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(get_api_token.Log_level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+
+# Дописывает накопившиеся в очереди записи и останавливает поток вывода
+def stop():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,465 +1,472 @@
-import get_api_token
-import yookassa_link
-import database
-
-import logging
-import json
-import asyncio
-import aiosqlite
-import aiohttp
-from aiogram import Bot, Dispatcher, types
-from aiogram.utils import executor
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, PreCheckoutQuery, ReplyKeyboardMarkup, KeyboardButton
-from datetime import datetime, timedelta, timezone
-
-# Логирование
-logging.basicConfig(level=logging.INFO)
-
-# Инициализация бота
-bot = Bot(token=get_api_token.TOKEN)
-dp = Dispatcher(bot)
-
-# Класс для работы с Marzban API
-class MarzbanBackend:
-
-    def __init__(self, token: str = None):
-        self.base_url = get_api_token.Marzban_url
-        self.headers = {"accept": "application/json"}
-        self.session = aiohttp.ClientSession()
-        if token:
-            self.headers["Authorization"] = f"Bearer {token}"
-        else:
-            asyncio.create_task(self.authorize())
-
-    async def _get(self, path: str) -> dict:
-        url = f"{self.base_url}/{path}"
-        async with self.session.get(url, headers=self.headers) as response:
-            if response.status == 200:
-                return await response.json()
-            else:
-                logging.error(f"GET request failed with status {response.status}: {url}")
-                return {}
-
-    async def _post(self, path: str, data=None) -> dict:
-        url = f"{self.base_url}/{path}"
-        async with self.session.post(url, headers=self.headers, json=data) as response:
-            if response.status in {200, 201}:
-                return await response.json()
-            else:
-                logging.error(f"POST request failed with status {response.status}: {url}")
-                return {}
-
-    async def _put(self, path: str, data=None) -> dict:
-        url = f"{self.base_url}/{path}"
-        async with self.session.put(url, headers=self.headers, json=data) as response:
-            if response.status == 200:
-                logging.info(f"cmd xray PUT {path}, data: {data}")
-                return await response.json()
-            else:
-                logging.error(f"cmd xray PUT failed with status {response.status} for {path}")
-                return {}
-
-    async def authorize(self) -> None:
-        data = {
-            "username": get_api_token.Auth_name,
-            "password": get_api_token.Auth_password
-        }
-
-        token = get_api_token.Marzban_Api_Token
-        if token:
-            self.headers["Authorization"] = f"Bearer {token}"
-        else:
-            logging.error("Authorization failed, no token received")
-
-    async def create_user(self, name: str) -> dict:
-        data = {
-            "username": name,
-            "proxies": {"shadowsocks": {"method": "chacha20-ietf-poly1305"}},
-            "inbounds": {"shadowsocks": ["Shadowsocks TCP"]},
-            "data_limit": 15 * 1024 * 1024 * 1024,
-            "data_limit_reset_strategy": "day",
-        }
-        response = await self._post("api/user", data=data)
-        if not response:
-            logging.error(f"Failed to create user {name}")
-            return {}
-        return response
-
-    async def get_user(self, name: str) -> dict:
-        response = await self._get(f"api/user/{name}")
-        if response:
-            user = response.get("username")
-            status = response.get("status")
-            logging.info(f"Get user: {user}, status: {status}")
-        else:
-            logging.warning(f"User {name} not found")
-        return response
-
-    async def disable_user(self, name: str) -> dict:
-        data = {"status": "disabled"}
-        response = await self._put(f"api/user/{name}", data=data)
-        if response:
-            logging.info(f"Disable xray user: {name} success, {response.get('username', 'unknown username')}")
-            check = await self.get_user(name)
-            await asyncio.sleep(0.25)  # Используйте асинхронный sleep
-            if check.get("status") != data.get("status"):
-                logging.error(f"After disabling user {name}, user is not disabled!")
-            return response
-        else:
-            logging.warning(f"xray user {name} not found")
-            return {}
-
-    async def enable_user(self, name: str) -> dict:
-        data = {"status": "active"}
-        response = await self._put(f"api/user/{name}", data=data)
-        if response:
-            logging.info(f"Enable xray user: {name} success, {response.get('username', 'unknown username')}")
-            return response
-        else:
-            logging.warning(f"xray user {name} not found")
-            return {}
-
-    async def close(self):
-        await self.session.close()
-
-# Инициализация Marzban API клиента с токеном
-marzban = MarzbanBackend(token=get_api_token.Marzban_Api_Token)
-
-# Функция для работы с БД при старте
-async def on_startup(_):
-    await database.db_start()
-    asyncio.create_task(check_expired_subscriptions())  # Запускаем проверку истекших подписок ежедневно
-    print("Бот успешно запущен!")
-
-# Фоновая задача для ежедневной проверки истекших подписок
-async def check_expired_subscriptions():
-    while True:
-        async with aiosqlite.connect('tg.db') as db:
-            cursor = await db.execute('''
-                SELECT user_id, end_date FROM accounts
-            ''')
-
-            async for row in cursor:
-                user_id, end_date = row
-
-                # Проверяем наличие и корректность end_date
-                if not end_date:
-                    logging.warning(f"Пустая дата для user_id {user_id}")
-                    continue
-
-                try:
-                    end_date = datetime.fromisoformat(end_date).replace(tzinfo=timezone.utc)
-                except ValueError as e:
-                    logging.error(f"Некорректный формат даты для user_id {user_id}: {end_date}. Ошибка: {e}")
-                    continue
-
-                # Если подписка истекла, отключаем доступ
-                if datetime.now(timezone.utc) > end_date:
-                    await marzban.disable_user(f"user_{user_id}")
-                    # Удаляем запись из базы данных или обновляем статус
-                    await db.execute('''
-                        UPDATE accounts
-                        SET access_key = NULL, end_date = NULL
-                        WHERE user_id = ?
-                    ''', (user_id,))
-                    await db.commit()
-                    logging.info(f"Доступ для пользователя {user_id} отключен, подписка истекла.")
-
-        # Ждем 24 часа до следующей проверки
-        await asyncio.sleep(86400)  # 86400 секунд = 24 часа
-
-
-# Стартовая команда
-@dp.message_handler(commands=['start'])
-async def menu_vpn(message: types.Message):
-    user_id = message.from_user.id
-    inline_kb = ReplyKeyboardMarkup(resize_keyboard=True)
-    buy_button = KeyboardButton("Купить VPN")
-    status_button = KeyboardButton("Мои подписки")
-    info_button = KeyboardButton("Инфо")
-    inline_kb.add(buy_button, status_button, info_button)
-    await message.answer("Выберите действие:", reply_markup=inline_kb)
-
-    # Подключаемся к базе данных и добавляем пользователя
-    async with aiosqlite.connect('tg.db') as db:
-        # Проверяем, существует ли пользователь в базе данных
-        cursor = await db.execute('SELECT user_id FROM accounts WHERE user_id = ?', (user_id,))
-        result = await cursor.fetchone()
-
-        if result is None:
-            # Если пользователя нет, добавляем его
-            await db.execute('''
-                INSERT INTO accounts (user_id)
-                VALUES (?)
-            ''', (user_id,))
-            await db.commit()
-
-
-@dp.message_handler(lambda message: message.text == "Инфо")
-async def info_message(callback_query: types.CallbackQuery):
-    info_text = (
-        "*Как пользоваться ботом?* \n"
-        "1. Запустите бота в Telegram, отправив команду /start \n"
-        "2. Выберите *Купить VPN* в меню \n"
-        "3. Выберите период подписки (1 месяц, 3 месяца, 6 месяцев) из предложенных вариантов.\n"
-        "4. Бот отправит ссылку на оплату — нажмите на кнопку *Оплатить*\n"
-        "5. После оплаты нужно проверить статус платежа, нажав на кнопку Проверить оплату \n"
-        "6. По завершении оплаты бот предоставит вам *ключ доступа* к VPN \n \n \n"
-        "*Как воспользоваться ключом?*, \n"
-        "1. Установите приложение Outline на ваше устройство.\n"
-        "2. Откройте приложение и нажмите на кнопку *Добавить сервер*.\n"
-        "3. Введите или вставьте ваш ключ доступа в соответствующее поле.\n"
-        "4. Сохраните настройки и подключитесь к серверу.\n\n"
-    )
-
-    await bot.send_message(
-        chat_id=callback_query.from_user.id,
-        text=info_text,
-        parse_mode = 'Markdown'
-    )
-    await bot.send_message(
-        chat_id=callback_query.from_user.id,
-        text="В случае проблем пишите сюда: @JustSL",
-    )
-
-# Проверка статуса подписки
-@dp.message_handler(lambda message: message.text == "Мои подписки")
-async def show_subscription_info(message: types.Message):
-    user_id = message.from_user.id
-
-
-    # Подключаемся к базе данных и извлекаем информацию о подписке
-    async with aiosqlite.connect('tg.db') as db:
-        cursor = await db.execute('''
-            SELECT end_date FROM accounts WHERE user_id = ?
-        ''', (user_id,))
-        result = await cursor.fetchone()
-
-    if result and result[0]:
-        # Если у пользователя есть активная подписка
-
-        end_date = datetime.fromisoformat(result[0]).replace(tzinfo=timezone.utc)
-        now = datetime.now(timezone.utc)
-        remaining_time = end_date - now
-        remaining_days = remaining_time.days
-
-        if remaining_time.total_seconds() > 0:
-            # Если подписка еще активна, извлекаем ключ
-            async with aiosqlite.connect('tg.db') as db:
-                cursor = await db.execute('''
-                    SELECT access_key FROM accounts WHERE user_id = ?
-                ''', (user_id,))
-                key_result = await cursor.fetchone()
-
-            if key_result:
-                access_key = key_result[0]
-
-                # Отправляем пользователю информацию о действующей подписке
-                await message.answer(
-                    f"Ваша подписка активна до {end_date.strftime('%Y-%m-%d')}.\n\n"
-                    f"Ваш ключ доступа:\n\n"
-                    f"<code>{access_key}</code>", parse_mode='HTML'
-                )
-            else:
-                await message.answer("Ошибка: ключ доступа не найден.")
-        else:
-            # Если подписка истекла
-            await message.answer("Ваша подписка истекла.")
-    else:
-        # Если подписка не найдена
-        await message.answer("У вас нет активной подписки.")
-
-# кнопка Назад
-@dp.callback_query_handler(lambda c: c.data == 'back_to_duration_selection')
-async def back_to_duration_selection(callback_query: types.CallbackQuery):
-    # Возвращаем пользователя к выбору сроков подписки
-    inline_kb = InlineKeyboardMarkup(row_width=1)
-
-    # VPN на 1 месяц
-    pay_button_1m = InlineKeyboardButton("VPN на 1 месяц - 100 руб", callback_data='1month')
-
-    # VPN на 3 месяца
-    pay_button_3m = InlineKeyboardButton("VPN на 3 месяца - 250 руб", callback_data='3month')
-
-    # VPN на 6 месяцев
-    pay_button_6m = InlineKeyboardButton("VPN на 6 месяцев - 450 руб", callback_data='6month')
-
-    # Добавляем кнопки в разметку
-    inline_kb.add(pay_button_1m, pay_button_3m, pay_button_6m)
-
-    await bot.edit_message_text(
-        chat_id=callback_query.from_user.id,
-        message_id=callback_query.message.message_id,
-        text="Выберите срок подписки и перейдите по ссылке для оплаты:",
-        reply_markup=inline_kb
-    )
-
-# Кнопка покупки VPN
-@dp.message_handler(lambda message: message.text == "Купить VPN")
-async def process_buy_vpn(message: types.Message):
-    user_id = message.from_user.id
-
-    inline_kb = InlineKeyboardMarkup(row_width=1)
-
-    # VPN на 1 месяц
-    pay_button_1m = InlineKeyboardButton("VPN на 1 месяц - 100 руб",callback_data='1month' )
-
-    # VPN на 3 месяца
-    pay_button_3m = InlineKeyboardButton("VPN на 3 месяца - 250 руб", callback_data='3month')
-
-    # VPN на 6 месяцев
-    pay_button_6m = InlineKeyboardButton("VPN на 6 месяцев - 450 руб", callback_data='6month')
-
-    # Добавляем кнопки в разметку
-    inline_kb.add(pay_button_1m, pay_button_3m, pay_button_6m)
-
-    await message.answer('Выберите срок подписки и перейдите по ссылке для оплаты:', reply_markup=inline_kb)
-
-# Обработчик для выбранного периода подписки
-@dp.callback_query_handler(lambda c: c.data in ['1month', '3month', '6month'])
-async def handle_subscription_choice(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-
-    # Определяем срок подписки и цену
-    if callback_query.data == '1month':
-        duration = '1 месяц'
-        price = 100
-    elif callback_query.data == '3month':
-        duration = '3 месяца'
-        price = 250
-    elif callback_query.data == '6month':
-        duration = '6 месяцев'
-        price = 450
-
-    # Генерация ссылки на оплату
-    payment_url = await yookassa_link.create_payment(user_id, callback_query.data)
-
-    # Инлайн-клавиатура для оплаты и проверки оплаты
-    inline_kb = InlineKeyboardMarkup(row_width=1)
-    pay_button = InlineKeyboardButton(f"Оплатить {duration} - {price} руб", url=payment_url)
-    check_payment_button = InlineKeyboardButton(f"Проверить оплату за {duration}", callback_data=f'check_payment_{duration}')
-    back_button = InlineKeyboardButton("Назад", callback_data='back_to_duration_selection')
-
-    # Добавляем кнопки в разметку
-    inline_kb.add(pay_button, check_payment_button, back_button)
-
-    await bot.edit_message_text(
-        chat_id=callback_query.from_user.id,
-        message_id=callback_query.message.message_id,
-        text=f"Оплата за VPN на {duration}. После оплаты нажмите Проверить оплату! :",
-        reply_markup=inline_kb
-    )
-
-
-# Обработка оплаты
-@dp.pre_checkout_query_handler()
-async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
-    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
-
-
-# Проверка статуса оплаты
-@dp.callback_query_handler(lambda c: c.data.startswith("check_payment_"))
-async def check_payment_status_handler(callback_query: types.CallbackQuery):
-    user_id = callback_query.from_user.id
-
-    # Извлекаем срок подписки из callback_data (например, "1month", "3 месяца", "6 месяцев")
-    duration = callback_query.data.split('_')[-1]
-
-    # Определяем количество дней для подписки (поддержка как английских, так и русских вариантов)
-    days = 0
-    if duration in ["1month", "1 месяц"]:
-        days = 30
-    elif duration in ["3month", "3 месяца"]:
-        days = 90
-    elif duration in ["6month", "6 месяцев"]:
-        days = 180
-    else:
-        logging.error(f"Unexpected duration value: {duration}")
-
-    # Проверяем статус платежа
-    payment_success = await yookassa_link.check_payment_status(user_id)
-
-    if payment_success and days > 0:
-        now = datetime.utcnow()
-
-        # Получаем текущую дату окончания подписки и ключ доступа из базы данных
-        async with aiosqlite.connect('tg.db') as db:
-            cursor = await db.execute('''
-                SELECT end_date, access_key FROM accounts WHERE user_id = ?
-            ''', (user_id,))
-            result = await cursor.fetchone()
-
-        end_date = None
-        access_key = None
-
-        if result:
-            end_date_str = result[0]
-            access_key = result[1]
-
-            # Проверяем, является ли дата окончания подписки строкой и преобразуем её
-            if end_date_str:
-                try:
-                    end_date = datetime.fromisoformat(end_date_str).replace(tzinfo=timezone.utc)
-                except ValueError:
-                    logging.error(f"Некорректный формат даты в базе данных для пользователя {user_id}: {end_date_str}")
-                    end_date = now  # Если формат некорректен, начинаем отсчет с текущей даты
-            else:
-                end_date = now
-
-
-
-        # Если подписка уже активна, прибавляем к ней дни
-        if end_date and end_date.replace(tzinfo=None) > now.replace(tzinfo=None):
-            new_end_date = end_date + timedelta(days=days)
-        else:
-            new_end_date = now + timedelta(days=days)
-
-        # Если ключ отсутствует или не был найден, создаем нового пользователя в системе Marzban
-        if access_key is None or access_key == "":
-            create_response = await marzban.create_user(f"user_{user_id}")
-
-            if create_response is None or "error" in create_response:
-                await bot.send_message(chat_id=callback_query.from_user.id,
-                                       text="Ошибка при создании пользователя. Пожалуйста, свяжитесь с поддержкой.")
-                return
-
-            key_list = create_response.get("links", [])
-            if key_list:
-                access_key = key_list[0] +'\n' + key_list[1] # Получаем ключ доступа
-
-            else:
-                await bot.send_message(
-                    chat_id=callback_query.from_user.id,
-                    text="Не удалось получить ключ доступа. Пожалуйста, свяжитесь с поддержкой."
-                )
-                return
-
-        # Сохраняем обновленную подписку и ключ в БД
-        async with aiosqlite.connect('tg.db') as db:
-            await db.execute('''
-                INSERT OR REPLACE INTO accounts (user_id, end_date, access_key)
-                VALUES (?, ?, ?)
-            ''', (user_id, new_end_date.isoformat(), access_key))
-            await db.commit()
-
-        # Отправляем сообщение о завершении оплаты и ключе
-        await bot.send_message(
-            chat_id=callback_query.from_user.id,
-            text=f"Оплата прошла успешно! Ваша подписка на {duration} активирована до {new_end_date.strftime('%Y-%m-%d')}.\n\n"
-                 f"Ваш ключ доступа (его нужно ввести в Outline):\n\n"
-                 f"<code>{access_key}</code>", parse_mode='HTML'
-        )
-    else:
-        await bot.send_message(
-            chat_id=callback_query.from_user.id,
-            text="Сначала нужно оплатить!"
-        )
-
-
-
-
-
-
-
-if __name__ == "__main__":
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+import get_api_token
+import yookassa_link
+import database
+import subscriptions
+import payment_webhook
+import reconciler
+import usage_sync
+import reminders
+import leader
+import metrics
+import logs
+import outbox
+import plans
+import callbacks
+import admin
+import qr
+from marzban_pool import MarzbanPool
+from singleflight import SingleFlight
+from throttling import ThrottlingMiddleware
+
+import hmac
+import logging
+import json
+import asyncio
+import time
+import multiprocessing
+from contextlib import contextmanager
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from aiogram.utils import executor
+from aiogram.types import PreCheckoutQuery, ReplyKeyboardMarkup, KeyboardButton
+from datetime import datetime, timezone
+from typing import Optional
+
+# Сколько истекших подписок обрабатывать за одну транзакцию
+EXPIRY_BATCH_SIZE = 500
+# Максимальная пауза между проверками истекших подписок, в секундах
+EXPIRY_MAX_SLEEP = 3600
+# Через сколько секунд повторить отключение, если Marzban не ответил успехом
+EXPIRY_RETRY_DELAY = 60
+
+# Заголовок, в котором Telegram присылает secret_token вебхука
+TELEGRAM_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+EXPIRY_NOTICE = "Ваша подписка истекла. Чтобы продолжить пользоваться VPN, оформите новую в меню «Купить VPN»."
+
+# Бот, диспетчер и пул панелей создает create_dispatcher(), а соединения с БД, Marzban и YooKassa
+# открываются в on_startup. Импорт модуля ничего не создает и не ходит в сеть.
+bot = None
+dp = None
+marzban = None
+
+# Номер воркера в режиме webhook с несколькими процессами (см. start_webhook)
+worker_index = 0
+
+# Проверки оплаты, которые выполняются прямо сейчас, по user_id
+payment_checks = SingleFlight()
+
+# Длительность этапов запуска: (этап, секунды). После старта выводится одной строкой.
+startup_timings = []
+
+
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        startup_timings.append((name, elapsed))
+        metrics.STARTUP_PHASE_SECONDS.set(elapsed, name)
+
+
+# Создает бота, диспетчер с middleware и обработчиками и пул панелей Marzban (без сетевых запросов:
+# токены панелей будут получены при первом запросе к каждой из них)
+def create_dispatcher():
+    global bot, dp, marzban
+    with startup_phase('dispatcher'):
+        bot = Bot(token=get_api_token.TOKEN)
+        dp = Dispatcher(bot)
+        # Ограничение частоты стоит первым: отклоненные вызовы не попадают в метрики обработчиков
+        dp.middleware.setup(ThrottlingMiddleware())
+        dp.middleware.setup(metrics.HandlerMetricsMiddleware())
+        register_handlers(dp)
+        marzban = MarzbanPool.from_config()
+    return dp
+
+# Функция для работы с БД при старте
+async def on_startup(_):
+    with startup_phase('database'):
+        await database.db_start()
+    with startup_phase('yookassa'):
+        await yookassa_link.start()
+    outbox.start(bot)
+    # Нагрузку панелей узнаем до первого размещения пользователя, дальше - периодически.
+    # Недоступная панель не мешает запуску: она помечается нездоровой до следующей проверки.
+    with startup_phase('marzban'):
+        await marzban.start()
+    if get_api_token.Metrics_port:
+        with startup_phase('metrics'):
+            await metrics.start(get_api_token.Metrics_port + worker_index)
+    if get_api_token.Bot_mode == 'webhook':
+        # Уведомления YooKassa принимает тот же aiohttp-сервер (см. start_webhook)
+        with startup_phase('telegram_webhook'):
+            await set_telegram_webhook()
+    elif get_api_token.Yoo_Webhook_port:
+        with startup_phase('payment_webhook'):
+            await payment_webhook.start(marzban)
+    # Фоновые задачи выполняет только один воркер - владелец блокировки в БД
+    asyncio.create_task(leader.run_as_leader('expired_subscriptions', check_expired_subscriptions))  # Отключение истекших подписок
+    asyncio.create_task(leader.run_as_leader('payments_reconciler', lambda: reconciler.run(marzban)))  # Сверка неоплаченных платежей
+    asyncio.create_task(leader.run_as_leader('usage_sync', lambda: usage_sync.run(marzban)))  # Трафик пользователей из Marzban
+    asyncio.create_task(leader.run_as_leader('reminders', reminders.run))  # Напоминания перед окончанием подписки
+    asyncio.create_task(leader.run_as_leader('outbox', outbox.run_pump))  # Уведомления и рассылки из outbox
+    if not qr.available():
+        logging.warning("Пакет qrcode[png] не установлен: ключи отправляются без QR-кода")
+    report = ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in startup_timings)
+    logging.info("Этапы запуска: %s", report)
+    print("Бот успешно запущен!")
+
+# Регистрируем адрес вебхука и его секрет в Telegram. getWebhookInfo секрет не возвращает,
+# поэтому сверить его нельзя и адрес регистрирует заново первый воркер при каждом запуске.
+async def set_telegram_webhook():
+    if worker_index != 0:
+        return
+    url = f"{get_api_token.Bot_webhook_host}{get_api_token.Bot_webhook_path}"
+    # Обновления, накопившиеся за время перезапуска, не сбрасываем
+    await bot.set_webhook(url, drop_pending_updates=False, secret_token=get_api_token.Bot_webhook_secret)
+
+
+# Обновления Telegram на path принимаются только с секретом из set_webhook в заголовке: иначе
+# любой, кто достучится до порта, мог бы прислать обновление от имени любого пользователя,
+# в том числе администратора. Остальные пути (уведомления YooKassa) middleware не трогает.
+def telegram_secret_middleware(path, secret):
+    expected = secret.encode()
+
+    @web.middleware
+    async def middleware(request, handler):
+        if request.path == path:
+            received = request.headers.get(TELEGRAM_SECRET_HEADER, '').encode()
+            if not hmac.compare_digest(received, expected):
+                logging.warning("Отклонено обновление Telegram без верного секрета от %s", request.remote)
+                raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    return middleware
+
+# Закрываем соединения при остановке
+async def on_shutdown(_):
+    await leader.release_all()
+    await metrics.stop()
+    await payment_webhook.stop()
+    await outbox.stop()
+    qr.stop()
+    await marzban.close()
+    await yookassa_link.close()
+    await database.db_close()
+
+# Отключает все подписки со сроком до now пачками по EXPIRY_BATCH_SIZE,
+# каждая пачка записывается в БД одной транзакцией.
+# Возвращает число пользователей, которых не удалось отключить.
+async def expire_due_subscriptions(now):
+    after_ts, after_user_id = -1, -1
+    failed = 0
+    while True:
+        rows = await database.get_due_subscriptions(now, after_ts, after_user_id, EXPIRY_BATCH_SIZE)
+        if not rows:
+            break
+
+        results = await marzban.disable_users(
+            [f"user_{user_id}" for user_id, _, _ in rows], [node_id for _, _, node_id in rows]
+        )
+
+        # В БД снимаем подписку только тем, кого Marzban действительно отключил
+        disabled = []
+        for (user_id, _, _), result in zip(rows, results):
+            if result.ok:
+                disabled.append(user_id)
+            else:
+                failed += 1
+                logging.error("Не удалось отключить пользователя %s: %s %s", user_id, result.status, result.error)
+
+        if disabled:
+            expired_keys = await database.expire_users(disabled, now)
+            expired = [user_id for user_id, _ in expired_keys]
+            for user_id in expired:
+                logging.info("Доступ для пользователя %s отключен, подписка истекла.", user_id)
+            # Пока шло отключение, часть пользователей оплатила продление: их подписка в БД
+            # не тронута, а в Marzban их нужно включить обратно
+            await reenable_renewed(rows, set(disabled) - set(expired))
+            # QR-коды снятых ключей больше не нужны
+            await qr.forget([access_key for _, access_key in expired_keys])
+            # Строки по каждому пользователю ограничены по частоте (logs.py), итог пачки виден всегда
+            logging.info("Отключено истекших подписок: %s", len(expired))
+            for user_id in expired:
+                subscriptions.invalidate(user_id)
+            # Уведомления ставим в постоянную очередь: их отправка не упрется в лимиты Telegram
+            await outbox.notify([(user_id, EXPIRY_NOTICE) for user_id in expired])
+        after_ts, after_user_id = rows[-1][1], rows[-1][0]
+        if len(rows) < EXPIRY_BATCH_SIZE:
+            break
+    return failed
+
+
+# Включает в Marzban пользователей из rows, которые продлили подписку во время отключения
+async def reenable_renewed(rows, renewed):
+    if not renewed:
+        return
+    rows = [row for row in rows if row[0] in renewed]
+    results = await marzban.enable_users(
+        [f"user_{user_id}" for user_id, _, _ in rows], [node_id for _, _, node_id in rows]
+    )
+    for (user_id, _, _), result in zip(rows, results):
+        if result.ok:
+            logging.info("Пользователь %s продлил подписку во время отключения, доступ включен снова", user_id)
+        else:
+            logging.error(
+                "Пользователь %s продлил подписку, но включить его в Marzban не удалось: %s %s",
+                user_id, result.status, result.error
+            )
+
+
+# Фоновая задача: отключает истекшие подписки и спит до ближайшего следующего срока
+async def check_expired_subscriptions():
+    while True:
+        now = int(time.time())
+        started = time.perf_counter()
+        try:
+            failed = await expire_due_subscriptions(now)
+            next_ts = await database.next_expiry_ts(now)
+        except Exception as e:
+            logging.error("Ошибка при проверке истекших подписок: %s", e)
+            failed, next_ts = 1, None
+        metrics.EXPIRY_PASS_SECONDS.set(time.perf_counter() - started)
+        metrics.EXPIRY_PASS_TIMESTAMP.set(time.time())
+
+        # Не спим дольше EXPIRY_MAX_SLEEP, чтобы подхватывать изменения, сделанные в обход бота
+        delay = EXPIRY_MAX_SLEEP if next_ts is None else min(next_ts - now, EXPIRY_MAX_SLEEP)
+        if failed:
+            delay = min(delay, EXPIRY_RETRY_DELAY)
+        await asyncio.sleep(max(delay, 1))
+
+
+# Стартовая команда
+async def menu_vpn(message: types.Message):
+    user_id = message.from_user.id
+    inline_kb = ReplyKeyboardMarkup(resize_keyboard=True)
+    buy_button = KeyboardButton("Купить VPN")
+    status_button = KeyboardButton("Мои подписки")
+    info_button = KeyboardButton("Инфо")
+    inline_kb.add(buy_button, status_button, info_button)
+    outbox.send(message.chat.id, "Выберите действие:", reply_markup=inline_kb)
+
+    # Добавляем пользователя в базу данных, если его там еще нет
+    await database.add_user(user_id)
+
+
+async def info_message(callback_query: types.CallbackQuery):
+    info_text = (
+        "*Как пользоваться ботом?* \n"
+        "1. Запустите бота в Telegram, отправив команду /start \n"
+        "2. Выберите *Купить VPN* в меню \n"
+        f"3. Выберите период подписки ({', '.join(plan.title for plan in plans.active())}) из предложенных вариантов.\n"
+        "4. Бот отправит ссылку на оплату — нажмите на кнопку *Оплатить*\n"
+        "5. После оплаты нужно проверить статус платежа, нажав на кнопку Проверить оплату \n"
+        "6. По завершении оплаты бот предоставит вам *ключ доступа* к VPN \n \n \n"
+        "*Как воспользоваться ключом?*, \n"
+        "1. Установите приложение Outline на ваше устройство.\n"
+        "2. Откройте приложение и нажмите на кнопку *Добавить сервер*.\n"
+        "3. Введите или вставьте ваш ключ доступа в соответствующее поле.\n"
+        "4. Сохраните настройки и подключитесь к серверу.\n\n"
+    )
+
+    outbox.send(callback_query.from_user.id, info_text, parse_mode='Markdown')
+    outbox.send(callback_query.from_user.id, "В случае проблем пишите сюда: @JustSL")
+
+# Строка о дневном трафике по данным последней синхронизации (usage_sync.py), без запроса к Marzban
+def usage_text(status):
+    if status.used_traffic is None or not status.data_limit:
+        return ""
+    gb = 1024 ** 3
+    return f"Трафик за сегодня: {status.used_traffic / gb:.1f} из {status.data_limit / gb:.0f} ГБ.\n\n"
+
+
+# Проверка статуса подписки
+async def show_subscription_info(message: types.Message):
+    user_id = message.from_user.id
+
+
+    # Дата окончания подписки и ключ: повторные проверки отвечаются из кэша без запроса к БД
+    status = await subscriptions.get_status(user_id)
+
+    if status and status.end_date:
+        # Если у пользователя есть активная подписка
+
+        end_date = status.end_date
+        now = datetime.now(timezone.utc)
+        remaining_time = end_date - now
+        remaining_days = remaining_time.days
+
+        if remaining_time.total_seconds() > 0:
+            # Если подписка еще активна, берем ключ из того же статуса
+            access_key = status.access_key
+
+            if access_key:
+
+                # Отправляем пользователю информацию о действующей подписке
+                outbox.send(
+                    message.chat.id,
+                    f"Ваша подписка активна до {end_date.strftime('%Y-%m-%d')}.\n\n"
+                    f"{usage_text(status)}"
+                    f"Ваш ключ доступа:\n\n"
+                    f"<code>{access_key}</code>", parse_mode='HTML'
+                )
+                qr.send(message.chat.id, access_key)
+            else:
+                outbox.send(message.chat.id, "Ошибка: ключ доступа не найден.")
+        else:
+            # Если подписка истекла
+            outbox.send(message.chat.id, "Ваша подписка истекла.")
+    else:
+        # Если подписка не найдена
+        outbox.send(message.chat.id, "У вас нет активной подписки.")
+
+# кнопка Назад
+async def back_to_duration_selection(callback_query: types.CallbackQuery):
+    # Возвращаем пользователя к выбору сроков подписки
+    await bot.edit_message_text(
+        chat_id=callback_query.from_user.id,
+        message_id=callback_query.message.message_id,
+        text="Выберите срок подписки и перейдите по ссылке для оплаты:",
+        reply_markup=callbacks.plans_keyboard()
+    )
+
+# Кнопка покупки VPN
+async def process_buy_vpn(message: types.Message):
+    outbox.send(message.chat.id, 'Выберите срок подписки и перейдите по ссылке для оплаты:', reply_markup=callbacks.plans_keyboard())
+
+# Обработчик для выбранного периода подписки; plan - тариф из кнопки (см. callbacks.action_filter)
+async def handle_subscription_choice(callback_query: types.CallbackQuery, plan: plans.Plan):
+    user_id = callback_query.from_user.id
+
+    # Генерация ссылки на оплату
+    payment_url = await yookassa_link.create_payment(user_id, plan)
+
+    await bot.edit_message_text(
+        chat_id=callback_query.from_user.id,
+        message_id=callback_query.message.message_id,
+        text=f"Оплата за VPN на {plan.title}. После оплаты нажмите Проверить оплату! :",
+        reply_markup=callbacks.payment_keyboard(plan, payment_url)
+    )
+
+
+# Обработка оплаты
+async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
+    await bot.answer_pre_checkout_query(pre_checkout_query.id, ok=True)
+
+
+# Проверяет последний платеж пользователя и, если он оплачен, продлевает подписку.
+# Возвращает (оплачен ли платеж, тариф из платежа, Activation).
+async def check_and_activate(user_id, days):
+    payment = await yookassa_link.check_payment_status(user_id)
+    if not payment:
+        return False, None, None
+
+    # Срок берем из тарифа, который записан в самом платеже (у старых платежей его нет)
+    plan = (payment.get("metadata") or {}).get("plan")
+    paid_plan = plans.get(plan)
+    if paid_plan is not None:
+        days = paid_plan.days
+    if days <= 0:
+        return False, plan, None
+
+    activation = await subscriptions.activate(marzban, user_id, days, payment["id"])
+    return True, plan, activation
+
+
+# Проверка статуса оплаты
+async def check_payment_status_handler(callback_query: types.CallbackQuery, plan: Optional[plans.Plan]):
+    user_id = callback_query.from_user.id
+
+    # Тариф из кнопки нужен только платежам без тарифа в metadata
+    days = plan.days if plan else 0
+    if plan is None:
+        logging.error("Unexpected duration value: %s", callback_query.data)
+
+    # Повторные нажатия, пока первое еще обрабатывается, не ходят в YooKassa и Marzban заново
+    (paid, paid_plan, activation), shared = await payment_checks.do(
+        user_id, lambda: check_and_activate(user_id, days)
+    )
+    if shared:
+        # Ответ пользователю отправит обработчик первого нажатия
+        await callback_query.answer()
+        return
+
+    if paid:
+        if activation is None:
+            outbox.send(
+                callback_query.from_user.id,
+                "Ошибка при создании пользователя. Пожалуйста, свяжитесь с поддержкой.",
+                priority=outbox.PRIORITY_TRANSACTIONAL
+            )
+            return
+
+        # Отправляем сообщение о завершении оплаты и ключе
+        title = plans.title(paid_plan) if plans.get(paid_plan) else plan.title
+        outbox.send(
+            callback_query.from_user.id,
+            subscriptions.activation_text(title, activation),
+            priority=outbox.PRIORITY_TRANSACTIONAL, parse_mode='HTML'
+        )
+        qr.send(callback_query.from_user.id, activation.access_key, outbox.PRIORITY_TRANSACTIONAL)
+    else:
+        outbox.send(callback_query.from_user.id, "Сначала нужно оплатить!")
+
+
+# Регистрация обработчиков в диспетчере, созданном create_dispatcher()
+def register_handlers(dp):
+    dp.register_message_handler(menu_vpn, commands=['start'])
+    dp.register_message_handler(info_message, lambda message: message.text == "Инфо")
+    dp.register_message_handler(show_subscription_info, lambda message: message.text == "Мои подписки")
+    # Кнопки разбираются по таблице действий в callbacks.py, включая кнопки старого формата
+    dp.register_callback_query_handler(back_to_duration_selection, callbacks.action_filter(callbacks.ACTION_BACK))
+    dp.register_message_handler(process_buy_vpn, lambda message: message.text == "Купить VPN")
+    dp.register_callback_query_handler(handle_subscription_choice, callbacks.action_filter(callbacks.ACTION_BUY))
+    dp.register_pre_checkout_query_handler(process_pre_checkout_query)
+    dp.register_callback_query_handler(check_payment_status_handler, callbacks.action_filter(callbacks.ACTION_CHECK))
+    # /stats и /export для администраторов
+    admin.register_handlers(dp)
+
+
+# Запуск в режиме webhook: обновления Telegram и уведомления YooKassa принимает один aiohttp-сервер
+def start_webhook(index=0):
+    global worker_index
+    worker_index = index
+    logs.setup()
+    create_dispatcher()
+    web_app = web.Application(middlewares=[
+        telegram_secret_middleware(get_api_token.Bot_webhook_path, get_api_token.Bot_webhook_secret),
+    ])
+    payment_webhook.setup(web_app, marzban)
+    webhook_executor = executor.set_webhook(
+        dispatcher=dp,
+        webhook_path=get_api_token.Bot_webhook_path,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        skip_updates=False,
+        web_app=web_app,
+    )
+    webhook_executor.run_app(
+        host=get_api_token.Bot_webapp_host,
+        port=get_api_token.Bot_webapp_port,
+        reuse_port=get_api_token.Bot_workers > 1,
+    )
+
+
+if __name__ == "__main__":
+    if get_api_token.Bot_mode == 'webhook':
+        if get_api_token.Bot_workers > 1:
+            # Каждый воркер - отдельный процесс со своим event loop, все слушают один порт
+            context = multiprocessing.get_context('spawn')
+            workers = [context.Process(target=start_webhook, args=(index,)) for index in range(get_api_token.Bot_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            start_webhook()
+    else:
+        logs.setup()
+        create_dispatcher()
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=False)
@@ -0,0 +1,444 @@
+import get_api_token
+import metrics
+
+import logging
+import asyncio
+import base64
+import json
+import random
+import time
+import aiohttp
+from collections import deque
+from dataclasses import dataclass
+
+# Ответы, после которых панель просит притормозить или временно недоступна; такие запросы повторяются
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Сколько пользователей проверять одним запросом GET api/users
+VERIFY_CHUNK_SIZE = 100
+
+
+# Путь запроса без имени пользователя, чтобы метрики не дробились по пользователям
+def _path_template(path: str) -> str:
+    if path.startswith("api/user/"):
+        return "api/user/{username}"
+    return path
+
+
+# Время истечения (unix) из поля exp JWT-токена, 0 если его не удалось прочитать
+def _jwt_exp(token: str) -> int:
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, ValueError, KeyError, TypeError):
+        return 0
+
+
+# Ошибки Marzban API. status - HTTP-статус ответа, 0 - ответа не было (сеть, таймаут, автомат разомкнут).
+class MarzbanError(Exception):
+
+    def __init__(self, status: int, detail: str = ""):
+        super().__init__(f"{status} {detail}".strip())
+        self.status = status
+        self.detail = detail
+
+
+# Панель недоступна: сетевая ошибка, таймаут, 429/5xx после всех повторов или разомкнутый автомат
+class MarzbanUnavailable(MarzbanError):
+    pass
+
+
+class MarzbanAuthError(MarzbanError):
+    pass
+
+
+class MarzbanNotFound(MarzbanError):
+    pass
+
+
+# Пользователь с таким именем уже существует
+class MarzbanConflict(MarzbanError):
+    pass
+
+
+def _error_for_status(status: int, detail: str) -> MarzbanError:
+    if status == 404:
+        return MarzbanNotFound(status, detail)
+    if status == 409:
+        return MarzbanConflict(status, detail)
+    if status in {401, 403}:
+        return MarzbanAuthError(status, detail)
+    return MarzbanError(status, detail)
+
+
+# Результат операции над одним пользователем в пакетных методах
+@dataclass
+class UserOpResult:
+    name: str
+    ok: bool
+    status: int = 0
+    error: str = ""
+
+
+# Автоматический выключатель: если из последних window попыток доля неудачных (сеть, таймаут, 5xx)
+# достигла failure_ratio, запросы к панели сразу завершаются ошибкой, пока не пройдет reset_timeout.
+# Затем пропускается один пробный запрос: если он успешен - автомат замыкается, если нет - снова размыкается.
+# Считается доля, а не неудачи подряд: при параллельных запросах быстрые 502 приходят пачкой
+# раньше медленных успешных ответов, и счетчик подряд размыкал бы автомат у живой панели.
+class CircuitBreaker:
+
+    def __init__(self, failure_ratio: float = 0.8, window: int = 20, reset_timeout: float = 30.0):
+        self.failure_ratio = failure_ratio
+        self.reset_timeout = reset_timeout
+        # Исходы последних попыток: True - неудачная
+        self.outcomes = deque(maxlen=window)
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self.is_open or self._trial:
+            return False
+        self._trial = True
+        return True
+
+    # Пробная попытка завершилась без исхода (429, отмена): следующий запрос сможет попробовать снова
+    def release(self):
+        self._trial = False
+
+    def record_success(self):
+        self.outcomes.append(False)
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.outcomes.append(True)
+        half_open = self.opened_at is not None
+        self._trial = False
+        failures = sum(self.outcomes)
+        if half_open or (len(self.outcomes) == self.outcomes.maxlen and failures >= self.failure_ratio * len(self.outcomes)):
+            if not self.is_open:
+                logging.error("Marzban circuit opened: %s/%s recent requests failed", failures, len(self.outcomes))
+            self.opened_at = time.monotonic()
+            self.outcomes.clear()
+
+
+# Класс для работы с Marzban API
+class MarzbanBackend:
+
+    def __init__(self, token: str = None, concurrency: int = None, url: str = None,
+                 username: str = None, password: str = None, inbound: str = None):
+        self.base_url = url or get_api_token.Marzban_url
+        self.username = username or get_api_token.Auth_name
+        self.password = password or get_api_token.Auth_password
+        # Inbound, в который попадают новые пользователи этой панели
+        self.inbound = inbound or "Shadowsocks TCP"
+        self.headers = {"accept": "application/json"}
+        # Сессия создается в start() внутри работающего event loop
+        self.session = None
+        self.concurrency = concurrency or get_api_token.Marzban_concurrency
+        self.max_retries = 5
+        self.breaker = CircuitBreaker()
+        # Общая для всех запросов пауза: растет на 429/5xx и плавно уменьшается на успешных ответах
+        self.backoff = 0.0
+        self.max_backoff = 30.0
+        self._backoff_raised_at = 0.0
+        # Токен получаем лениво при первом запросе и обновляем заранее, до истечения exp
+        self.token_exp = 0
+        self._login_task = None
+        if token:
+            self._set_token(token)
+
+    # Пул соединений к панели: keep-alive, кэш DNS и таймауты на каждый запрос
+    async def start(self):
+        if self.session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=get_api_token.Marzban_connections,
+            limit_per_host=get_api_token.Marzban_connections,
+            keepalive_timeout=30,
+            ttl_dns_cache=300,
+        )
+        timeout = aiohttp.ClientTimeout(total=get_api_token.Marzban_timeout, connect=5)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def _set_token(self, token: str):
+        self.headers["Authorization"] = f"Bearer {token}"
+        self.token_exp = _jwt_exp(token)
+
+    def _token_expiring(self) -> bool:
+        if "Authorization" not in self.headers:
+            return True
+        return bool(self.token_exp) and time.time() >= self.token_exp - get_api_token.Marzban_token_margin
+
+    def _slow_down(self, retry_after=None):
+        now = time.monotonic()
+        if retry_after:
+            try:
+                self.backoff = min(float(retry_after), self.max_backoff)
+                self._backoff_raised_at = now
+                return
+            except ValueError:
+                pass
+        # Пачка одновременных 429 - это один сигнал перегрузки, а не много:
+        # увеличиваем паузу не чаще одного раза за ее текущую длину
+        if now - self._backoff_raised_at >= self.backoff:
+            self.backoff = min(max(self.backoff * 2, 0.1), self.max_backoff)
+            self._backoff_raised_at = now
+
+    def _speed_up(self):
+        self.backoff = self.backoff / 2 if self.backoff > 0.01 else 0.0
+
+    # Пауза перед попыткой: общая адаптивная и экспоненциальная для повторов, обе со случайным разбросом
+    def _retry_delay(self, attempt: int) -> float:
+        delay = self.backoff
+        if attempt > 1:
+            delay = max(delay, min(0.2 * 2 ** (attempt - 2), 5.0))
+        return delay * random.uniform(0.5, 1.5)
+
+    async def _request(self, method: str, path: str, data=None, params=None, retry: bool = True):
+        # Возвращает тело успешного ответа (200/201), иначе бросает MarzbanError.
+        # При 429/5xx, сетевых ошибках и таймаутах повторяет запрос (если retry) с паузой.
+        if self.session is None:
+            await self.start()
+        url = f"{self.base_url}/{path}"
+        attempts = self.max_retries + 1 if retry else 1
+        reauthorized = False
+        error = None
+        attempt = 0
+        while attempt < attempts:
+            if not self.breaker.allow():
+                raise error or MarzbanUnavailable(0, f"circuit open for {self.base_url}")
+            # Эта попытка - пробная после размыкания автомата: она должна либо дать исход
+            # (record_success/record_failure), либо вернуть право на пробу, иначе автомат не закроется никогда
+            trial = self.breaker.opened_at is not None
+            attempt += 1
+            try:
+                delay = self._retry_delay(attempt)
+                if delay:
+                    await asyncio.sleep(delay)
+                if self._token_expiring():
+                    # Вход - часть попытки: недоступная панель при входе повторяется так же, как сам запрос
+                    try:
+                        if not await self.authorize():
+                            raise MarzbanAuthError(401, "authorization failed")
+                    except MarzbanUnavailable as e:
+                        error = e
+                        continue
+                authorization = self.headers.get("Authorization")
+                started = time.perf_counter()
+                try:
+                    async with self.session.request(method, url, headers=self.headers, json=data, params=params) as response:
+                        metrics.MARZBAN_REQUEST_SECONDS.observe(
+                            time.perf_counter() - started, method, _path_template(path), response.status
+                        )
+                        if response.status in RETRY_STATUSES:
+                            # 429 - панель жива, но перегружена: с этим справляется общая пауза, а не автомат
+                            if response.status != 429:
+                                self.breaker.record_failure()
+                            self._slow_down(response.headers.get("Retry-After"))
+                            error = MarzbanUnavailable(response.status, await response.text())
+                            continue
+                        # Панель ответила по существу - для автомата это успех, даже если это 401 или 404
+                        self.breaker.record_success()
+                        if response.status == 401 and not reauthorized:
+                            # Токен отозван или истек раньше срока: один раз входим заново и повторяем запрос.
+                            # Если токен уже обновил другой запрос, просто повторяем с новым.
+                            reauthorized = True
+                            attempt -= 1
+                            if self.headers.get("Authorization") == authorization and not await self.authorize():
+                                raise MarzbanAuthError(401, "authorization failed")
+                            continue
+                        self._speed_up()
+                        if response.status in {200, 201}:
+                            return await response.json()
+                        raise _error_for_status(response.status, await response.text())
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    metrics.MARZBAN_REQUEST_SECONDS.observe(
+                        time.perf_counter() - started, method, _path_template(path), "error"
+                    )
+                    self.breaker.record_failure()
+                    error = MarzbanUnavailable(0, str(e) or type(e).__name__)
+            finally:
+                if trial:
+                    # 429 или отмена (например, таймаут проверки здоровья пула) исхода не дают
+                    self.breaker.release()
+        logging.error("%s %s/%s failed after %s attempts: %s", method, self.base_url, path, attempt, error)
+        raise error
+
+    async def _get(self, path: str, params=None) -> dict:
+        return await self._request("GET", path, params=params)
+
+    # Повтор POST безопасен только там, где повторное выполнение распознается (см. create_user)
+    async def _post(self, path: str, data=None, retry: bool = False) -> dict:
+        return await self._request("POST", path, data=data, retry=retry)
+
+    async def _put(self, path: str, data=None) -> dict:
+        response = await self._request("PUT", path, data=data)
+        logging.debug("cmd xray PUT %s, data: %s", path, data)
+        return response
+
+    async def _login(self) -> bool:
+        data = {
+            "username": self.username,
+            "password": self.password
+        }
+        if self.session is None:
+            await self.start()
+        try:
+            started = time.perf_counter()
+            async with self.session.post(f"{self.base_url}/api/admin/token", data=data) as response:
+                metrics.MARZBAN_REQUEST_SECONDS.observe(
+                    time.perf_counter() - started, "POST", "api/admin/token", response.status
+                )
+                if response.status in RETRY_STATUSES:
+                    if response.status != 429:
+                        self.breaker.record_failure()
+                    raise MarzbanUnavailable(response.status, "authorization failed")
+                self.breaker.record_success()
+                if response.status != 200:
+                    logging.error("Authorization failed with status %s", response.status)
+                    return False
+                token = (await response.json()).get("access_token")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Панель недоступна - это не ошибка учетных данных
+            self.breaker.record_failure()
+            raise MarzbanUnavailable(0, f"authorization failed: {e or type(e).__name__}") from e
+
+        if token:
+            self._set_token(token)
+            return True
+        else:
+            logging.error("Authorization failed, no token received")
+            return False
+
+    # Вход в панель. Одновременные вызовы ждут один и тот же запрос токена, а не логинятся каждый сам.
+    async def authorize(self) -> bool:
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self._login())
+            self._login_task.add_done_callback(self._login_done)
+        return await asyncio.shield(self._login_task)
+
+    def _login_done(self, task):
+        self._login_task = None
+        # Ошибку получат ожидающие authorize(); если их отменили, она не должна попасть в лог asyncio
+        if not task.cancelled():
+            task.exception()
+
+    # Создание пользователя можно повторять: если первый запрос дошел до панели, повтор получит 409,
+    # и вызывающий код (subscriptions._issue_key) включит уже существующего пользователя.
+    # Бросает MarzbanConflict, если пользователь уже есть, и MarzbanError при других ошибках.
+    async def create_user(self, name: str) -> dict:
+        data = {
+            "username": name,
+            "proxies": {"shadowsocks": {"method": "chacha20-ietf-poly1305"}},
+            "inbounds": {"shadowsocks": [self.inbound]},
+            "data_limit": 15 * 1024 * 1024 * 1024,
+            "data_limit_reset_strategy": "day",
+        }
+        return await self._post("api/user", data=data, retry=True)
+
+    # Пользователь панели или пустой словарь, если его нет
+    async def get_user(self, name: str) -> dict:
+        try:
+            response = await self._get(f"api/user/{name}")
+        except MarzbanNotFound:
+            logging.warning("User %s not found", name)
+            return {}
+        logging.info("Get user: %s, status: %s", response.get('username'), response.get('status'))
+        return response
+
+    # Нагрузка панели (GET api/system) без повторов: для проверки здоровья важен быстрый ответ
+    async def get_system(self) -> dict:
+        return await self._request("GET", "api/system", retry=False)
+
+    # Страница списка пользователей панели: (пользователи, всего пользователей)
+    async def list_users(self, offset: int, limit: int):
+        response = await self._get("api/users", params={"offset": offset, "limit": limit})
+        return response.get("users", []), response.get("total", 0)
+
+    # Статусы пользователей одним запросом на VERIFY_CHUNK_SIZE имен
+    async def get_statuses(self, names) -> dict:
+        statuses = {}
+        for i in range(0, len(names), VERIFY_CHUNK_SIZE):
+            chunk = names[i:i + VERIFY_CHUNK_SIZE]
+            response = await self._get("api/users", params=[("username", name) for name in chunk])
+            for user in response.get("users", []):
+                statuses[user["username"]] = user.get("status")
+        return statuses
+
+    # Отключает пользователя. Пустой словарь, если его нет в панели.
+    async def disable_user(self, name: str) -> dict:
+        data = {"status": "disabled"}
+        try:
+            response = await self._put(f"api/user/{name}", data=data)
+        except MarzbanNotFound:
+            logging.warning("xray user %s not found", name)
+            return {}
+        logging.info("Disable xray user: %s success, %s", name, response.get('username', 'unknown username'))
+        # Ответ на PUT уже содержит новый статус, отдельный GET для проверки не нужен
+        if response.get("status") != data.get("status"):
+            logging.error("After disabling user %s, user is not disabled!", name)
+        return response
+
+    # Включает пользователя. Бросает MarzbanNotFound, если его нет в панели.
+    async def enable_user(self, name: str) -> dict:
+        response = await self._put(f"api/user/{name}", data={"status": "active"})
+        logging.info("Enable xray user: %s success, %s", name, response.get('username', 'unknown username'))
+        return response
+
+    async def _set_status_bulk(self, names, status: str, verify: bool, concurrency: int = None) -> list:
+        semaphore = asyncio.Semaphore(concurrency or self.concurrency)
+
+        async def set_status(name):
+            async with semaphore:
+                try:
+                    response = await self._request("PUT", f"api/user/{name}", data={"status": status})
+                except MarzbanNotFound:
+                    if status == "disabled":
+                        # Пользователя нет в панели - отключать нечего
+                        return UserOpResult(name, True, 404, "not found")
+                    return UserOpResult(name, False, 404, "not found")
+                except MarzbanError as e:
+                    return UserOpResult(name, False, e.status, str(e))
+            if response.get("status") != status:
+                return UserOpResult(name, False, 200, f"status is {response.get('status')}")
+            return UserOpResult(name, True, 200)
+
+        started = time.monotonic()
+        results = await asyncio.gather(*(set_status(name) for name in names))
+
+        if verify:
+            # Повторная проверка одним списочным запросом на пачку вместо GET на каждого
+            try:
+                statuses = await self.get_statuses([r.name for r in results if r.ok and r.status == 200])
+            except MarzbanError as e:
+                logging.error("Failed to verify user statuses: %s", e)
+                statuses = {}
+            for result in results:
+                if result.ok and result.status == 200 and statuses.get(result.name) != status:
+                    result.ok = False
+                    result.error = f"verification failed: {statuses.get(result.name)}"
+
+        done = sum(result.ok for result in results)
+        logging.info("Set status %s for %s/%s users in %.2fs", status, done, len(results), time.monotonic() - started)
+        return results
+
+    # Отключает пользователей параллельно (не больше concurrency запросов одновременно).
+    # Возвращает UserOpResult на каждое имя в том же порядке; ok=True и для отсутствующих в панели.
+    async def disable_users(self, names, verify: bool = False, concurrency: int = None) -> list:
+        return await self._set_status_bulk(list(names), "disabled", verify, concurrency)
+
+    async def enable_users(self, names, verify: bool = False, concurrency: int = None) -> list:
+        return await self._set_status_bulk(list(names), "active", verify, concurrency)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
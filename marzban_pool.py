@@ -0,0 +1,143 @@
+import get_api_token
+from marzban_backend import MarzbanBackend, UserOpResult
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+# Сколько ждать ответа api/system при проверке здоровья, в секундах
+HEALTH_TIMEOUT = 5
+
+
+# Последние известные нагрузка и доступность узла
+@dataclass
+class NodeStats:
+    healthy: bool = True
+    users_active: int = 0
+    bandwidth: int = 0
+    checked_at: float = 0.0
+
+
+# Несколько панелей Marzban. Новые пользователи размещаются на наименее нагруженном
+# доступном узле, а все дальнейшие операции идут на узел, записанный в accounts.node_id.
+class MarzbanPool:
+
+    def __init__(self, nodes):
+        # nodes - список (node_id, MarzbanBackend, weight); первый узел - узел по умолчанию
+        self.nodes = {node_id: backend for node_id, backend, _ in nodes}
+        self.weights = {node_id: weight for node_id, _, weight in nodes}
+        self.default_node = nodes[0][0]
+        self.stats = {node_id: NodeStats() for node_id in self.nodes}
+        self._health_task = None
+
+    # Пул из конфигурации: Marzban_nodes или одна панель Marzban_url с id "default"
+    @classmethod
+    def from_config(cls):
+        nodes = []
+        for node in get_api_token.Marzban_nodes:
+            backend = MarzbanBackend(
+                url=node["url"],
+                username=node.get("username"),
+                password=node.get("password"),
+                inbound=node.get("inbound"),
+            )
+            nodes.append((str(node["id"]), backend, float(node.get("weight", 1))))
+        if not nodes:
+            nodes.append(("default", MarzbanBackend(), 1.0))
+        return cls(nodes)
+
+    # Клиент узла; пользователи без записанного узла живут на узле по умолчанию
+    def node(self, node_id=None) -> MarzbanBackend:
+        return self.nodes.get(node_id or self.default_node) or self.nodes[self.default_node]
+
+    def node_id(self, node_id=None) -> str:
+        return node_id if node_id in self.nodes else self.default_node
+
+    # Узел доступен по последней проверке, и его автомат не разомкнут текущими ошибками
+    def healthy(self, node_id) -> bool:
+        return self.stats[node_id].healthy and not self.nodes[node_id].breaker.is_open
+
+    # Узел для нового пользователя: меньше всего активных пользователей на единицу веса,
+    # при равенстве - меньше трафика. Если недоступны все узлы, выбираем из всех.
+    def place(self) -> str:
+        candidates = [node_id for node_id in self.nodes if self.healthy(node_id)] or list(self.nodes)
+        node_id = min(candidates, key=lambda n: (
+            self.stats[n].users_active / self.weights[n],
+            self.stats[n].bandwidth / self.weights[n],
+        ))
+        # До следующего опроса учитываем размещенного пользователя сами,
+        # чтобы пачка оплат не ушла целиком на один узел
+        self.stats[node_id].users_active += 1
+        return node_id
+
+    async def _check(self, node_id):
+        stats = self.stats[node_id]
+        try:
+            system = await asyncio.wait_for(self.nodes[node_id].get_system(), HEALTH_TIMEOUT)
+        except Exception as e:
+            system = {}
+            logging.error("Узел Marzban %s не ответил на проверку: %s", node_id, e)
+        healthy = bool(system)
+        if stats.healthy != healthy:
+            logging.warning("Узел Marzban %s %s", node_id, 'снова доступен' if healthy else 'недоступен')
+        stats.healthy = healthy
+        stats.checked_at = time.time()
+        if healthy:
+            stats.users_active = int(system.get("users_active") or 0)
+            stats.bandwidth = int(system.get("incoming_bandwidth_speed") or 0) + int(system.get("outgoing_bandwidth_speed") or 0)
+
+    # Опрашивает нагрузку и доступность всех узлов параллельно
+    async def refresh(self):
+        await asyncio.gather(*(self._check(node_id) for node_id in self.nodes))
+
+    # Первая проверка узлов и запуск периодической. Выполняется в каждом процессе,
+    # потому что размещение пользователей идет в любом воркере.
+    async def start(self):
+        for backend in self.nodes.values():
+            await backend.start()
+        await self.refresh()
+        self._health_task = asyncio.create_task(self._run_health_checks())
+
+    async def _run_health_checks(self):
+        while True:
+            await asyncio.sleep(get_api_token.Marzban_health_interval)
+            await self.refresh()
+
+    # Отключает пользователей на их узлах. node_ids - узел каждого пользователя из names.
+    # Возвращает UserOpResult в том же порядке, что и names.
+    async def disable_users(self, names, node_ids) -> list:
+        return await self._on_nodes('disable_users', names, node_ids)
+
+    # Включает пользователей на их узлах, результат - как у disable_users
+    async def enable_users(self, names, node_ids) -> list:
+        return await self._on_nodes('enable_users', names, node_ids)
+
+    async def _on_nodes(self, method, names, node_ids) -> list:
+        by_node = {}
+        for index, (name, node_id) in enumerate(zip(names, node_ids)):
+            by_node.setdefault(self.node_id(node_id), []).append((index, name))
+
+        results = [None] * len(names)
+
+        async def run_on(node_id, items):
+            node_results = await getattr(self.nodes[node_id], method)([name for _, name in items])
+            for (index, _), result in zip(items, node_results):
+                results[index] = result
+
+        outcomes = await asyncio.gather(
+            *(run_on(node_id, items) for node_id, items in by_node.items()), return_exceptions=True
+        )
+        for (node_id, items), outcome in zip(by_node.items(), outcomes):
+            if isinstance(outcome, Exception):
+                logging.error("Ошибка %s на узле %s: %s", method, node_id, outcome)
+                for index, name in items:
+                    results[index] = UserOpResult(name, False, error=str(outcome) or type(outcome).__name__)
+        return results
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for backend in self.nodes.values():
+            await backend.close()
@@ -0,0 +1,219 @@
+import get_api_token
+import logs
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from aiohttp import web
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Метрики в текстовом формате Prometheus без внешних зависимостей.
+# Запись в гистограмму - поиск корзины и пара сложений, поэтому их можно держать включенными всегда.
+
+# Обработчики дольше этого (в секундах) попадают в лог с полем latency_ms
+SLOW_HANDLER_SECONDS = 1.0
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry = []
+_runner = None
+_lag_task = None
+
+
+def _format_labels(labelnames, labels, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [счетчики по корзинам (последняя - +Inf), сумма, количество]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            label_str = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        _registry.append(self)
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Время выполнения обработчиков aiogram", ("handler",))
+MARZBAN_REQUEST_SECONDS = Histogram(
+    "marzban_request_seconds", "Время запросов к Marzban API", ("method", "path", "status"))
+YOOKASSA_REQUEST_SECONDS = Histogram(
+    "yookassa_request_seconds", "Время запросов к API YooKassa", ("method", "path", "status"))
+SQLITE_QUERY_SECONDS = Histogram(
+    "sqlite_query_seconds", "Время запросов к SQLite, включая ожидание соединения", ("query",))
+EVENT_LOOP_LAG_SECONDS = Gauge(
+    "event_loop_lag_seconds", "Насколько позже положенного проснулась последняя проверка event loop")
+EXPIRY_PASS_SECONDS = Gauge(
+    "expiry_pass_duration_seconds", "Длительность последнего прохода check_expired_subscriptions")
+CACHE_REQUESTS = Counter(
+    "cache_requests_total", "Обращения к кэшам в памяти процесса", ("cache", "result"))
+EXPIRY_PASS_TIMESTAMP = Gauge(
+    "expiry_pass_timestamp_seconds", "Unix-время окончания последнего прохода check_expired_subscriptions")
+STARTUP_PHASE_SECONDS = Gauge(
+    "startup_phase_seconds", "Длительность этапов запуска процесса бота", ("phase",))
+QR_RENDER_SECONDS = Histogram(
+    "qr_render_seconds", "Время получения PNG с QR-кодом ключа в пуле процессов", ("source",))
+
+
+# Декоратор для асинхронных функций: время каждого вызова пишется в histogram с меткой - именем функции
+def timed(histogram):
+    def decorator(func):
+        name = func.__name__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+# Время работы каждого обработчика диспетчера (после прохождения фильтров).
+# Заодно добавляет имя обработчика и пользователя ко всем записям лога, сделанным во время обновления.
+class HandlerMetricsMiddleware(BaseMiddleware):
+
+    async def _start(self, update, data):
+        handler = current_handler.get()
+        if handler is not None:
+            data["metrics_handler"] = handler.__name__
+            data["metrics_started"] = time.perf_counter()
+            logs.bind(handler=handler.__name__, user_id=update.from_user.id if update.from_user else None)
+
+    async def _finish(self, data):
+        if "metrics_started" in data:
+            elapsed = time.perf_counter() - data["metrics_started"]
+            HANDLER_SECONDS.observe(elapsed, data["metrics_handler"])
+            if elapsed >= SLOW_HANDLER_SECONDS:
+                logging.warning("Медленный обработчик %s", data["metrics_handler"], extra={"latency_ms": round(elapsed * 1000)})
+
+    async def on_process_message(self, message, data):
+        await self._start(message, data)
+
+    async def on_post_process_message(self, message, results, data):
+        await self._finish(data)
+
+    async def on_process_callback_query(self, callback_query, data):
+        await self._start(callback_query, data)
+
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        await self._finish(data)
+
+    async def on_process_pre_checkout_query(self, pre_checkout_query, data):
+        await self._start(pre_checkout_query, data)
+
+    async def on_post_process_pre_checkout_query(self, pre_checkout_query, results, data):
+        await self._finish(data)
+
+
+# Если event loop чем-то заблокирован, sleep просыпается позже положенного - эту задержку и пишем
+async def _monitor_loop_lag(interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG_SECONDS.set(max(loop.time() - started - interval, 0.0))
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+# Запускает локальный HTTP-сервер с /metrics и замер задержки event loop
+async def start(port):
+    global _runner, _lag_task
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, get_api_token.Metrics_host, port).start()
+    _lag_task = asyncio.create_task(_monitor_loop_lag())
+    logging.info("Метрики доступны на http://%s:%s/metrics", get_api_token.Metrics_host, port)
+
+
+async def stop():
+    global _runner, _lag_task
+    if _lag_task is not None:
+        _lag_task.cancel()
+        _lag_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,221 @@
+import logging
+import sqlite3
+
+# Версионированные миграции схемы. Номер последней примененной миграции хранится в PRAGMA user_version,
+# при старте выполняются только более новые. Миграцию после выпуска не меняют - добавляют следующую.
+
+# Сколько строк переводить за одну транзакцию при переносе данных
+BATCH_SIZE = 1000
+
+
+# Схема, к которой бот пришел до появления миграций. Базы того времени могли остановиться
+# на любом промежуточном состоянии, поэтому все шаги здесь идемпотентны.
+async def _initial_schema(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS accounts (
+            user_id INTEGER PRIMARY KEY,
+            payment_id TEXT,
+            end_date TEXT,
+            access_key TEXT
+        )
+    ''')
+    columns = await _columns(conn, 'accounts')
+    # Срок подписки в unix-времени, по нему идут выборки истекающих подписок
+    if 'end_ts' not in columns:
+        await conn.execute('ALTER TABLE accounts ADD COLUMN end_ts INTEGER')
+    # Узел Marzban, на котором создан пользователь (NULL - узел по умолчанию, см. marzban_pool.py)
+    if 'node_id' not in columns:
+        await conn.execute('ALTER TABLE accounts ADD COLUMN node_id TEXT')
+
+    # Платежи, по которым подписка уже продлена: каждый payment_id применяется ровно один раз
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS applied_payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            applied_at INTEGER NOT NULL
+        )
+    ''')
+    # История платежей; незавершенные (pending) проверяет фоновая сверка reconciler.py
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            plan TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            next_check_at INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_payments_user ON payments (user_id, created_at)')
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments (next_check_at)
+        WHERE status = 'pending'
+    ''')
+
+    # Блокировки для выбора ведущего процесса, когда бот запущен в несколько воркеров
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS locks (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at INTEGER NOT NULL
+        )
+    ''')
+
+    # Трафик пользователей по данным Marzban (usage_sync.py); updated_at - когда значения последний раз менялись
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS usage (
+            user_id INTEGER PRIMARY KEY,
+            node_id TEXT,
+            status TEXT,
+            used_traffic INTEGER NOT NULL DEFAULT 0,
+            lifetime_used_traffic INTEGER NOT NULL DEFAULT 0,
+            data_limit INTEGER,
+            updated_at INTEGER NOT NULL
+        )
+    ''')
+
+    # Исходящие уведомления и рассылки (outbox.py). Строка удаляется после отправки,
+    # поэтому перезапуск бота не теряет еще не доставленные сообщения.
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    # Рассылки всем пользователям: last_user_id - до кого сообщения уже поставлены в outbox
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            reply_markup TEXT,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            done INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+
+
+# Переносит end_date (ISO-строка) в end_ts пачками по rowid, каждая пачка - своя транзакция,
+# чтобы большая таблица не держала блокировку записи все время переноса.
+# Повторный запуск после сбоя безопасен: переводятся только строки с пустым end_ts.
+async def _end_ts_from_end_date(conn):
+    if 'end_date' not in await _columns(conn, 'accounts'):
+        return
+    last_rowid = 0
+    converted = 0
+    while True:
+        async with conn.execute('''
+            SELECT MAX(rowid), COUNT(*) FROM (
+                SELECT rowid FROM accounts WHERE rowid > ? ORDER BY rowid LIMIT ?
+            )
+        ''', (last_rowid, BATCH_SIZE)) as cursor:
+            batch_end, count = await cursor.fetchone()
+        if not count:
+            break
+        await conn.execute('BEGIN IMMEDIATE')
+        cursor = await conn.execute('''
+            UPDATE accounts SET end_ts = CAST(strftime('%s', end_date) AS INTEGER)
+            WHERE rowid > ? AND rowid <= ? AND end_ts IS NULL AND end_date IS NOT NULL
+        ''', (last_rowid, batch_end))
+        converted += cursor.rowcount
+        await conn.execute('COMMIT')
+        last_rowid = batch_end
+    logging.info("Миграция: срок подписки переведен в end_ts у %s пользователей", converted)
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_accounts_end_ts ON accounts (end_ts)')
+
+
+# end_date больше никто не читает и не пишет: срок хранится только в end_ts.
+# DROP COLUMN появился в SQLite 3.35; на более старых версиях колонка остается пустой.
+async def _drop_end_date(conn):
+    if 'end_date' not in await _columns(conn, 'accounts'):
+        return
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        await conn.execute('ALTER TABLE accounts DROP COLUMN end_date')
+    else:
+        await conn.execute('UPDATE accounts SET end_date = NULL')
+
+
+# Отправленные напоминания об окончании подписки (reminders.py). Ключ включает end_ts:
+# после продления срок меняется, и напоминания для нового срока отправляются заново.
+async def _sent_reminders(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS sent_reminders (
+            user_id INTEGER NOT NULL,
+            end_ts INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            sent_at INTEGER NOT NULL,
+            PRIMARY KEY (user_id, end_ts, kind)
+        ) WITHOUT ROWID
+    ''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_sent_reminders_end_ts ON sent_reminders (end_ts)')
+
+
+# Покрывающий индекс для статистики выручки (admin.py): оплаченные платежи по тарифам
+# читаются из индекса уже сгруппированными, без обращения к таблице и без сортировки
+async def _payments_stats_index(conn):
+    await conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_payments_status_plan ON payments (status, plan, created_at, amount)
+    ''')
+
+
+# file_id картинок с QR-кодом ключа, уже загруженных в Telegram (qr.py), по хэшу ссылки ключа
+async def _qr_file_ids(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS qr_file_ids (
+            key_hash TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+
+# (номер, функция, выполнять ли в одной транзакции вместе с обновлением user_version)
+MIGRATIONS = (
+    (1, _initial_schema, True),
+    (2, _end_ts_from_end_date, False),
+    (3, _drop_end_date, True),
+    (4, _sent_reminders, True),
+    (5, _payments_stats_index, True),
+    (6, _qr_file_ids, True),
+)
+
+
+async def _columns(conn, table):
+    async with conn.execute(f'PRAGMA table_info({table})') as cursor:
+        return [row[1] async for row in cursor]
+
+
+async def _user_version(conn):
+    async with conn.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+# Применяет недостающие миграции на соединении с isolation_level=None.
+# Несколько воркеров могут стартовать одновременно: транзакционные миграции перепроверяют
+# версию под блокировкой записи, а пакетные можно безопасно выполнить повторно.
+async def migrate(conn):
+    for number, migration, transactional in MIGRATIONS:
+        if await _user_version(conn) >= number:
+            continue
+        if transactional:
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                if await _user_version(conn) < number:
+                    await migration(conn)
+                    await conn.execute(f'PRAGMA user_version = {number}')
+            except BaseException:
+                await conn.execute('ROLLBACK')
+                raise
+            else:
+                await conn.execute('COMMIT')
+        else:
+            await migration(conn)
+            await conn.execute(f'PRAGMA user_version = {number}')
+        logging.info("Применена миграция схемы БД %s: %s", number, migration.__name__)
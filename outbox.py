@@ -0,0 +1,327 @@
+import database
+import get_api_token
+from ratelimit import TokenBucket, BucketMap
+
+import asyncio
+import heapq
+import io
+import itertools
+import logging
+import time
+from aiogram.types import InputFile
+from aiogram.utils import exceptions
+
+# Очередь исходящих сообщений. Отправка идет с учетом лимитов Telegram: общий token bucket
+# на бота и по одному на каждый чат. Сообщения с меньшим приоритетом уходят первыми.
+#
+# Ответы пользователю (send) живут только в памяти процесса, который обработал обновление.
+# Уведомления и рассылки (notify, broadcast) сначала пишутся в таблицу outbox, а отправляет их
+# только ведущий процесс (run_pump) - так после перезапуска они не теряются и не дублируются воркерами.
+
+PRIORITY_TRANSACTIONAL = 0  # ключи доступа, результат оплаты
+PRIORITY_REPLY = 1          # обычные ответы на команды и кнопки
+PRIORITY_BULK = 2           # уведомления об истечении, рассылки
+
+# Сколько сообщений подряд можно отправить в один чат, прежде чем сработает лимит чата
+CHAT_BURST = 3
+# Сколько корзин чатов держать в памяти
+MAX_CHAT_BUCKETS = 10000
+# Сколько запросов sendMessage и sendPhoto может выполняться одновременно
+SEND_CONCURRENCY = 20
+# Сколько раз пробовать отправить сообщение при сетевых ошибках и ошибках Telegram
+MAX_ATTEMPTS = 3
+# Ведущий процесс подгружает из outbox новую страницу, когда в памяти остается меньше BULK_LOW_WATER сообщений.
+# Порог меньше страницы: следующая страница успевает загрузиться, пока отправляется остаток предыдущей.
+BULK_LOW_WATER = 200
+PAGE_SIZE = 500
+PUMP_INTERVAL = 1.0
+
+# Получатель заблокировал бота или чата больше нет - повторять бессмысленно
+_UNDELIVERABLE = (
+    exceptions.BotBlocked,
+    exceptions.ChatNotFound,
+    exceptions.UserDeactivated,
+    exceptions.CantInitiateConversation,
+)
+
+
+# photo - картинка вместо текстового сообщения (text тогда подпись): file_id уже загруженной
+# в Telegram картинки или PNG в байтах. document - файл на диске: (путь, имя файла для получателя).
+class _Message:
+    __slots__ = ("chat_id", "text", "parse_mode", "reply_markup", "row_id", "future", "attempts", "photo", "document")
+
+    def __init__(self, chat_id, text, parse_mode=None, reply_markup=None, row_id=None, future=None, photo=None,
+                 document=None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.reply_markup = reply_markup
+        self.row_id = row_id
+        self.future = future
+        self.attempts = 0
+        self.photo = photo
+        self.document = document
+
+
+_bot = None
+# Готовые к отправке: (priority, seq, message); seq сохраняет порядок внутри приоритета
+_queue = []
+# Отложенные лимитом чата или повтором: (ready_at, priority, seq, message)
+_delayed = []
+_seq = itertools.count()
+_wakeup = None
+_global_bucket = None
+_chat_buckets = None
+_semaphore = None
+_sender_task = None
+_in_flight = 0
+# Сколько сообщений из таблицы outbox сейчас в памяти и до какого id они загружены
+_bulk_loaded = 0
+_last_loaded_id = 0
+
+
+def start(bot):
+    global _bot, _wakeup, _global_bucket, _chat_buckets, _semaphore, _sender_task
+    loop = asyncio.get_running_loop()
+    _bot = bot
+    _wakeup = asyncio.Event()
+    _global_bucket = TokenBucket(get_api_token.Telegram_rate, get_api_token.Telegram_rate, loop.time())
+    _chat_buckets = BucketMap(get_api_token.Telegram_chat_rate, CHAT_BURST, MAX_CHAT_BUCKETS)
+    _semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+    _sender_task = asyncio.create_task(_sender())
+
+
+# Ждет, пока уйдут уже поставленные сообщения (не дольше timeout), и останавливает отправку
+async def stop(timeout=5.0):
+    global _sender_task
+    if _sender_task is None:
+        return
+    deadline = time.monotonic() + timeout
+    while (_queue or _delayed or _in_flight) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    _sender_task.cancel()
+    _sender_task = None
+
+
+def _push(priority, seq, message):
+    heapq.heappush(_queue, (priority, seq, message))
+    _wakeup.set()
+
+
+def _push_delayed(ready_at, priority, seq, message):
+    heapq.heappush(_delayed, (ready_at, priority, seq, message))
+    _wakeup.set()
+
+
+# Ставит сообщение в очередь текущего процесса. Возвращает future, которое завершится
+# True после доставки или False, если сообщение доставить не удалось; ждать его не обязательно.
+def send(chat_id, text, priority=PRIORITY_REPLY, parse_mode=None, reply_markup=None):
+    future = asyncio.get_running_loop().create_future()
+    _push(priority, next(_seq), _Message(chat_id, text, parse_mode, reply_markup, future=future))
+    return future
+
+
+# Ставит в очередь картинку: photo - file_id или PNG в байтах. Future завершится file_id
+# картинки в Telegram (по нему ее можно отправить повторно без загрузки) или False.
+def send_photo(chat_id, photo, priority=PRIORITY_REPLY, caption=None, parse_mode=None):
+    future = asyncio.get_running_loop().create_future()
+    _push(priority, next(_seq), _Message(chat_id, caption, parse_mode, future=future, photo=photo))
+    return future
+
+
+# Ставит в очередь файл с диска как документ. Future завершится file_id документа или False;
+# удалять файл можно только после этого.
+def send_document(chat_id, path, filename, priority=PRIORITY_REPLY, caption=None):
+    future = asyncio.get_running_loop().create_future()
+    _push(priority, next(_seq), _Message(chat_id, caption, future=future, document=(path, filename)))
+    return future
+
+
+def _markup_json(reply_markup):
+    if reply_markup is None or isinstance(reply_markup, str):
+        return reply_markup
+    return reply_markup.as_json()
+
+
+# Ставит уведомления в постоянную очередь: messages - пары (chat_id, text).
+# Отправит их ведущий процесс, в том числе после перезапуска.
+async def notify(messages, parse_mode=None, reply_markup=None):
+    if messages:
+        await database.add_outbox_messages(messages, parse_mode, _markup_json(reply_markup), int(time.time()))
+
+
+# Рассылка всем пользователям из accounts. Получатели выбираются страницами
+# по мере отправки, поэтому в памяти никогда не лежит весь список. Возвращает id рассылки.
+async def broadcast(text, parse_mode=None, reply_markup=None):
+    broadcast_id = await database.add_broadcast(text, parse_mode, _markup_json(reply_markup), int(time.time()))
+    logging.info("Рассылка %s поставлена в очередь", broadcast_id)
+    return broadcast_id
+
+
+async def _sender():
+    global _in_flight
+    loop = asyncio.get_running_loop()
+    while True:
+        now = loop.time()
+        while _delayed and _delayed[0][0] <= now:
+            _, priority, seq, message = heapq.heappop(_delayed)
+            heapq.heappush(_queue, (priority, seq, message))
+
+        if not _queue:
+            timeout = _delayed[0][0] - now if _delayed else None
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        priority, seq, message = heapq.heappop(_queue)
+        chat_bucket = _chat_buckets.get(message.chat_id, now)
+        wait = chat_bucket.delay(now)
+        if wait > 0:
+            # Чат исчерпал лимит - откладываем только его сообщение, остальные идут дальше
+            heapq.heappush(_delayed, (now + wait, priority, seq, message))
+            continue
+        wait = _global_bucket.delay(now)
+        if wait > 0:
+            # Общий лимит: возвращаем сообщение и ждем токен. Пришедшее за это время
+            # сообщение с большим приоритетом будет отправлено раньше.
+            heapq.heappush(_queue, (priority, seq, message))
+            await asyncio.sleep(wait)
+            continue
+
+        chat_bucket.consume(now)
+        _global_bucket.consume(now)
+        await _semaphore.acquire()
+        _in_flight += 1
+        asyncio.create_task(_deliver(priority, seq, message))
+
+
+async def _deliver(priority, seq, message):
+    global _in_flight
+    loop = asyncio.get_running_loop()
+    try:
+        if message.photo is not None:
+            result = await _send_photo(message)
+        elif message.document is not None:
+            result = await _send_document(message)
+        else:
+            await _bot.send_message(
+                message.chat_id, message.text,
+                parse_mode=message.parse_mode, reply_markup=message.reply_markup
+            )
+            result = True
+    except exceptions.RetryAfter as e:
+        # Telegram просит подождать: останавливаем всю отправку на указанное время
+        # и возвращаем сообщение на его прежнее место в очереди
+        logging.warning("Telegram просит подождать %s с перед отправкой сообщений", e.timeout)
+        _global_bucket.pause_until(loop.time() + e.timeout)
+        _chat_buckets.get(message.chat_id, loop.time()).pause_until(loop.time() + e.timeout)
+        _push(priority, seq, message)
+    except _UNDELIVERABLE as e:
+        logging.info("Сообщение пользователю %s не доставлено: %s", message.chat_id, e)
+        await _done(message, False)
+    except exceptions.TelegramAPIError as e:
+        message.attempts += 1
+        if message.attempts < MAX_ATTEMPTS:
+            _push_delayed(loop.time() + 2 ** message.attempts, priority, seq, message)
+        else:
+            logging.error("Не удалось отправить сообщение пользователю %s: %s", message.chat_id, e)
+            await _done(message, False)
+    except Exception as e:
+        logging.error("Не удалось отправить сообщение пользователю %s: %s", message.chat_id, e)
+        await _done(message, False)
+    else:
+        await _done(message, result)
+    finally:
+        _in_flight -= 1
+        _semaphore.release()
+
+
+async def _send_photo(message):
+    photo = message.photo
+    if isinstance(photo, bytes):
+        # Файл собирается при каждой попытке: поток прошлой неудачной загрузки уже прочитан
+        photo = InputFile(io.BytesIO(photo), filename='qr.png')
+    sent = await _bot.send_photo(
+        message.chat_id, photo, caption=message.text,
+        parse_mode=message.parse_mode, reply_markup=message.reply_markup
+    )
+    # Telegram хранит несколько размеров, самый большой - последний
+    return sent.photo[-1].file_id
+
+
+async def _send_document(message):
+    path, filename = message.document
+    sent = await _bot.send_document(message.chat_id, InputFile(path, filename=filename), caption=message.text)
+    return sent.document.file_id
+
+
+async def _done(message, delivered):
+    global _bulk_loaded
+    if message.row_id is not None:
+        _bulk_loaded = max(_bulk_loaded - 1, 0)
+        try:
+            await database.delete_outbox_message(message.row_id)
+        except Exception as e:
+            logging.error("Не удалось удалить сообщение %s из outbox: %s", message.row_id, e)
+    if message.future is not None and not message.future.done():
+        message.future.set_result(delivered)
+
+
+# Ставит в outbox очередную страницу незавершенных рассылок
+async def _advance_broadcasts():
+    for broadcast_row in await database.get_active_broadcasts():
+        user_ids = await database.get_recipients(broadcast_row[4], PAGE_SIZE)
+        done = len(user_ids) < PAGE_SIZE
+        await database.enqueue_broadcast_page(broadcast_row, user_ids, done, int(time.time()))
+        if done:
+            logging.info("Рассылка %s полностью поставлена в очередь", broadcast_row[0])
+        # По одной странице за раз: следующую возьмем, когда эта будет отправлена
+        return
+
+
+# Подгружает сообщения из outbox в очередь отправки. Возвращает число загруженных.
+async def _load_outbox():
+    global _bulk_loaded, _last_loaded_id
+    rows = await database.get_outbox_messages(_last_loaded_id, PAGE_SIZE)
+    for row_id, chat_id, text, parse_mode, reply_markup in rows:
+        _push(PRIORITY_BULK, next(_seq), _Message(chat_id, text, parse_mode, reply_markup, row_id=row_id))
+        _last_loaded_id = row_id
+    _bulk_loaded += len(rows)
+    return len(rows)
+
+
+# Убирает из памяти сообщения outbox: после потери лидерства их отправит новый ведущий процесс
+def _drop_bulk():
+    global _queue, _delayed, _bulk_loaded
+    _queue = [item for item in _queue if item[2].row_id is None]
+    _delayed = [item for item in _delayed if item[3].row_id is None]
+    heapq.heapify(_queue)
+    heapq.heapify(_delayed)
+    _bulk_loaded = 0
+
+
+# Фоновая задача ведущего процесса: отправляет постоянную очередь outbox и рассылки,
+# держа в памяти не больше пары страниц сообщений
+async def run_pump():
+    global _last_loaded_id
+    _last_loaded_id = 0
+    try:
+        while True:
+            loaded = 0
+            try:
+                if _bulk_loaded < BULK_LOW_WATER:
+                    loaded = await _load_outbox()
+                    if not loaded:
+                        await _advance_broadcasts()
+                        loaded = await _load_outbox()
+            except Exception as e:
+                logging.error("Ошибка при загрузке очереди outbox: %s", e)
+            if not loaded:
+                await asyncio.sleep(PUMP_INTERVAL)
+            else:
+                await asyncio.sleep(0)
+    finally:
+        _drop_bulk()
@@ -0,0 +1,78 @@
+import get_api_token
+import plans
+import subscriptions
+import yookassa_link
+
+import logging
+from aiohttp import web
+
+_runner = None
+
+
+# Уведомление YooKassa о платеже. YooKassa повторяет уведомление, пока не получит 200,
+# поэтому при временных ошибках отвечаем 5xx, а повторная доставка безопасна:
+# subscriptions.activate применяет каждый payment_id только один раз.
+async def handle_notification(request):
+    try:
+        notification = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    if notification.get("event") != "payment.succeeded":
+        return web.Response(status=200)
+
+    payment_id = (notification.get("object") or {}).get("id")
+    if not payment_id:
+        return web.Response(status=400)
+
+    # Телу уведомления не доверяем: статус и метаданные перечитываем из API YooKassa
+    try:
+        payment = await yookassa_link.get_payment(payment_id)
+    except Exception as e:
+        logging.error("Не удалось получить платеж %s из уведомления: %s", payment_id, e)
+        return web.Response(status=502)
+
+    if payment.get("status") != "succeeded":
+        return web.Response(status=200)
+
+    metadata = payment.get("metadata") or {}
+    plan = plans.get(metadata.get("plan"))
+    if plan is None or not metadata.get("user_id"):
+        logging.error("В платеже %s нет пользователя или тарифа: %s", payment_id, metadata)
+        return web.Response(status=200)
+    user_id = int(metadata["user_id"])
+
+    activation = await subscriptions.activate(
+        request.app["marzban"], user_id, plan.days, payment_id
+    )
+    if activation is None:
+        return web.Response(status=503)
+
+    if activation.applied:
+        # Сами отправляем ключ, не дожидаясь нажатия «Проверить оплату»
+        await subscriptions.notify_activation(user_id, plan.code, activation)
+    return web.Response(status=200)
+
+
+# Добавляет обработчик уведомлений в существующее aiohttp-приложение
+def setup(app, marzban):
+    app["marzban"] = marzban
+    app.router.add_post(get_api_token.Yoo_Webhook_path, handle_notification)
+
+
+# Запускает отдельный HTTP-сервер для уведомлений рядом с диспетчером
+async def start(marzban):
+    global _runner
+    app = web.Application()
+    setup(app, marzban)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, get_api_token.Yoo_Webhook_host, get_api_token.Yoo_Webhook_port).start()
+    logging.info("Прием уведомлений YooKassa на порту %s", get_api_token.Yoo_Webhook_port)
+
+
+async def stop():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,63 @@
+import get_api_token
+
+from dataclasses import dataclass
+from typing import Optional
+
+# Тарифы бота. Список берется из Plans_env (см. get_api_token.py), без него - тарифы ниже.
+# Код тарифа попадает в callback_data кнопок, metadata платежа YooKassa и payments.plan,
+# поэтому у существующего тарифа его не меняют. Снятый с продажи тариф помечают "active": false:
+# он пропадает из меню, но уже созданные платежи по нему продолжают активироваться.
+DEFAULT_PLANS = (
+    {"code": "1month", "title": "1 месяц", "days": 30, "price": 100},
+    {"code": "3month", "title": "3 месяца", "days": 90, "price": 250},
+    {"code": "6month", "title": "6 месяцев", "days": 180, "price": 450},
+)
+
+# Код тарифа вместе с префиксом должен уместиться в 64 байта callback_data Telegram
+MAX_CODE_LENGTH = 32
+
+
+@dataclass(frozen=True)
+class Plan:
+    code: str
+    title: str
+    days: int
+    price: int  # в рублях
+    active: bool = True
+
+
+def _load(config):
+    plans = {}
+    for item in config or DEFAULT_PLANS:
+        plan = Plan(
+            code=str(item["code"]),
+            title=item["title"],
+            days=int(item["days"]),
+            price=int(item["price"]),
+            active=bool(item.get("active", True)),
+        )
+        if not plan.code or len(plan.code.encode()) > MAX_CODE_LENGTH or ":" in plan.code:
+            raise ValueError(f"Недопустимый код тарифа: {plan.code!r}")
+        if plan.code in plans:
+            raise ValueError(f"Тариф {plan.code} указан дважды")
+        plans[plan.code] = plan
+    return plans
+
+
+# Все тарифы по коду в порядке из конфигурации
+PLANS = _load(get_api_token.Plans)
+
+
+def get(code) -> Optional[Plan]:
+    return PLANS.get(code)
+
+
+# Тарифы, которые показываются в меню покупки и продления
+def active():
+    return [plan for plan in PLANS.values() if plan.active]
+
+
+# Название тарифа для сообщений; для неизвестного кода - сам код
+def title(code) -> str:
+    plan = PLANS.get(code)
+    return plan.title if plan else code
@@ -0,0 +1,238 @@
+import database
+import get_api_token
+import metrics
+import outbox
+from cache import TTLCache, MISSING
+from singleflight import SingleFlight
+
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    import qrcode
+    import png  # noqa: F401 - pypng, через него PyPNGImage пишет PNG без Pillow
+    from qrcode.image.pure import PyPNGImage
+except ImportError:
+    # qrcode[png] - необязательная зависимость: без нее ключи отправляются только текстом
+    qrcode = None
+
+# QR-коды ключа доступа отправляются картинками следом за текстом ключа, чтобы ключ можно было
+# отсканировать в приложении, а не копировать вручную. Ключ из accounts - это до двух ссылок ss://
+# через перевод строки (subscriptions._issue_key), приложение импортирует их по одной,
+# поэтому QR-код рисуется для каждой ссылки отдельно.
+#
+# Картинка рисуется в отдельном процессе (построение матрицы и сжатие PNG занимают процессор
+# и держали бы event loop), сохраняется в каталог Qr_cache_dir и в LRU в памяти по хэшу ссылки,
+# а после первой отправки ее file_id записывается в БД: дальше Telegram получает только file_id.
+# PNG на диске содержит ссылку в открытом виде, поэтому каталог ограничен DISK_CACHE_MAX_FILES
+# файлами, а при истечении подписки картинки и file_id ее ключа удаляются (forget).
+
+QR_CAPTION = "QR-код ключа: отсканируйте его в приложении вместо ввода ключа вручную"
+# Размер модуля QR-кода в пикселях и ширина белой рамки в модулях
+QR_BOX_SIZE = 8
+QR_BORDER = 2
+# Сколько PNG и file_id держать в памяти процесса и как долго
+PNG_CACHE_SIZE = 256
+FILE_ID_CACHE_SIZE = 10000
+CACHE_TTL = 3600
+# Сколько картинок хранить на диске; лишние, давно не читавшиеся, удаляются.
+# Проверка идет не чаще раза в DISK_PRUNE_INTERVAL секунд в каждом процессе пула.
+DISK_CACHE_MAX_FILES = 5000
+DISK_PRUNE_INTERVAL = 60
+
+_png_cache = TTLCache("qr_png", PNG_CACHE_SIZE, CACHE_TTL)
+_file_id_cache = TTLCache("qr_file_id", FILE_ID_CACHE_SIZE, CACHE_TTL)
+# Одновременные запросы одной ссылки (повторные нажатия) ждут одну отрисовку
+_renders = SingleFlight()
+_pool = None
+# Ссылки на фоновые задачи отправки, чтобы их не собрал сборщик мусора
+_tasks = set()
+# Когда процесс пула последний раз проверял размер каталога
+_pruned_at = 0.0
+
+
+def available() -> bool:
+    return qrcode is not None
+
+
+def key_hash(link) -> str:
+    return hashlib.sha256(link.encode()).hexdigest()
+
+
+# Отдельные ссылки ключа доступа. Строки, не похожие на ссылку, пропускаются: в старых записях
+# accounts вторая строка ключа - "False", когда Marzban вернул одну ссылку.
+def _links(access_key):
+    return [line.strip() for line in access_key.splitlines() if '://' in line]
+
+
+def _cache_path(digest):
+    return os.path.join(get_api_token.Qr_cache_dir, f"{digest}.png")
+
+
+# Выполняется в процессе пула: PNG с диска или новая картинка, которая сразу сохраняется на диск.
+# Возвращает (PNG, взят ли он с диска).
+def _render(link, path):
+    try:
+        with open(path, 'rb') as cached:
+            data = cached.read()
+        # Время изменения - время последнего чтения: по нему _prune удаляет давно не нужные
+        os.utime(path)
+        return data, True
+    except FileNotFoundError:
+        pass
+    image = qrcode.make(
+        link, box_size=QR_BOX_SIZE, border=QR_BORDER,
+        error_correction=qrcode.constants.ERROR_CORRECT_M, image_factory=PyPNGImage,
+    )
+    output = io.BytesIO()
+    image.save(output)
+    data = output.getvalue()
+    # Запись через временный файл: другой воркер не прочитает недописанную картинку
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as temp:
+        temp.write(data)
+    os.replace(temp_path, path)
+    _prune(directory)
+    return data, False
+
+
+# Выполняется в процессе пула: оставляет в каталоге не больше DISK_CACHE_MAX_FILES картинок
+def _prune(directory):
+    global _pruned_at
+    now = time.monotonic()
+    if now - _pruned_at < DISK_PRUNE_INTERVAL:
+        return
+    _pruned_at = now
+    with os.scandir(directory) as entries:
+        files = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith('.png')]
+    if len(files) <= DISK_CACHE_MAX_FILES:
+        return
+    files.sort()
+    for _, path in files[:len(files) - DISK_CACHE_MAX_FILES]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        # spawn, а не fork: в процессе бота уже работают потоки (aiosqlite, вывод логов)
+        _pool = ProcessPoolExecutor(
+            max_workers=get_api_token.Qr_workers, mp_context=multiprocessing.get_context('spawn')
+        )
+    return _pool
+
+
+# PNG с QR-кодом одной ссылки: из памяти, с диска или новый
+async def render(link, digest=None):
+    digest = digest or key_hash(link)
+    data = _png_cache.get(digest)
+    if data is not MISSING:
+        return data
+
+    async def load():
+        global _pool
+        started = time.perf_counter()
+        try:
+            rendered, from_disk = await asyncio.get_running_loop().run_in_executor(
+                _get_pool(), _render, link, _cache_path(digest)
+            )
+        except BrokenProcessPool:
+            # Процесс пула упал - следующая отрисовка создаст пул заново
+            _pool = None
+            raise
+        metrics.QR_RENDER_SECONDS.observe(time.perf_counter() - started, "disk" if from_disk else "render")
+        _png_cache.set(digest, rendered)
+        return rendered
+
+    data, _ = await _renders.do(digest, load)
+    return data
+
+
+async def _file_id(digest):
+    file_id = _file_id_cache.get(digest)
+    if file_id is MISSING:
+        file_id = await database.get_qr_file_id(digest)
+        if file_id is not None:
+            _file_id_cache.set(digest, file_id)
+    return file_id
+
+
+async def _send(chat_id, link, priority, caption):
+    digest = key_hash(link)
+    try:
+        file_id = await _file_id(digest)
+        if file_id is not None:
+            outbox.send_photo(chat_id, file_id, priority, caption=caption)
+            return
+        data = await render(link, digest)
+    except Exception as e:
+        logging.error("Не удалось подготовить QR-код для пользователя %s: %s", chat_id, e)
+        return
+    file_id = await outbox.send_photo(chat_id, data, priority, caption=caption)
+    if file_id:
+        _file_id_cache.set(digest, file_id)
+        try:
+            await database.set_qr_file_id(digest, file_id, int(time.time()))
+        except Exception as e:
+            logging.error("Не удалось сохранить file_id QR-кода: %s", e)
+
+
+# Ссылки отправляются по очереди, чтобы картинки пришли в том же порядке, что и ключи в тексте
+async def _send_all(chat_id, links, priority):
+    for number, link in enumerate(links, 1):
+        caption = QR_CAPTION if len(links) == 1 else f"{QR_CAPTION} ({number} из {len(links)})"
+        await _send(chat_id, link, priority, caption)
+
+
+# Ставит в очередь картинки с QR-кодом каждой ссылки ключа. Как и outbox.send, не ждет отправки:
+# отрисовка и загрузка идут в фоне. Без пакета qrcode ничего не делает.
+def send(chat_id, access_key, priority=outbox.PRIORITY_REPLY):
+    if qrcode is None or not access_key:
+        return
+    task = asyncio.create_task(_send_all(chat_id, _links(access_key), priority))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+# Удаляет картинки и file_id снятых ключей (при истечении подписки). Кэши в памяти других
+# воркеров очищаются сами через CACHE_TTL.
+async def forget(access_keys):
+    digests = [key_hash(link) for access_key in access_keys if access_key for link in _links(access_key)]
+    if not digests:
+        return
+    for digest in digests:
+        _png_cache.invalidate(digest)
+        _file_id_cache.invalidate(digest)
+    try:
+        await asyncio.to_thread(_remove_files, [_cache_path(digest) for digest in digests])
+        await database.delete_qr_file_ids(digests)
+    except Exception as e:
+        logging.error("Не удалось удалить QR-коды истекших ключей: %s", e)
+
+
+# Останавливает процессы пула при остановке бота
+def stop():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
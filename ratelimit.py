@@ -0,0 +1,78 @@
+from collections import OrderedDict
+
+
+# Классический token bucket: capacity токенов, пополняется со скоростью rate токенов в секунду.
+# Время передается явно (loop.time() или time.monotonic()), чтобы корзина не зависела от часов.
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    # Через сколько секунд будет доступно cost токенов (0 - уже доступно)
+    def delay(self, now, cost=1):
+        if now < self.updated:
+            # Корзина на паузе (pause_until)
+            return self.updated - now + max(cost - self.tokens, 0) / self.rate
+        self._refill(now)
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+    def consume(self, now, cost=1):
+        if now < self.updated:
+            return False
+        self._refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    # Запрещает расход до момента until (например, после RetryAfter от Telegram),
+    # после чего корзина начинает с одного токена
+    def pause_until(self, until):
+        self.tokens = min(1, self.capacity)
+        self.updated = max(self.updated, until)
+
+
+# Корзины по ключу (чат, пользователь) с ограничением по памяти: при превышении max_size
+# выбрасываются дольше всех не использовавшиеся. Корзина, которая простаивала достаточно долго,
+# чтобы наполниться, ничем не отличается от новой, поэтому такие выбрасываются сразу.
+class BucketMap:
+
+    def __init__(self, rate, capacity, max_size):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def get(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            self._evict_idle(now)
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    # Выбрасывает из начала (давно не использованные) корзины, которые уже успели наполниться
+    def _evict_idle(self, now):
+        refill_time = self.capacity / self.rate
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if now - bucket.updated < refill_time:
+                break
+            self._buckets.popitem(last=False)
@@ -0,0 +1,102 @@
+import database
+import plans
+import subscriptions
+import yookassa_link
+
+import asyncio
+import logging
+import time
+
+# Как часто просыпается сверка и сколько платежей проверяет за один проход
+RECONCILE_INTERVAL = 15
+RECONCILE_BATCH_SIZE = 100
+# Одновременных запросов к YooKassa и не больше стольких запросов в секунду
+RECONCILE_CONCURRENCY = 10
+RECONCILE_RATE = 20
+# Интервал между проверками одного платежа растет вдвое с каждой попыткой, но не больше часа
+MAX_CHECK_INTERVAL = 3600
+# Через сколько платеж без оплаты считается брошенным
+PAYMENT_TTL = 24 * 3600
+
+
+def _next_check_delay(attempts):
+    return min(yookassa_link.FIRST_CHECK_DELAY * 2 ** attempts, MAX_CHECK_INTERVAL)
+
+
+class _RateLimiter:
+    # Равномерно распределяет запросы: не больше rate стартов в секунду
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+async def _reconcile_payment(marzban, payment_id, user_id, plan, attempts):
+    now = int(time.time())
+    try:
+        payment = await yookassa_link.get_payment(payment_id)
+    except Exception as e:
+        logging.error("Сверка: не удалось получить платеж %s: %s", payment_id, e)
+        await database.reschedule_payment(payment_id, now + _next_check_delay(attempts))
+        return
+
+    status = payment.get("status")
+    if status == "succeeded":
+        if plans.get(plan) is None:
+            logging.error("Сверка: тариф %s платежа %s не найден в конфигурации", plan, payment_id)
+            await database.reschedule_payment(payment_id, now + _next_check_delay(attempts))
+            return
+        # Тот же путь, что и у кнопки «Проверить оплату» и вебхука
+        activation = await subscriptions.activate(marzban, user_id, plans.get(plan).days, payment_id)
+        if activation is None:
+            await database.reschedule_payment(payment_id, now + _next_check_delay(attempts))
+            return
+        await database.set_payment_status(payment_id, "succeeded")
+        if activation.applied:
+            logging.info("Сверка: платеж %s пользователя %s оплачен, подписка продлена", payment_id, user_id)
+            await subscriptions.notify_activation(user_id, plan, activation)
+    elif status == "canceled":
+        await database.set_payment_status(payment_id, "canceled")
+    else:
+        await database.reschedule_payment(payment_id, now + _next_check_delay(attempts))
+
+
+# Один проход сверки: помечает брошенные платежи и проверяет те, чей срок проверки наступил.
+# Возвращает число проверенных платежей.
+async def reconcile_once(marzban, limiter=None):
+    now = int(time.time())
+    expired = await database.expire_payments(now - PAYMENT_TTL)
+    if expired:
+        logging.info("Сверка: %s неоплаченных платежей помечены как брошенные", expired)
+
+    rows = await database.get_due_payments(now, RECONCILE_BATCH_SIZE)
+    limiter = limiter or _RateLimiter(RECONCILE_RATE)
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+
+    async def check(row):
+        async with semaphore:
+            await limiter.wait()
+            await _reconcile_payment(marzban, *row)
+
+    await asyncio.gather(*(check(row) for row in rows))
+    return len(rows)
+
+
+# Фоновая задача: проверяет ожидающие платежи, пока не останется тех, чей срок проверки наступил
+async def run(marzban):
+    limiter = _RateLimiter(RECONCILE_RATE)
+    while True:
+        try:
+            checked = await reconcile_once(marzban, limiter)
+        except Exception as e:
+            logging.error("Ошибка при сверке платежей: %s", e)
+            checked = 0
+        if checked < RECONCILE_BATCH_SIZE:
+            await asyncio.sleep(RECONCILE_INTERVAL)
@@ -0,0 +1,66 @@
+import callbacks
+import database
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+# Как часто искать подписки, которым пора напомнить, в секундах
+REMINDER_INTERVAL = 60
+# Сколько подписок выбирать и ставить в очередь за один раз
+REMINDER_BATCH_SIZE = 500
+# Сколько хранить записи об отправленных напоминаниях после окончания срока
+SENT_REMINDERS_TTL = 7 * 86400
+
+# (вид, за сколько секунд до окончания, текст). От большего срока к меньшему: окно напоминания
+# заканчивается там, где начинается окно следующего, поэтому подписка, купленная за 20 часов
+# до окончания, получит только напоминания за день и за час.
+REMINDERS = (
+    ('3d', 3 * 86400, "Ваша подписка на VPN закончится {date}. Продлите ее заранее:"),
+    ('1d', 86400, "Ваша подписка на VPN закончится меньше чем через сутки, {date}. Продлите ее, чтобы не остаться без доступа:"),
+    ('1h', 3600, "Ваша подписка на VPN закончится меньше чем через час. Продлите ее, чтобы не остаться без доступа:"),
+)
+
+
+# Ставит в очередь напоминания вида kind для сроков в (after, until] страницами по REMINDER_BATCH_SIZE.
+# Возвращает число поставленных напоминаний.
+async def _queue_reminders(kind, text, after, until, now):
+    after_ts, after_user_id = -1, -1
+    queued = 0
+    while True:
+        rows = await database.get_due_reminders(kind, after, until, after_ts, after_user_id, REMINDER_BATCH_SIZE)
+        if not rows:
+            break
+        reminders = [
+            (user_id, end_ts, text.format(date=datetime.fromtimestamp(end_ts, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')))
+            for user_id, end_ts in rows
+        ]
+        queued += await database.add_reminders(kind, reminders, None, callbacks.renew_keyboard(), now)
+        after_ts, after_user_id = rows[-1][1], rows[-1][0]
+        if len(rows) < REMINDER_BATCH_SIZE:
+            break
+    return queued
+
+
+# Один проход по всем видам напоминаний. Возвращает {вид: число поставленных в очередь}.
+async def remind_once(now=None):
+    now = now or int(time.time())
+    queued = {}
+    for index, (kind, offset, text) in enumerate(REMINDERS):
+        lower = REMINDERS[index + 1][1] if index + 1 < len(REMINDERS) else 0
+        queued[kind] = await _queue_reminders(kind, text, now + lower, now + offset, now)
+    if any(queued.values()):
+        logging.info("Напоминания об окончании подписки поставлены в очередь: %s", queued)
+    return queued
+
+
+# Фоновая задача ведущего процесса; сами сообщения отправляет очередь outbox
+async def run():
+    while True:
+        try:
+            await remind_once()
+            await database.delete_old_reminders(int(time.time()) - SENT_REMINDERS_TTL)
+        except Exception as e:
+            logging.error("Ошибка при отправке напоминаний: %s", e)
+        await asyncio.sleep(REMINDER_INTERVAL)
@@ -0,0 +1,23 @@
+import asyncio
+
+
+# Объединяет одновременные одинаковые вызовы: пока по ключу выполняется запрос,
+# повторные вызовы с тем же ключом не запускают его заново, а ждут тот же результат.
+class SingleFlight:
+
+    def __init__(self):
+        self._calls = {}
+
+    def in_flight(self, key) -> bool:
+        return key in self._calls
+
+    # Возвращает (результат, shared); shared=True, если результат получен из чужого вызова
+    async def do(self, key, fn):
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = asyncio.ensure_future(fn())
+        self._calls[key] = future
+        future.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(future), False
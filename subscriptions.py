@@ -0,0 +1,167 @@
+import database
+import outbox
+import plans
+import qr
+from cache import TTLCache, MISSING
+from marzban_backend import MarzbanConflict, MarzbanError
+from singleflight import SingleFlight
+
+import logging
+import time
+from dataclasses import dataclass, replace
+from datetime import datetime, timezone
+from typing import Optional
+
+# Сколько пользователей держать в кэше статуса подписки и сколько секунд доверять записи.
+# Кэш свой у каждого процесса: запись, сделанная другим воркером, станет видна не позже чем через TTL.
+STATUS_CACHE_SIZE = 10000
+STATUS_CACHE_TTL = 60
+# Сколько раз повторить применение платежа, если ключ в БД изменился во время активации
+APPLY_ATTEMPTS = 3
+
+# Активации, которые выполняются прямо сейчас, по payment_id
+_activations = SingleFlight()
+
+# user_id -> SubscriptionStatus или None, если пользователя нет в БД
+_status_cache = TTLCache("subscription_status", STATUS_CACHE_SIZE, STATUS_CACHE_TTL)
+
+
+# Итог активации: новая дата окончания, ключ доступа и был ли платеж применен именно сейчас
+@dataclass
+class Activation:
+    end_date: datetime
+    access_key: str
+    applied: bool
+
+
+# Срок окончания (None - подписки нет) и ключ доступа, как они записаны в accounts,
+# и трафик по последней синхронизации с Marzban (None - еще не синхронизирован)
+@dataclass(frozen=True)
+class SubscriptionStatus:
+    end_date: Optional[datetime]
+    access_key: Optional[str]
+    used_traffic: Optional[int] = None
+    data_limit: Optional[int] = None
+
+
+# Статус подписки пользователя: из кэша, а при промахе - из БД.
+# Возвращает SubscriptionStatus или None, если пользователя нет в БД.
+async def get_status(user_id):
+    status = _status_cache.get(user_id)
+    if status is not MISSING:
+        return status
+
+    generation = _status_cache.generation
+    status = await _load_status(user_id)
+    if _status_cache.generation == generation:
+        _status_cache.set(user_id, status)
+    return status
+
+
+# Статус подписки прямо из БД, мимо кэша
+async def _load_status(user_id):
+    result = await database.get_subscription(user_id)
+    if result is None:
+        return None
+    end_date = datetime.fromtimestamp(result[0], timezone.utc) if result[0] else None
+    return SubscriptionStatus(end_date, result[1], result[2], result[3])
+
+
+# Сбрасывает кэш статуса после любой записи в подписку пользователя
+def invalidate(user_id):
+    _status_cache.invalidate(user_id)
+
+
+# Создает пользователя в Marzban и возвращает ключ доступа или None.
+# Если пользователь уже есть (подписка истекала и он был отключен) - включает его обратно.
+# Пользователь остается на своем узле пула, новый - размещается на наименее нагруженном.
+async def _issue_key(marzban, user_id):
+    name = f"user_{user_id}"
+    node_id = await database.get_node_id(user_id)
+    if node_id is None or node_id not in marzban.nodes or not marzban.healthy(node_id):
+        node_id = marzban.place()
+    backend = marzban.node(node_id)
+    try:
+        try:
+            response = await backend.create_user(name)
+        except MarzbanConflict:
+            response = await backend.enable_user(name)
+    except MarzbanError as e:
+        logging.error("Ошибка Marzban при выдаче ключа пользователю %s на узле %s: %s", user_id, node_id, e)
+        return None
+    key_list = response.get("links", [])
+    if not key_list:
+        logging.error("Не удалось получить ключ доступа для пользователя %s на узле %s", user_id, node_id)
+        return None
+    await database.set_node_id(user_id, node_id)
+    return '\n'.join(key_list[:2])
+
+
+# Продлевает подписку по оплаченному платежу. Общий путь для кнопки «Проверить оплату»,
+# вебхука YooKassa и фоновой сверки: повторный вызов с тем же payment_id подписку не продлевает,
+# а одновременные вызовы (вебхук пришел, пока пользователь жмет кнопку) выполняются один раз.
+# Возвращает Activation или None, если не удалось выдать ключ.
+async def activate(marzban, user_id, days, payment_id):
+    activation, shared = await _activations.do(
+        payment_id, lambda: _activate(marzban, user_id, days, payment_id)
+    )
+    if shared and activation is not None:
+        # Об уже примененном платеже сообщает тот, кто его применил
+        activation = replace(activation, applied=False)
+    return activation
+
+
+async def _activate(marzban, user_id, days, payment_id):
+    for _ in range(APPLY_ATTEMPTS):
+        # Статус читается из БД, а не из кэша: ведущий процесс другого воркера мог уже снять истекшую
+        # подписку и отключить пользователя в Marzban, а продлевать с закэшированным старым ключом нельзя
+        status = await _load_status(user_id)
+        read_key = status.access_key if status else None
+        if await database.is_payment_applied(payment_id):
+            break
+
+        # Если ключ отсутствует, создаем пользователя в системе Marzban (или включаем отключенного)
+        access_key = read_key
+        if not access_key:
+            access_key = await _issue_key(marzban, user_id)
+            if access_key is None:
+                return None
+
+        end_ts = await database.apply_payment(payment_id, user_id, days, access_key, read_key, int(time.time()))
+        invalidate(user_id)
+        if end_ts is database.KEY_CHANGED:
+            # Подписку сняли между чтением и записью: пользователь отключен в Marzban,
+            # поэтому старый ключ записывать нельзя - читаем заново и выдаем ключ снова
+            logging.warning("Ключ пользователя %s изменился во время применения платежа %s, повторяем", user_id, payment_id)
+            continue
+        if end_ts is not None:
+            logging.info("Платеж %s применен: подписка пользователя %s продлена на %s дн.", payment_id, user_id, days)
+            return Activation(datetime.fromtimestamp(end_ts, timezone.utc), access_key, True)
+        break
+    else:
+        logging.error("Не удалось применить платеж %s пользователя %s: ключ все время меняется", payment_id, user_id)
+        return None
+
+    # Платеж уже применен ранее - возвращаем текущее состояние подписки
+    status = await _load_status(user_id)
+    if not status or not status.end_date:
+        return None
+    return Activation(status.end_date, status.access_key, False)
+
+
+def activation_text(duration, activation):
+    return (
+        f"Оплата прошла успешно! Ваша подписка на {duration} активирована до {activation.end_date.strftime('%Y-%m-%d')}.\n\n"
+        f"Ваш ключ доступа (его нужно ввести в Outline):\n\n"
+        f"<code>{activation.access_key}</code>"
+    )
+
+
+# Сообщает пользователю о продлении подписки без нажатия кнопки (вебхук, фоновая сверка).
+# Ключ и его QR-код уходят через очередь outbox раньше рассылок и уведомлений.
+async def notify_activation(user_id, plan, activation):
+    outbox.send(
+        user_id, activation_text(plans.title(plan), activation),
+        priority=outbox.PRIORITY_TRANSACTIONAL, parse_mode='HTML'
+    )
+    qr.send(user_id, activation.access_key, outbox.PRIORITY_TRANSACTIONAL)
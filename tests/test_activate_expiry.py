@@ -0,0 +1,81 @@
+# Регрессия: проверка истекших подписок, прошедшая между чтением ключа и применением платежа,
+# не должна оставить оплаченную подписку со старым ключом и отключенным в Marzban пользователем.
+# Запуск: python -m pytest -q tests
+
+import asyncio
+import time
+
+import database
+import subscriptions
+from marzban_backend import MarzbanConflict
+
+USER_ID = 42
+NAME = f"user_{USER_ID}"
+
+
+class FakeNode:
+    def __init__(self):
+        self.enabled = {NAME: True}
+
+    async def create_user(self, name):
+        if name in self.enabled:
+            raise MarzbanConflict("exists")
+        self.enabled[name] = True
+        return {"links": ["ss://new"]}
+
+    async def enable_user(self, name):
+        self.enabled[name] = True
+        return {"links": ["ss://new"]}
+
+
+class FakePool:
+    def __init__(self):
+        self.backend = FakeNode()
+        self.nodes = {"default": self.backend}
+
+    def healthy(self, node_id):
+        return True
+
+    def place(self):
+        return "default"
+
+    def node(self, node_id):
+        return self.backend
+
+
+def test_expiry_between_read_and_apply_reissues_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "tg.db"))
+    marzban = FakePool()
+    is_payment_applied = database.is_payment_applied
+    expired = []
+
+    # Проверка истекших срабатывает ровно после того, как _activate прочитал старый ключ
+    async def expire_then_check(payment_id):
+        if not expired:
+            now = int(time.time())
+            marzban.backend.enabled[NAME] = False
+            expired.extend(await database.expire_users([USER_ID], now))
+        return await is_payment_applied(payment_id)
+
+    monkeypatch.setattr(database, "is_payment_applied", expire_then_check)
+
+    async def run():
+        await database.db_start()
+        try:
+            async with database.transaction() as conn:
+                await conn.execute(
+                    "INSERT INTO accounts (user_id, end_ts, access_key, node_id) VALUES (?, ?, ?, ?)",
+                    (USER_ID, int(time.time()) - 10, "ss://old", "default"),
+                )
+            activation = await subscriptions.activate(marzban, USER_ID, 30, "payment-1")
+            return activation, await database.get_subscription(USER_ID)
+        finally:
+            await database.db_close()
+
+    activation, row = asyncio.run(run())
+    assert expired == [(USER_ID, "ss://old")]
+    assert activation is not None and activation.applied
+    assert activation.access_key == "ss://new"
+    assert row[1] == "ss://new"
+    assert row[0] > time.time() + 29 * 86400
+    assert marzban.backend.enabled[NAME]
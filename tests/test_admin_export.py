@@ -0,0 +1,55 @@
+# Выгрузка уходит в личный чат администратора (from_user), а не в чат, указанный в обновлении:
+# команда из чужого или группового чата не должна отдавать туда таблицы пользователей и платежей.
+# Запуск: python -m pytest -q tests
+
+import asyncio
+import os
+import tempfile
+
+from aiogram import types
+
+import admin
+import get_api_token
+
+ADMIN_ID = 1001
+OTHER_CHAT_ID = -5005
+
+
+def _message(text):
+    return types.Message(**{
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": OTHER_CHAT_ID, "type": "group", "title": "chat"},
+        "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"},
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+    })
+
+
+def test_export_goes_to_admin_not_to_update_chat(monkeypatch):
+    texts = []
+    documents = []
+
+    async def write_export(table):
+        fd, path = tempfile.mkstemp(suffix='.csv.gz')
+        os.close(fd)
+        return path, 0
+
+    async def send_document(chat_id, path, filename, priority=None, caption=None):
+        documents.append(chat_id)
+        return "file_id"
+
+    monkeypatch.setattr(get_api_token, "Admin_ids", {ADMIN_ID})
+    monkeypatch.setattr(admin, "write_export", write_export)
+    monkeypatch.setattr(admin.outbox, "send", lambda chat_id, text, *args, **kwargs: texts.append(chat_id))
+    monkeypatch.setattr(admin.outbox, "send_document", send_document)
+
+    async def run():
+        message = _message("/export payments")
+        assert admin.is_admin(message)
+        await admin.export_command(message)
+        await asyncio.gather(*admin._exports.values())
+
+    asyncio.run(run())
+    assert documents == [ADMIN_ID]
+    assert set(texts) == {ADMIN_ID}
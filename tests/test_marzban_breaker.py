@@ -0,0 +1,92 @@
+# Регрессия: пробный запрос полуоткрытого автомата, не давший исхода (429, отмена),
+# не должен оставлять автомат разомкнутым навсегда.
+# Запуск: python -m pytest -q tests
+
+import asyncio
+import time
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from marzban_backend import MarzbanBackend, MarzbanUnavailable
+
+
+def _app(state):
+    async def admin_token(request):
+        if state["login"] != 200:
+            return web.json_response({"detail": "Too Many Requests"}, status=state["login"])
+        return web.json_response({"access_token": "token"})
+
+    async def system(request):
+        await asyncio.sleep(state["delay"])
+        if state["system"] != 200:
+            return web.json_response({"detail": "Too Many Requests"}, status=state["system"])
+        return web.json_response({"users_active": 1})
+
+    app = web.Application()
+    app.router.add_post("/api/admin/token", admin_token)
+    app.router.add_get("/api/system", system)
+    return app
+
+
+# Состояние после reset_timeout: автомат разомкнут, но готов пропустить пробный запрос
+def _half_open(backend):
+    backend.breaker.opened_at = time.monotonic() - backend.breaker.reset_timeout - 1
+
+
+async def _run(scenario, token="token"):
+    state = {"login": 200, "system": 200, "delay": 0.0}
+    server = TestServer(_app(state))
+    await server.start_server()
+    backend = MarzbanBackend(token=token, url=str(server.make_url("")).rstrip("/"), username="u", password="p")
+    try:
+        _half_open(backend)
+        await scenario(backend, state)
+        # Следующий запрос снова пробный и, получив ответ, замыкает автомат
+        state.update(login=200, system=200, delay=0.0)
+        backend.backoff = 0.0
+        assert await backend.get_system() == {"users_active": 1}
+        assert not backend.breaker.is_open and backend.breaker.opened_at is None
+    finally:
+        await backend.close()
+        await server.close()
+
+
+def test_probe_429_releases_trial():
+    async def scenario(backend, state):
+        state["system"] = 429
+        try:
+            await backend.get_system()
+        except MarzbanUnavailable as e:
+            assert e.status == 429
+        else:
+            raise AssertionError("ожидался MarzbanUnavailable")
+
+    asyncio.run(_run(scenario))
+
+
+def test_login_429_during_probe_releases_trial():
+    async def scenario(backend, state):
+        state["login"] = 429
+        try:
+            await backend.get_system()
+        except MarzbanUnavailable as e:
+            assert e.status == 429
+        else:
+            raise AssertionError("ожидался MarzbanUnavailable")
+
+    asyncio.run(_run(scenario, token=None))
+
+
+def test_cancelled_probe_releases_trial():
+    async def scenario(backend, state):
+        # Как проверка здоровья пула: wait_for отменяет запрос раньше таймаута сессии
+        state["delay"] = 1.0
+        try:
+            await asyncio.wait_for(backend.get_system(), 0.1)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("ожидался таймаут")
+
+    asyncio.run(_run(scenario))
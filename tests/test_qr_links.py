@@ -0,0 +1,35 @@
+# Для ключа рисуется QR-код только для строк-ссылок: в старых записях accounts вторая строка - "False".
+# Запуск: python -m pytest -q tests
+
+import asyncio
+
+import qr
+
+
+def _sent(monkeypatch, access_key):
+    sent = []
+
+    async def send(chat_id, link, priority, caption):
+        sent.append((link, caption))
+
+    # Пакет qrcode не нужен: сама отрисовка подменена
+    monkeypatch.setattr(qr, "qrcode", object())
+    monkeypatch.setattr(qr, "_send", send)
+
+    async def run():
+        qr.send(1, access_key)
+        await asyncio.gather(*qr._tasks)
+
+    asyncio.run(run())
+    return sent
+
+
+def test_legacy_false_line_is_skipped(monkeypatch):
+    sent = _sent(monkeypatch, "ss://Y2hhY2hhMjA@1.2.3.4:443#vpn\nFalse")
+    assert sent == [("ss://Y2hhY2hhMjA@1.2.3.4:443#vpn", qr.QR_CAPTION)]
+
+
+def test_each_link_gets_own_code(monkeypatch):
+    sent = _sent(monkeypatch, "ss://a@1.2.3.4:443#a\nss://b@5.6.7.8:443#b\n")
+    assert [link for link, _ in sent] == ["ss://a@1.2.3.4:443#a", "ss://b@5.6.7.8:443#b"]
+    assert sent[0][1].endswith("(1 из 2)") and sent[1][1].endswith("(2 из 2)")
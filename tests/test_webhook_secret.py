@@ -0,0 +1,68 @@
+# Обновления Telegram без секрета вебхука (или с чужим) отклоняются до диспетчера,
+# чтобы нельзя было выполнить обработчики от имени произвольного пользователя.
+# Запуск: python -m pytest -q tests
+
+import asyncio
+
+from aiogram import Bot, Dispatcher
+from aiogram.dispatcher.webhook import BOT_DISPATCHER_KEY, WebhookRequestHandler
+from aiohttp import ClientSession, web
+from aiohttp.test_utils import TestServer
+
+import main
+
+PATH = "/telegram/webhook"
+SECRET = "test-secret"
+
+UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 0,
+        "chat": {"id": 1001, "type": "private"},
+        "from": {"id": 1001, "is_bot": False, "first_name": "admin"},
+        "text": "/stats",
+    },
+}
+
+
+async def _post(headers):
+    seen = []
+    bot = Bot("123456:TESTtestTESTtest")
+    dp = Dispatcher(bot)
+
+    async def handler(message):
+        seen.append(message.from_user.id)
+
+    dp.register_message_handler(handler)
+    app = web.Application(middlewares=[main.telegram_secret_middleware(PATH, SECRET)])
+    app[BOT_DISPATCHER_KEY] = dp
+    app.router.add_route("*", PATH, WebhookRequestHandler)
+    server = TestServer(app)
+    await server.start_server()
+    try:
+        async with ClientSession() as session:
+            async with session.post(server.make_url(PATH), json=UPDATE, headers=headers) as response:
+                status = response.status
+    finally:
+        await server.close()
+        await (await bot.get_session()).close()
+    return status, seen
+
+
+def test_update_without_secret_is_rejected():
+    status, seen = asyncio.run(_post({}))
+    assert status == 401
+    assert seen == []
+
+
+def test_update_with_wrong_secret_is_rejected():
+    status, seen = asyncio.run(_post({main.TELEGRAM_SECRET_HEADER: "guess"}))
+    assert status == 401
+    assert seen == []
+
+
+def test_update_with_secret_reaches_dispatcher():
+    status, seen = asyncio.run(_post({main.TELEGRAM_SECRET_HEADER: SECRET}))
+    assert status == 200
+    assert seen == [1001]
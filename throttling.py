@@ -0,0 +1,85 @@
+from ratelimit import TokenBucket, BucketMap
+
+import logging
+import time
+from aiogram.dispatcher.handler import current_handler, CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+# Общий лимит на пользователя по всем обработчикам: USER_RATE токенов в секунду, запас USER_BURST
+USER_RATE = 1.0
+USER_BURST = 10
+# Сколько токенов общего лимита стоит вызов обработчика (по умолчанию 1).
+# Дорогие обработчики ходят в YooKassa и Marzban.
+HANDLER_COSTS = {
+    'handle_subscription_choice': 3,     # создает платеж в YooKassa
+    'check_payment_status_handler': 2,   # запрашивает платеж в YooKassa и активирует ключ
+}
+# Отдельный лимит пользователя на дорогой обработчик: (токенов в секунду, запас)
+USER_HANDLER_LIMITS = {
+    'handle_subscription_choice': (1 / 20, 3),
+    'check_payment_status_handler': (1 / 5, 3),
+}
+# Лимит на обработчик для всех пользователей процесса вместе - страховка от массового наплыва ботов,
+# чтобы не исчерпать квоты YooKassa: (в секунду, запас). Одиночного нарушителя останавливают лимиты выше.
+GLOBAL_HANDLER_LIMITS = {
+    'handle_subscription_choice': (50, 200),
+    'check_payment_status_handler': (100, 300),
+}
+# Сколько пользователей держать в памяти на каждый лимит
+MAX_TRACKED_USERS = 50000
+
+
+# Ограничивает частоту вызова обработчиков token bucket'ами: общим на пользователя (с учетом стоимости
+# обработчика), отдельным на пользователя и дорогой обработчик и общим на обработчик.
+# Отклоненное нажатие кнопки получает быстрый answer_callback_query, сообщения просто пропускаются.
+class ThrottlingMiddleware(BaseMiddleware):
+
+    def __init__(self):
+        super().__init__()
+        self.user_buckets = BucketMap(USER_RATE, USER_BURST, MAX_TRACKED_USERS)
+        self.user_handler_buckets = {
+            name: BucketMap(rate, burst, MAX_TRACKED_USERS) for name, (rate, burst) in USER_HANDLER_LIMITS.items()
+        }
+        now = time.monotonic()
+        self.global_buckets = {
+            name: TokenBucket(rate, burst, now) for name, (rate, burst) in GLOBAL_HANDLER_LIMITS.items()
+        }
+
+    # Сколько секунд пользователю ждать вызова обработчика (0 - можно выполнять, токены списаны)
+    def _acquire(self, user_id, name, now):
+        cost = HANDLER_COSTS.get(name, 1)
+        buckets = [(self.user_buckets.get(user_id, now), cost)]
+        if name in self.user_handler_buckets:
+            buckets.append((self.user_handler_buckets[name].get(user_id, now), 1))
+        if name in self.global_buckets:
+            buckets.append((self.global_buckets[name], 1))
+
+        # Списываем, только если хватает во всех корзинах, чтобы отказ не расходовал остальные лимиты
+        wait = max(bucket.delay(now, bucket_cost) for bucket, bucket_cost in buckets)
+        if wait > 0:
+            return wait
+        for bucket, bucket_cost in buckets:
+            bucket.consume(now, bucket_cost)
+        return 0.0
+
+    def _throttled(self, user):
+        handler = current_handler.get()
+        if handler is None or user is None:
+            return 0.0
+        wait = self._acquire(user.id, handler.__name__, time.monotonic())
+        if wait > 0:
+            logging.info("Пользователь %s превысил лимит %s, ждать %.1f с", user.id, handler.__name__, wait)
+        return wait
+
+    async def on_process_message(self, message, data):
+        if self._throttled(message.from_user):
+            raise CancelHandler()
+
+    async def on_process_callback_query(self, callback_query, data):
+        wait = self._throttled(callback_query.from_user)
+        if wait:
+            try:
+                await callback_query.answer(f"Слишком много запросов, попробуйте через {int(wait) + 1} с")
+            except Exception as e:
+                logging.warning("Не удалось ответить на callback пользователя %s: %s", callback_query.from_user.id, e)
+            raise CancelHandler()
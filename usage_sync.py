@@ -0,0 +1,70 @@
+import database
+
+import asyncio
+import logging
+import time
+
+# Как часто забирать трафик пользователей из Marzban, в секундах
+USAGE_SYNC_INTERVAL = 300
+# Сколько пользователей запрашивать одной страницей GET api/users
+USAGE_PAGE_SIZE = 1000
+
+
+# user_id из имени пользователя Marzban вида user_<id>; None для чужих пользователей панели
+def _user_id(username):
+    prefix, _, user_id = (username or "").partition("_")
+    if prefix != "user" or not user_id.isdigit():
+        return None
+    return int(user_id)
+
+
+# Проходит весь список пользователей узла страницами и сохраняет трафик.
+# Возвращает (сколько пользователей получено, сколько строк изменилось).
+async def _sync_node(node_id, backend, now):
+    offset = seen = changed = 0
+    while True:
+        users, total = await backend.list_users(offset, USAGE_PAGE_SIZE)
+        rows = []
+        for user in users:
+            user_id = _user_id(user.get("username"))
+            if user_id is None:
+                continue
+            rows.append((
+                user_id, node_id, user.get("status"),
+                user.get("used_traffic") or 0, user.get("lifetime_used_traffic") or 0, user.get("data_limit"),
+            ))
+        if rows:
+            changed += await database.save_usage(rows, now)
+        seen += len(users)
+        offset += len(users)
+        if len(users) < USAGE_PAGE_SIZE or offset >= total:
+            return seen, changed
+
+
+# Один проход по всем узлам пула (узлы опрашиваются параллельно, страницы узла - по очереди)
+async def sync_once(marzban):
+    now = int(time.time())
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(_sync_node(node_id, backend, now) for node_id, backend in marzban.nodes.items()),
+        return_exceptions=True
+    )
+    seen = changed = 0
+    for node_id, result in zip(marzban.nodes, results):
+        if isinstance(result, Exception):
+            logging.error("Не удалось получить трафик с узла Marzban %s: %s", node_id, result)
+            continue
+        seen += result[0]
+        changed += result[1]
+    logging.info("Трафик синхронизирован: %s пользователей, изменилось %s, %.1f с", seen, changed, time.monotonic() - started)
+    return seen, changed
+
+
+# Фоновая задача ведущего процесса: периодическая синхронизация трафика
+async def run(marzban):
+    while True:
+        try:
+            await sync_once(marzban)
+        except Exception as e:
+            logging.error("Ошибка при синхронизации трафика: %s", e)
+        await asyncio.sleep(USAGE_SYNC_INTERVAL)
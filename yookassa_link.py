@@ -1,86 +1,129 @@
-import yookassa
-import get_api_token
-import aiosqlite
-import logging
-
-
-async def create_payment(user_id, duration):
-    try:
-        # Настройка конфигурации YooKassa
-        yookassa.Configuration.account_id = get_api_token.Yoo_Api_id
-        yookassa.Configuration.secret_key = get_api_token.Yoo_Api_key
-
-        # Определение суммы и описания на основе выбранного срока
-        if duration == '1month':
-            amount_value = 100
-            description = f'Подписка на 1 месяц для user_{user_id}'
-        elif duration == '3month':
-            amount_value = 250
-            description = f'Подписка на 3 месяца для user_{user_id}'
-        elif duration == '6month':
-            amount_value = 450
-            description = f'Подписка на 6 месяцев для user_{user_id}'
-        else:
-            logging.error(f"Неизвестная длительность подписки: {duration}")
-            return None
-
-        # Создание платежа
-        payment = yookassa.Payment.create({
-            "amount": {
-                "value": amount_value,
-                "currency": "RUB"
-            },
-            "confirmation": {
-                "type": 'redirect',
-                "return_url": f'https://t.me/UmbraVPN_bot?start={user_id}'
-            },
-            'description': description,
-            'capture': True
-        })
-
-        # Сохранение идентификатора платежа в БД
-        async with aiosqlite.connect('tg.db') as db:
-            await db.execute('''
-                UPDATE accounts
-                SET payment_id = ?
-                WHERE user_id = ?
-            ''', (payment.id, user_id))
-            await db.commit()
-
-
-        # Возврат ссылки для подтверждения платежа
-        url = payment.confirmation.confirmation_url
-        return url
-
-    except Exception as e:
-        logging.error(f"Ошибка при создании платежа для пользователя {user_id}: {str(e)}")
-        return None
-
-
-
-
-async def check_payment_status(user_id):
-    try:
-        yookassa.Configuration.account_id = get_api_token.Yoo_Api_id
-        yookassa.Configuration.secret_key = get_api_token.Yoo_Api_key
-
-        async with aiosqlite.connect('tg.db') as db:
-            async with db.execute('SELECT payment_id FROM accounts WHERE user_id = ?', (user_id,)) as cursor:
-                row = await cursor.fetchone()
-
-        if row:
-            payment_id = row[0]
-            payment = yookassa.Payment.find_one(payment_id)
-            status = payment.status
-
-            if status == 'succeeded':
-                return True
-            else:
-                return False
-        else:
-            logging.warning(f"No payment_id found for user {user_id}")
-            return False
-
-    except Exception as e:
-        logging.error(f"Ошибка при проверке статуса платежа для пользователя {user_id}: {str(e)}")
-        return False
+import get_api_token
+import database
+import subscriptions
+import metrics
+import logging
+import time
+import uuid
+import aiohttp
+
+# Через сколько секунд после создания платеж впервые проверит фоновая сверка (reconciler.py)
+FIRST_CHECK_DELAY = 60
+
+# Общая сессия с пулом keep-alive соединений к API YooKassa.
+# Создается один раз при старте бота (start) и закрывается при остановке (close).
+_session = None
+
+
+class YooKassaError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f"YooKassa API error {status}: {body}")
+        self.status = status
+        self.body = body
+
+
+async def start():
+    global _session
+    if _session is not None:
+        return
+    connector = aiohttp.TCPConnector(limit=get_api_token.Yoo_Api_connections, ttl_dns_cache=300)
+    _session = aiohttp.ClientSession(
+        connector=connector,
+        auth=aiohttp.BasicAuth(get_api_token.Yoo_Api_id or '', get_api_token.Yoo_Api_key or ''),
+        timeout=aiohttp.ClientTimeout(total=30),
+        headers={"Content-Type": "application/json"},
+    )
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _request(method, path, data=None, idempotence_key=None):
+    url = f"{get_api_token.Yoo_Api_url}/{path}"
+    headers = {}
+    if idempotence_key:
+        # Повтор запроса с тем же ключом не создаст второй платеж
+        headers["Idempotence-Key"] = idempotence_key
+    started = time.perf_counter()
+    async with _session.request(method, url, json=data, headers=headers) as response:
+        body = await response.json(content_type=None)
+        template = "payments/{payment_id}" if path.startswith("payments/") else path
+        metrics.YOOKASSA_REQUEST_SECONDS.observe(time.perf_counter() - started, method, template, response.status)
+        if response.status != 200:
+            raise YooKassaError(response.status, body)
+        return body
+
+
+# Возвращает платеж в виде словаря, как его отдает API YooKassa
+async def get_payment(payment_id):
+    return await _request("GET", f"payments/{payment_id}")
+
+
+# Создает платеж по тарифу plan (plans.Plan) и возвращает ссылку на оплату или None
+async def create_payment(user_id, plan):
+    try:
+        # Создание платежа
+        payment = await _request("POST", "payments", {
+            "amount": {
+                "value": f"{plan.price}.00",
+                "currency": "RUB"
+            },
+            "confirmation": {
+                "type": 'redirect',
+                "return_url": f'https://t.me/UmbraVPN_bot?start={user_id}'
+            },
+            'description': f'Подписка на {plan.title} для user_{user_id}',
+            'metadata': {'user_id': user_id, 'plan': plan.code},
+            'capture': True
+        }, idempotence_key=str(uuid.uuid4()))
+
+        # Сохранение платежа в историю и как текущего платежа пользователя
+        now = int(time.time())
+        await database.add_payment(payment["id"], user_id, plan.code, plan.price, now, now + FIRST_CHECK_DELAY)
+        subscriptions.invalidate(user_id)
+
+        # Возврат ссылки для подтверждения платежа
+        url = payment["confirmation"]["confirmation_url"]
+        return url
+
+    except Exception as e:
+        logging.error("Ошибка при создании платежа для пользователя %s: %s", user_id, e)
+        return None
+
+
+
+
+# Возвращает последний платеж пользователя, если он оплачен, иначе None
+async def check_payment_status(user_id):
+    try:
+        last_payment = await database.get_last_payment(user_id)
+        if last_payment:
+            payment_id, plan, status = last_payment
+            if status == 'succeeded':
+                # Платеж уже подтвержден вебхуком или фоновой сверкой - в API не ходим
+                return {"id": payment_id, "status": status, "metadata": {"plan": plan}}
+            if status == 'canceled':
+                return None
+        else:
+            # Платежи, созданные до появления таблицы payments
+            payment_id = await database.get_payment_id(user_id)
+
+        if payment_id:
+            payment = await get_payment(payment_id)
+            status = payment.get("status")
+
+            if status == 'succeeded':
+                return payment
+            else:
+                return None
+        else:
+            logging.warning("No payment_id found for user %s", user_id)
+            return None
+
+    except Exception as e:
+        logging.error("Ошибка при проверке статуса платежа для пользователя %s: %s", user_id, e)
+        return None